@@ -0,0 +1,86 @@
+import functools
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(benchmarks_dir, '..', 'data-collection'))
+sys.path.append(os.path.join(benchmarks_dir, '..', 'model'))
+from SpotifyApi import SpotifyApi
+from features import FEATURE_COLUMNS, synthetic_tracks
+from genres import synthetic_artists
+
+
+@functools.lru_cache(maxsize=None)
+def tracks(n_tracks: int) -> pd.DataFrame:
+    # shared by all benchmarks of a scale, they must not modify it
+    return synthetic_tracks(n_tracks)
+
+
+@functools.lru_cache(maxsize=None)
+def artists(n_tracks: int) -> pd.DataFrame:
+    return synthetic_artists(tracks(n_tracks))
+
+
+@functools.lru_cache(maxsize=None)
+def responses(n_tracks: int) -> dict[str, list[dict]]:
+    # json bodies shaped like the items of the track, audio features and artist
+    # endpoints, for the tracks and artists of the scale
+    tracks_df = tracks(n_tracks)
+    artists_df = artists(n_tracks)
+    rng = np.random.default_rng(0)
+    popularity = rng.integers(0, 100, len(tracks_df)).tolist()
+    duration = rng.integers(60_000, 400_000, len(tracks_df)).tolist()
+    track_items = [
+        {
+            'id': track_id,
+            'album': {'id': track_id, 'name': album, 'uri': f'spotify:album:{track_id}', 'artists': [{'id': artist_id, 'name': '', 'genres': [], 'uri': f'spotify:artist:{artist_id}'}]},
+            'artists': [{'id': artist_id}],
+            'disc_number': 1,
+            'duration_ms': duration[i],
+            'explicit': False,
+            'is_local': False,
+            'name': name,
+            'popularity': popularity[i],
+            'track_number': 1,
+            'preview_url': None,
+            'uri': f'spotify:track:{track_id}',
+        }
+        for i, (track_id, name, artist_id, album) in enumerate(zip(tracks_df['id'], tracks_df['name'], tracks_df['artists_ids'], tracks_df['album']))
+    ]
+    values = tracks_df[FEATURE_COLUMNS].to_numpy().tolist()
+    feature_items = [
+        {'track_href': f'https://api.spotify.com/v1/tracks/{track_id}', **dict(zip(FEATURE_COLUMNS, row))}
+        for track_id, row in zip(tracks_df['id'], values)
+    ]
+    artist_items = [
+        {'id': artist_id, 'name': name, 'genres': genres.split('/'), 'uri': f'spotify:artist:{artist_id}'}
+        for artist_id, name, genres in zip(artists_df['artist_id'], artists_df['name'], artists_df['genres'])
+    ]
+    return {'tracks': track_items, 'audio_features': feature_items, 'artists': artist_items}
+
+
+@functools.lru_cache(maxsize=None)
+def parsed(n_tracks: int) -> dict[str, list]:
+    items = responses(n_tracks)
+    return {
+        'tracks': [SpotifyApi.Track.from_response(item) for item in items['tracks']],
+        'audio_features': [SpotifyApi.AudioFeatures.from_response(item) for item in items['audio_features']],
+        'artists': [SpotifyApi.Artist.from_response(item) for item in items['artists']],
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def cache(n_tracks: int) -> dict[str, dict]:
+    # the cache contents per type after crawling the tracks of the scale
+    objects = parsed(n_tracks)
+    spotify = SpotifyApi.__new__(SpotifyApi)
+    spotify.cache = {'artists': {}, 'playlists': {}, 'tracks': {}, 'categories': {}, 'audio_features': {}}
+    for track in objects['tracks']:
+        spotify.save_to_cache('tracks', track.id, track.to_dict())
+    for features in objects['audio_features']:
+        spotify.save_to_cache('audio_features', features.track_id, features.to_dict())
+    for artist in objects['artists']:
+        spotify.save_to_cache('artists', artist.id, artist.to_dict())
+    return spotify.cache
@@ -0,0 +1,264 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(benchmarks_dir, '..', 'data-collection'))
+sys.path.append(os.path.join(benchmarks_dir, '..', 'model'))
+import fixtures
+import script
+from SpotifyApi import SpotifyApi
+from spotify_cache import SpotifyCache
+from feature_store import FeatureStore
+from features import FEATURE_COLUMNS
+from k_sweep import fit
+from metrics import album_codes, artist_codes, densities
+from silhouette import sampled_silhouette
+
+BASELINE_PATH = os.path.join(benchmarks_dir, 'baselines', 'baseline.json')
+
+SCALES = [10_000, 100_000, 1_000_000]
+
+# a benchmark slower than its baseline by more than this share is a regression
+TOLERANCE = 0.25
+
+# timings below this many seconds are mostly noise and never count as regressions
+NOISE_FLOOR = 0.005
+
+
+def parse_responses(n_tracks: int):
+    items = fixtures.responses(n_tracks)
+
+    def run():
+        [SpotifyApi.Track.from_response(item) for item in items['tracks']]
+        [SpotifyApi.AudioFeatures.from_response(item) for item in items['audio_features']]
+        [SpotifyApi.Artist.from_response(item) for item in items['artists']]
+    return run
+
+
+def spotify_with_cache(n_tracks: int) -> 'SpotifyApi':
+    # a client without a session, only its cache is used, with every type loaded
+    spotify = SpotifyApi.__new__(SpotifyApi)
+    spotify.cache = SpotifyCache(f'cache_{n_tracks}')
+    spotify.cache.types = dict(fixtures.cache(n_tracks))
+    spotify.cache_hits = 0
+    return spotify
+
+
+def cache_save(n_tracks: int):
+    return spotify_with_cache(n_tracks).save_cache
+
+
+def cache_load(n_tracks: int):
+    spotify = spotify_with_cache(n_tracks)
+    spotify.save_cache()
+    return lambda: SpotifyCache(spotify.cache.directory).load_all()
+
+
+def cache_stats(n_tracks: int):
+    # what `cli.py cache stats` reads, without loading the cache
+    spotify = spotify_with_cache(n_tracks)
+    spotify.save_cache()
+    return lambda: SpotifyCache(spotify.cache.directory).stats()
+
+
+def cache_get(n_tracks: int):
+    spotify = spotify_with_cache(n_tracks)
+    track_ids = fixtures.tracks(n_tracks)['id'].tolist()
+    # every track once, half of them also as a miss of another type
+    missing = track_ids[::2]
+
+    def run():
+        for track_id in track_ids:
+            spotify.get_from_cache('tracks', track_id)
+        for track_id in missing:
+            spotify.get_from_cache('playlists', track_id)
+    return run
+
+
+def build_dataframes(n_tracks: int):
+    objects = fixtures.parsed(n_tracks)
+
+    def run():
+        script.track_list_to_dataframe(objects['tracks'])
+        script.features_list_to_dataframe(objects['audio_features'])
+        script.artists_list_to_dataframe(objects['artists'])
+    return run
+
+
+def enrichment_join(n_tracks: int):
+    tracks_df = fixtures.tracks(n_tracks)
+    artists_df = fixtures.artists(n_tracks)
+    return lambda: script.artist_columns(tracks_df, artists_df)
+
+
+def feature_matrix(n_tracks: int):
+    tracks_df = fixtures.tracks(n_tracks)
+    directory = tempfile.mkdtemp(dir='.')
+    runs = iter(range(sys.maxsize))
+    # every run builds a new store, parsing the columns, fitting the scaler and writing
+    # the matrix and the id index
+    return lambda: FeatureStore.build(tracks_df, os.path.join(directory, str(next(runs))))
+
+
+def kmeans_fit(n_tracks: int):
+    features = fixtures.tracks(n_tracks)[FEATURE_COLUMNS].to_numpy(dtype=np.float32)
+    # __wrapped__ skips the memo cache, which would answer every run after the first
+    return lambda: fit.__wrapped__(features, 20, 'k-means++', minibatch=True)
+
+
+def density_scores(n_tracks: int):
+    tracks_df = fixtures.tracks(n_tracks)
+    labelings = np.random.default_rng(0).integers(-1, 50, (5, n_tracks))
+
+    def run():
+        for rows, codes in [artist_codes(tracks_df), album_codes(tracks_df)]:
+            densities(rows, codes, labelings)
+    return run
+
+
+def silhouette_score(n_tracks: int):
+    features = fixtures.tracks(n_tracks)[FEATURE_COLUMNS].to_numpy(dtype=np.float32)
+    labels = np.random.default_rng(0).integers(0, 50, n_tracks)
+    return lambda: sampled_silhouette.__wrapped__(features, labels, sample_size=500)
+
+
+# name -> function of the number of tracks that prepares the inputs and returns the
+# callable that is timed
+BENCHMARKS = {
+    'parse_responses': parse_responses,
+    'cache_save': cache_save,
+    'cache_load': cache_load,
+    'cache_get': cache_get,
+    'cache_stats': cache_stats,
+    'build_dataframes': build_dataframes,
+    'enrichment_join': enrichment_join,
+    'feature_matrix': feature_matrix,
+    'kmeans_fit': kmeans_fit,
+    'density_scores': density_scores,
+    'silhouette_score': silhouette_score,
+}
+
+# the cache of a million tracks takes gigabytes of memory as python objects, on top of
+# the responses and parsed objects it is made from
+MAX_TRACKS = {
+    'cache_save': 100_000,
+    'cache_load': 100_000,
+    'cache_get': 100_000,
+    'cache_stats': 100_000,
+}
+
+
+def measure(run, repeats: int) -> float:
+    # the fastest of repeats runs, the one least disturbed by the rest of the machine
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def machine() -> dict:
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float = TOLERANCE, noise_floor: float = NOISE_FLOOR) -> list[dict]:
+    # one row per benchmark and scale that is in both results
+    rows = []
+    for name, timings in results['results'].items():
+        for scale, seconds in timings.items():
+            previous = baseline['results'].get(name, {}).get(scale)
+            if previous is None:
+                continue
+            ratio = seconds / previous if previous > 0 else float('inf')
+            rows.append({
+                'benchmark': name,
+                'tracks': int(scale),
+                'seconds': seconds,
+                'baseline': previous,
+                'ratio': ratio,
+                'regression': ratio > 1 + tolerance and seconds > noise_floor,
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the data collection and model code on synthetic data, compared with a json baseline.')
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES[:2], help=f'numbers of tracks, {SCALES} for the full suite')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='run only these benchmarks')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='allowed slowdown against the baseline, as a share')
+    parser.add_argument('--output', help='write the results to this json')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to --baseline, merged into the timings already there')
+    args = parser.parse_args()
+
+    names = args.only or list(BENCHMARKS)
+    results = {'machine': machine(), 'repeats': args.repeats, 'results': {name: {} for name in names}}
+    # the cache and feature stores are written to a temporary directory
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            for n_tracks in sorted(args.scales):
+                for name in names:
+                    if n_tracks > MAX_TRACKS.get(name, n_tracks):
+                        continue
+                    seconds = measure(BENCHMARKS[name](n_tracks), args.repeats)
+                    results['results'][name][str(n_tracks)] = seconds
+                    print(f'{name} ({n_tracks} tracks): {seconds * 1000:.1f}ms')
+                for fixture in [fixtures.tracks, fixtures.artists, fixtures.responses, fixtures.parsed, fixtures.cache]:
+                    fixture.cache_clear()
+        finally:
+            os.chdir(working_directory)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    regressions = []
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get('machine') != results['machine']:
+            print(f'The baseline was measured on another machine ({baseline.get("machine")}), ratios are only a rough guide')
+        rows = compare(results, baseline, args.tolerance)
+        for row in rows:
+            flag = '  REGRESSION' if row['regression'] else ''
+            print(f'{row["benchmark"]} ({row["tracks"]} tracks): {row["seconds"] * 1000:.1f}ms against {row["baseline"] * 1000:.1f}ms, {row["ratio"]:.2f}x{flag}')
+        regressions = [row for row in rows if row['regression']]
+        print(f'{len(regressions)} of {len(rows)} timings more than {args.tolerance:.0%} slower than the baseline')
+    else:
+        print(f'No baseline at {args.baseline}, run with --save-baseline to create it')
+
+    if args.save_baseline:
+        if os.path.exists(args.baseline):
+            # timings of benchmarks and scales that were not run are kept
+            for name, timings in results['results'].items():
+                baseline['results'].setdefault(name, {}).update(timings)
+            baseline.update(machine=results['machine'], repeats=results['repeats'])
+        else:
+            baseline = results
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline + '.tmp', 'w') as file:
+            json.dump(baseline, file, indent=2)
+        os.replace(args.baseline + '.tmp', args.baseline)
+        print(f'Saved the baseline to {args.baseline}')
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
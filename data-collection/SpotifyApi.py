@@ -1,9 +1,28 @@
 from aiohttp import ClientSession
+import asyncio
 import time
 import json
 import base64
+import os
+from contextlib import asynccontextmanager
 from typing import MutableSequence, Union
 import traceback
+from spotify_cache import CACHE_TTL, SpotifyCache
+
+try:
+    import fcntl
+except ImportError:
+    # no cross-process token lock on windows
+    fcntl = None
+
+TOKEN_PATH = 'token.json'
+
+# tokens are refreshed this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 5 * 60
+
+# a failed background refresh is retried after this many seconds, doubling up to the maximum
+TOKEN_RETRY_DELAY = 5
+TOKEN_RETRY_MAX_DELAY = 5 * 60
 
 def format_query(**kwargs):
     return '&'.join([f'{key}={value}' for key, value in kwargs.items()])
@@ -12,20 +31,36 @@ def format_query(**kwargs):
 def print_json(data: dict):
     print(json.dumps(data, indent=4))
 
+
+@asynccontextmanager
+async def file_lock(path: str):
+    # exclusive lock shared by all processes, polled so the event loop is not blocked
+    with open(path, 'a') as file:
+        while fcntl is not None:
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(0.05)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
 class SpotifyApi:
     def __init__(self, client_id, client_secret, session: ClientSession):
         self.client_id = client_id
         self.client_secret = client_secret
         self.session = session
-        self.load_cache()
-
-    cache = {
-        'artists': {},
-        'playlists': {},
-        'tracks': {},
-        'categories': {},
-        'audio_features': {},
-    }
+        self.access_token = None
+        self.token = None
+        self.refresh_task = None
+        # one refresh at a time within the process, the file lock covers other processes
+        self.refresh_lock = asyncio.Lock()
+        # nothing is read until a type of the cache is first used
+        self.cache = SpotifyCache()
+
     cache_hits = 0
 
     def save_to_cache(self, type: str, key: str, value: any):
@@ -36,7 +71,7 @@ class SpotifyApi:
 
     def get_from_cache(self, key: str, id: str):
         try:
-            if id in self.cache[key] and time.time() - self.cache[key][id]['timestamp'] < 60 * 60 * 24:
+            if id in self.cache[key] and time.time() - self.cache[key][id]['timestamp'] < CACHE_TTL:
                     self.cache_hits += 1
                     return self.cache[key][id]['value']
         except KeyError:
@@ -44,15 +79,10 @@ class SpotifyApi:
         return None
 
     def save_cache(self):
-        with open('cache.json', 'w') as file:
-            json.dump(self.cache, file)
+        self.cache.save()
 
     def load_cache(self):
-        try:
-            with open('cache.json', 'r') as file:
-                self.cache = json.load(file)
-        except FileNotFoundError:
-            pass
+        self.cache.load_all()
 
     class AudioFeatures:
         def __init__(self, track_id: str, danceability: float, energy: float, key: int, loudness: float, mode: int, speechiness: float, acousticness: float, instrumentalness: float, liveness: float, valence: float, tempo: float, time_signature: int):
@@ -430,6 +460,9 @@ class SpotifyApi:
         def is_expired(self) -> bool:
             return self.created_at + self.expires_in < time.time()
 
+        def expires_soon(self) -> bool:
+            return self.created_at + self.expires_in - TOKEN_REFRESH_MARGIN < time.time()
+
         def __str__(self) -> str:
             return json.dumps({
                 'access_token': self.access_token,
@@ -463,10 +496,12 @@ class SpotifyApi:
     async def __aenter__(self):
         print('enter async context')
         await self.initialize_authentication(self.session)
+        self.refresh_task = asyncio.create_task(self.__refresh_in_background(self.session))
         return self
 
     async def __aexit__(self, exc_type, exc, tb):
-        pass
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
 
     async def __authenticate_using_credentials(self, session: ClientSession):
         url = 'https://accounts.spotify.com/api/token'
@@ -485,52 +520,114 @@ class SpotifyApi:
             return (url, 'ERROR', None)
 
     async def initialize_authentication(self, session: ClientSession) -> None:
-        global spotify_access_token
         stored_token = self.__get_stored_token()
 
-        if stored_token is None or stored_token.is_expired():
+        if stored_token is None or stored_token.expires_soon():
             if stored_token is None:
                 print(
                     'No stored token found. Retrieving a new one using client credentials.')
             else:
                 print(
                     'Stored token is expired. Retrieving a new one using client credentials.')
-
-            (_, status, data) = await self.__authenticate_using_credentials(session)
-            if status != 'OK':
-                print('Failed to retrieve token.')
-                return
-            stored_token = SpotifyApi.StoredToken.from_response(data)
-            self.__store_token(stored_token)
-            print('Using new token {}'.format(stored_token.access_token))
+            await self.__refresh_token(session)
         else:
             print('Using stored token: {}'.format(stored_token))
+            self.__use_token(stored_token)
+
+    async def __refresh_token(self, session: ClientSession, stale_token: str = None) -> bool:
+        # refreshes unless another coroutine or process already stored a fresh token that
+        # is not stale_token (the one a request was just rejected with). returns False if
+        # no new token could be retrieved.
+        async with self.refresh_lock:
+            if self.token is not None and not self.token.expires_soon() and self.token.access_token != stale_token:
+                return True
+            async with file_lock(TOKEN_PATH + '.lock'):
+                stored_token = self.__get_stored_token()
+                if stored_token is not None and not stored_token.expires_soon() and stored_token.access_token != stale_token:
+                    print('Using token refreshed by another process')
+                    self.__use_token(stored_token)
+                    return True
+
+                (_, status, data) = await self.__authenticate_using_credentials(session)
+                if status != 'OK' or 'access_token' not in (data or {}):
+                    print('Failed to retrieve token.')
+                    return False
+                stored_token = SpotifyApi.StoredToken.from_response(data)
+                self.__store_token(stored_token)
+                print('Using new token {}'.format(stored_token.access_token))
+                self.__use_token(stored_token)
+                return True
+
+    async def __refresh_in_background(self, session: ClientSession):
+        # refreshes TOKEN_REFRESH_MARGIN seconds before the current token expires, so long
+        # crawls never send requests with an expired token. failed refreshes are retried
+        # with exponential backoff instead of immediately, the token still expires soon.
+        retry_delay = TOKEN_RETRY_DELAY
+        while True:
+            if self.token is None:
+                delay = 60
+            else:
+                delay = max(self.token.created_at + self.token.expires_in - TOKEN_REFRESH_MARGIN - time.time(), 0)
+            await asyncio.sleep(delay)
+            try:
+                refreshed = await self.__refresh_token(session)
+            except Exception as e:
+                print(e)
+                refreshed = False
+            if refreshed:
+                retry_delay = TOKEN_RETRY_DELAY
+            else:
+                print(f'Retrying the token refresh in {retry_delay}s')
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, TOKEN_RETRY_MAX_DELAY)
 
-        self.access_token = stored_token.access_token
+    def __use_token(self, token: 'SpotifyApi.StoredToken'):
+        self.token = token
+        self.access_token = token.access_token
 
     def __get_stored_token(self) -> 'SpotifyApi.StoredToken':
         try:
-            with open('token.json', 'r') as f:
+            with open(TOKEN_PATH, 'r') as f:
                 data = json.load(f)
                 return SpotifyApi.StoredToken.from_stored_json(data)
         except:
             return None
 
     def __store_token(self, token: Union[dict, 'SpotifyApi.StoredToken']):
-        with open('token.json', 'w') as f:
+        # replaced atomically, so processes reading it without the lock never see a partial file
+        temporary = '{}.{}.tmp'.format(TOKEN_PATH, os.getpid())
+        with open(temporary, 'w') as f:
             if type(token) is SpotifyApi.StoredToken:
                 token = token.__dict__
 
             json.dump(token, f)
+        os.replace(temporary, TOKEN_PATH)
 
     def __get_auth_header(self) -> dict:
         return {'Authorization': 'Bearer {}'.format(self.access_token)}
 
+    @asynccontextmanager
+    async def __get(self, session: ClientSession, url: str, params: dict = None):
+        # authenticated GET, retried once with a fresh token if the token was rejected
+        if self.token is None or self.token.expires_soon():
+            await self.__refresh_token(session)
+        token = self.access_token
+        response = await session.get(url, params=params, headers=self.__get_auth_header())
+        if response.status == 401:
+            response.release()
+            print('Token rejected, refreshing')
+            await self.__refresh_token(session, stale_token=token)
+            response = await session.get(url, params=params, headers=self.__get_auth_header())
+        try:
+            yield response
+        finally:
+            response.release()
+
     async def fetch_all_categories(self, session: ClientSession, offset=0, limit=20, locale='en_EN'):
         url = 'https://api.spotify.com/v1/browse/categories?{}'.format(
             format_query(offset=offset, limit=limit, locale=locale))
         try:
-            async with session.get(url, headers=({} | self.__get_auth_header())) as response:
+            async with self.__get(session, url) as response:
                 content = await response.json()
                 return (url, 'OK', content['categories']['items'])
         except Exception as e:
@@ -547,7 +644,7 @@ class SpotifyApi:
         url = 'https://api.spotify.com/v1/browse/categories/{}/playlists?{}'.format(
             category_id, format_query(offset=offset, limit=limit, country=country))
         try:
-            async with session.get(url, headers=({} | self.__get_auth_header())) as response:
+            async with self.__get(session, url) as response:
                 content = await response.json()
 
                 if content is None:
@@ -572,7 +669,7 @@ class SpotifyApi:
         url = 'https://api.spotify.com/v1/playlists/{}/tracks?{}'.format(
             playlist_id, format_query(offset=offset, limit=limit))
         try:
-            async with session.get(url, headers=({} | self.__get_auth_header())) as response:
+            async with self.__get(session, url) as response:
                 content = await response.json()
 
                 if content is None:
@@ -607,7 +704,7 @@ class SpotifyApi:
     async def fetch_track(self, session: ClientSession, id: str):
         url = 'https://api.spotify.com/v1/tracks/{}'.format(id)
         try:
-            async with session.get(url, headers=({} | self.__get_auth_header())) as response:
+            async with self.__get(session, url) as response:
                 content = await response.json()
                 return (url, 'OK', content)
         except Exception as e:
@@ -627,7 +724,7 @@ class SpotifyApi:
             'ids': ','.join(list(filter(lambda id: id not in self.cache['tracks'] ,ids)))
         }
         try:
-            async with session.get(url, params=params, headers=({} | self.__get_auth_header())) as response:
+            async with self.__get(session, url, params=params) as response:
                 content = await response.json()
                 tracks = [SpotifyApi.Track.from_response(a) for a in content['tracks']]
                 print('am i even here? wtf')
@@ -654,7 +751,7 @@ class SpotifyApi:
     async def fetch_artist(self, session: ClientSession, id: str):
         url = 'https://api.spotify.com/v1/artists/{}'.format(id)
         try:
-            async with session.get(url, headers=({} | self.__get_auth_header())) as response:
+            async with self.__get(session, url) as response:
                 content = await response.json()
                 return (url, 'OK', content)
         except Exception as e:
@@ -678,7 +775,7 @@ class SpotifyApi:
             'ids': ','.join(ids_to_fetch)
         }
         try:
-            async with session.get(url, params=params, headers=({} | self.__get_auth_header())) as response:
+            async with self.__get(session, url, params=params) as response:
                 content = await response.json()
 
                 if content is None:
@@ -696,10 +793,32 @@ class SpotifyApi:
             print(''.join(traceback.format_tb(e.__traceback__)))
             return (url, 'ERROR', None)
 
+    async def fetch_related_artists(self, session: ClientSession, id: str):
+        # up to 20 artists similar to the given one. the relationships are not cached
+        # (related_artists.py stores them as a graph), the related artists themselves are.
+        url = 'https://api.spotify.com/v1/artists/{}/related-artists'.format(id)
+        try:
+            async with self.__get(session, url) as response:
+                content = await response.json()
+
+                if content is None or 'artists' not in content:
+                    return (url, 'ERROR', None)
+
+                artists = [SpotifyApi.Artist.from_response(a) for a in content['artists']]
+
+                for artist in artists:
+                    self.save_to_cache('artists', artist.id, artist.to_dict())
+
+                return (url, 'OK', artists)
+        except Exception as e:
+            print(e)
+            print(''.join(traceback.format_tb(e.__traceback__)))
+            return (url, 'ERROR', None)
+
     async def fetch_audio_analysis(self, session: ClientSession, id: str):
         url = 'https://api.spotify.com/v1/audio-analysis/{}'.format(id)
         try:
-            async with session.get(url, headers=({} | self.__get_auth_header())) as response:
+            async with self.__get(session, url) as response:
                 content = await response.json()
                 return (url, 'OK', content)
         except Exception as e:
@@ -710,7 +829,7 @@ class SpotifyApi:
     async def fetch_audio_features(self, session: ClientSession, id: str):
         url = 'https://api.spotify.com/v1/audio-features/{}'.format(id)
         try:
-            async with session.get(url, headers=({} | self.__get_auth_header())) as response:
+            async with self.__get(session, url) as response:
                 content = await response.json()
 
                 if content is None:
@@ -740,7 +859,7 @@ class SpotifyApi:
             'ids': ','.join(ids_to_fetch)
         }
         try:
-            async with session.get(url, params=params, headers=({} | self.__get_auth_header())) as response:
+            async with self.__get(session, url, params=params) as response:
                 content = await response.json()
                 features = [SpotifyApi.AudioFeatures.from_response(f) for f in content['audio_features']]
 
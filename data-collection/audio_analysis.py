@@ -0,0 +1,197 @@
+import argparse
+import asyncio
+import os
+import sys
+import aiohttp
+import dotenv
+import numpy as np
+import pandas as pd
+from SpotifyApi import SpotifyApi
+
+model_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model')
+sys.path.append(model_dir)
+from snapshots import Snapshots
+
+AUDIO_ANALYSIS_DIR = 'audio_analysis'
+
+PITCH_COLUMNS = [f'pitch_{i}' for i in range(12)]
+TIMBRE_COLUMNS = [f'timbre_{i}' for i in range(12)]
+
+# one float16 row per segment of a track. segment start times are not stored, they are
+# the cumulative durations (float16 is too coarse for times of several minutes)
+SEGMENT_COLUMNS = ['duration', 'confidence', 'loudness_start', 'loudness_max', 'loudness_max_time'] + PITCH_COLUMNS + TIMBRE_COLUMNS
+
+# fixed-size float32 embedding of every track: duration weighted mean and standard
+# deviation of the pitch and timbre vectors and the loudness, plus segments per second
+SUMMARY_COLUMNS = (
+    [f'{column}_mean' for column in PITCH_COLUMNS + TIMBRE_COLUMNS + ['loudness_max']]
+    + [f'{column}_std' for column in PITCH_COLUMNS + TIMBRE_COLUMNS + ['loudness_max']]
+    + ['segments_per_second']
+)
+
+
+def segment_matrix(analysis: dict) -> np.ndarray:
+    # the segments of an audio-analysis response as a float32 matrix of SEGMENT_COLUMNS
+    segments = analysis['segments']
+    matrix = np.empty((len(segments), len(SEGMENT_COLUMNS)), dtype=np.float32)
+    for i, segment in enumerate(segments):
+        matrix[i, :5] = [segment['duration'], segment['confidence'], segment['loudness_start'], segment['loudness_max'], segment['loudness_max_time']]
+        matrix[i, 5:17] = segment['pitches']
+        matrix[i, 17:29] = segment['timbre']
+    return matrix
+
+
+def summary_embedding(segments: np.ndarray) -> np.ndarray:
+    columns = np.r_[5:29, 3]
+    values = segments[:, columns].astype(np.float64)
+    weights = segments[:, 0].astype(np.float64)
+    if len(segments) == 0 or weights.sum() <= 0:
+        return np.zeros(len(SUMMARY_COLUMNS), dtype=np.float32)
+    mean = np.average(values, axis=0, weights=weights)
+    std = np.sqrt(np.average((values - mean) ** 2, axis=0, weights=weights))
+    return np.concatenate([mean, std, [len(segments) / weights.sum()]]).astype(np.float32)
+
+
+def write_chunk(directory: str, track_ids: list[str], matrices: list[np.ndarray]):
+    # written to a temporary directory first, so readers never see a partial chunk
+    temporary = f'{directory}.{os.getpid()}.tmp'
+    os.makedirs(temporary, exist_ok=True)
+    np.save(os.path.join(temporary, 'track_ids.npy'), np.array(track_ids, dtype=str))
+    np.save(os.path.join(temporary, 'offsets.npy'), np.cumsum([0] + [len(matrix) for matrix in matrices]))
+    np.save(os.path.join(temporary, 'segments.npy'), np.concatenate(matrices).astype(np.float16))
+    np.save(os.path.join(temporary, 'summaries.npy'), np.stack([summary_embedding(matrix) for matrix in matrices]))
+    os.rename(temporary, directory)
+
+
+class AudioAnalysisStore:
+    """
+    Audio-analysis segments of many tracks, stored outside of the response cache as
+    append-only chunks under audio_analysis/chunk_<n>/: the float16 segment rows of all
+    tracks of the chunk (memory-mapped), the row offsets of every track and its summary
+    embedding.
+    """
+
+    def __init__(self, directory: str = AUDIO_ANALYSIS_DIR):
+        self.directory = directory
+        self.chunks = []
+        if os.path.exists(directory):
+            for name in sorted(os.listdir(directory)):
+                if name.startswith('chunk_') and not name.endswith('.tmp'):
+                    path = os.path.join(directory, name)
+                    self.chunks.append({
+                        'track_ids': np.load(os.path.join(path, 'track_ids.npy')),
+                        'offsets': np.load(os.path.join(path, 'offsets.npy')),
+                        'segments': np.load(os.path.join(path, 'segments.npy'), mmap_mode='r'),
+                        'summaries': np.load(os.path.join(path, 'summaries.npy'), mmap_mode='r'),
+                    })
+
+        # every stored track with its chunk and row, sorted by id for vectorised lookups.
+        # tracks stored twice resolve to the newest chunk.
+        track_ids = np.concatenate([chunk['track_ids'] for chunk in self.chunks]) if self.chunks else np.empty(0, dtype=str)
+        chunk_numbers = np.concatenate([np.full(len(chunk['track_ids']), i) for i, chunk in enumerate(self.chunks)]) if self.chunks else np.empty(0, dtype=np.int64)
+        rows = np.concatenate([np.arange(len(chunk['track_ids'])) for chunk in self.chunks]) if self.chunks else np.empty(0, dtype=np.int64)
+        order = np.lexsort((-chunk_numbers, track_ids))
+        first = np.concatenate([[True], track_ids[order][1:] != track_ids[order][:-1]]) if len(order) else np.empty(0, dtype=bool)
+        self.track_ids = track_ids[order][first]
+        self.chunk_numbers = chunk_numbers[order][first]
+        self.rows = rows[order][first]
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def locate(self, track_ids) -> np.ndarray:
+        # positions in self.track_ids, -1 for tracks that are not stored
+        track_ids = np.asarray(track_ids, dtype=str)
+        if len(self) == 0:
+            return np.full(len(track_ids), -1)
+        positions = np.minimum(np.searchsorted(self.track_ids, track_ids), len(self) - 1)
+        return np.where(self.track_ids[positions] == track_ids, positions, -1)
+
+    def missing(self, track_ids) -> list[str]:
+        track_ids = list(dict.fromkeys(track_ids))
+        return [track_id for track_id, position in zip(track_ids, self.locate(track_ids)) if position < 0]
+
+    def segments(self, track_id: str) -> np.ndarray:
+        # float16 segment rows (SEGMENT_COLUMNS) of one track, a view into the memory map
+        position = self.locate([track_id])[0]
+        if position < 0:
+            raise KeyError(track_id)
+        chunk = self.chunks[self.chunk_numbers[position]]
+        row = self.rows[position]
+        return chunk['segments'][chunk['offsets'][row]:chunk['offsets'][row + 1]]
+
+    def summaries(self, track_ids) -> np.ndarray:
+        # summary embeddings of the given tracks, nan rows for tracks that are not stored
+        positions = self.locate(track_ids)
+        result = np.full((len(positions), len(SUMMARY_COLUMNS)), np.nan, dtype=np.float32)
+        for number, chunk in enumerate(self.chunks):
+            selected = np.flatnonzero((positions >= 0) & (self.chunk_numbers[np.maximum(positions, 0)] == number))
+            result[selected] = chunk['summaries'][self.rows[positions[selected]]]
+        return result
+
+    def summary_frame(self) -> pd.DataFrame:
+        # track_id + SUMMARY_COLUMNS of every stored track, to merge into the feature
+        # dataset once so the embeddings cost nothing per query
+        df = pd.DataFrame(self.summaries(self.track_ids), columns=SUMMARY_COLUMNS)
+        df.insert(0, 'track_id', self.track_ids)
+        return df
+
+    def next_chunk(self) -> str:
+        numbers = [int(name[len('chunk_'):]) for name in os.listdir(self.directory) if name.startswith('chunk_') and not name.endswith('.tmp')] if os.path.exists(self.directory) else []
+        return os.path.join(self.directory, f'chunk_{max(numbers, default=-1) + 1:05d}')
+
+
+async def fetch_analysis(session: aiohttp.ClientSession, spotify: 'SpotifyApi', semaphore: asyncio.Semaphore, track_id: str) -> np.ndarray:
+    async with semaphore:
+        (_, status, data) = await spotify.fetch_audio_analysis(session, track_id)
+    if status != 'OK' or not data or 'segments' not in data:
+        print(f'No audio analysis for track {track_id}')
+        return None
+    # only the segment matrix is kept, the json document is dropped right away
+    return segment_matrix(data)
+
+
+async def ingest(session: aiohttp.ClientSession, spotify: 'SpotifyApi', track_ids: list[str], directory: str = AUDIO_ANALYSIS_DIR, concurrency: int = 8, chunk_size: int = 500) -> AudioAnalysisStore:
+    # fetches the analysis of every track that is not stored yet, concurrency requests at
+    # a time, and writes a chunk every chunk_size tracks so an interrupted run keeps them
+    store = AudioAnalysisStore(directory)
+    pending = store.missing(track_ids)
+    print(f'Fetching audio analysis for {len(pending)} tracks')
+    semaphore = asyncio.Semaphore(concurrency)
+    os.makedirs(directory, exist_ok=True)
+    for i in range(0, len(pending), chunk_size):
+        batch = pending[i:i + chunk_size]
+        matrices = await asyncio.gather(*[fetch_analysis(session, spotify, semaphore, track_id) for track_id in batch])
+        fetched = [(track_id, matrix) for track_id, matrix in zip(batch, matrices) if matrix is not None]
+        if fetched:
+            write_chunk(store.next_chunk(), [track_id for track_id, _ in fetched], [matrix for _, matrix in fetched])
+        print(f'Stored audio analysis for tracks {i} to {i + len(batch)}')
+    return AudioAnalysisStore(directory)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Fetch the audio analysis of tracks into a compact float16 store.')
+    parser.add_argument('--tracks', help='csv with an id column, by default the tracks of a dataset snapshot')
+    parser.add_argument('--dataset', default='dataset', help='snapshot directory of script.py')
+    parser.add_argument('--snapshot', default='latest', help='snapshot version to take the tracks from')
+    parser.add_argument('--directory', default=AUDIO_ANALYSIS_DIR)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--summaries', default='audio_analysis_summaries.csv', help='write the summary embeddings of all stored tracks to this csv')
+    args = parser.parse_args()
+
+    dotenv.load_dotenv()
+    if args.tracks:
+        track_ids = pd.read_csv(args.tracks, usecols=['id'])['id'].tolist()
+    else:
+        track_ids = Snapshots(args.dataset).load('tracks', args.snapshot, columns=['id'])['id'].tolist()
+    async with aiohttp.ClientSession() as session:
+        async with SpotifyApi(client_id=os.getenv('SPOTIFY_CLIENT_ID'), client_secret=os.getenv('SPOTIFY_CLIENT_SECRET'), session=session) as spotify:
+            store = await ingest(session, spotify, track_ids, args.directory, args.concurrency, args.chunk_size)
+
+    store.summary_frame().to_csv(args.summaries, index=False, sep=',')
+    print(f'{len(store)} tracks in {args.directory}, summaries written to {args.summaries}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,178 @@
+import argparse
+import os
+import sys
+import time
+from spotify_cache import CACHE_DIR, CACHE_TTL, CACHE_TYPES, SpotifyCache
+
+# pandas, asyncio, aiohttp, the api client and the model code are imported by the
+# commands that use them, so `cache stats` and --help start without loading any of them
+
+STAGES = ['categories', 'playlists', 'tracks', 'artists', 'features']
+
+# every crawl stage writes its frame here, later stages run on their own read it back
+STAGING_DIR = 'staging'
+
+# the stage whose frame a stage starts from
+STAGE_INPUTS = {
+    'playlists': 'categories',
+    'tracks': 'playlists',
+    'artists': 'tracks',
+    'features': 'tracks',
+}
+
+SNAPSHOT_DIR = 'dataset'
+
+
+def stage_path(stage: str) -> str:
+    return os.path.join(STAGING_DIR, f'{stage}.csv')
+
+
+def read_stage(stage: str):
+    import pandas as pd
+    if not os.path.exists(stage_path(stage)):
+        sys.exit(f'{stage_path(stage)} is missing, run `cli.py crawl {stage}` first')
+    return pd.read_csv(stage_path(stage))
+
+
+def write_stage(stage: str, df):
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    df.to_csv(stage_path(stage) + '.tmp', index=False, sep=',')
+    os.replace(stage_path(stage) + '.tmp', stage_path(stage))
+
+
+async def crawl(stages: list[str]):
+    import aiohttp
+    import script
+    from SpotifyApi import SpotifyApi
+
+    # missing inputs fail before anything is fetched
+    for stage in stages:
+        if STAGE_INPUTS.get(stage) not in [None] + stages and not os.path.exists(stage_path(STAGE_INPUTS[stage])):
+            sys.exit(f'{stage_path(STAGE_INPUTS[stage])} is missing, run `cli.py crawl {STAGE_INPUTS[stage]}` first')
+
+    frames = {}
+
+    def frame(stage: str):
+        # from this run, or from the staging directory of an earlier one
+        if stage not in frames:
+            frames[stage] = read_stage(stage)
+        return frames[stage]
+
+    async with aiohttp.ClientSession() as session:
+        async with SpotifyApi(client_id=script.spotify_client_id, client_secret=script.spotify_client_secret, session=session) as spotify:
+            try:
+                for stage in stages:
+                    start = time.perf_counter()
+                    if stage == 'categories':
+                        df = await script.get_all_category_dataframe(session, spotify, cache=True)
+                    elif stage == 'playlists':
+                        cois = script.read_text_file('categories_of_interest.txt').split('\n')
+                        df = await script.get_all_playlists_for_category_dataframe(session, spotify, cois, frame('categories'), cache=True)
+                    elif stage == 'tracks':
+                        df = await script.get_all_tracks_in_playlists(session, spotify, frame('playlists'), cache=True)
+                    elif stage == 'artists':
+                        df = await script.get_all_artists(session, spotify, frame('tracks'), cache=True)
+                    else:
+                        from cluster_model import CLUSTER_MODEL_PATH, ClusterModel
+                        cluster_model_path = os.path.join(script.model_dir, CLUSTER_MODEL_PATH)
+                        cluster_model = ClusterModel.load(cluster_model_path) if os.path.exists(cluster_model_path) else None
+                        df = await script.get_all_audio_features(session, spotify, frame('tracks'), cache=True, cluster_model=cluster_model)
+                        if cluster_model is not None:
+                            cluster_model.save(cluster_model_path)
+                    frames[stage] = df
+                    write_stage(stage, df)
+                    print(f'{stage}: {len(df)} rows in {time.perf_counter() - start:.1f}s, {spotify.cache_hits} cache hits so far')
+            except Exception as e:
+                spotify.save_cache()
+                raise e
+
+
+def enrich(dataset: str, export: bool):
+    import script
+    from snapshots import Snapshots
+
+    snapshots = Snapshots(dataset)
+    version = script.enrich(read_stage('tracks'), read_stage('artists'), read_stage('features'), snapshots, note='cli.py enrich')
+    if version is not None and export:
+        script.export(snapshots, version)
+
+
+def export(dataset: str, version: str):
+    import script
+    from snapshots import Snapshots
+
+    script.export(Snapshots(dataset), version, entities=['artists', 'aliases'])
+
+
+def format_age(timestamp: float) -> str:
+    if timestamp is None:
+        return '-'
+    hours = (time.time() - timestamp) / 3600
+    return f'{hours:.1f}h' if hours < 48 else f'{hours / 24:.1f}d'
+
+
+def cache_stats(cache: SpotifyCache):
+    stats = cache.stats()
+    if not stats and os.path.exists(cache.legacy_path):
+        print(f'{cache.legacy_path} ({os.path.getsize(cache.legacy_path) / 2 ** 20:.1f}MB) of an earlier version is split into {cache.directory}/ when the cache is next used')
+    elif not stats:
+        print(f'No cache in {cache.directory}')
+    for type, entry in stats.items():
+        if entry['entries'] == 0:
+            print(f'{type}: empty')
+            continue
+        print(f'{type}: {entry["entries"]} entries, {entry["bytes"] / 2 ** 20:.1f}MB, newest {format_age(entry["newest"])} old, oldest {format_age(entry["oldest"])} old')
+    expiring = [type for type, entry in stats.items() if entry['oldest'] is not None and time.time() - entry['oldest'] > CACHE_TTL]
+    if expiring:
+        print(f'Entries older than {CACHE_TTL // 3600}h are not served and are fetched again: {", ".join(expiring)} (see `cache vacuum`)')
+
+
+def cache_vacuum(cache: SpotifyCache, types: list[str], max_age_hours: float):
+    start = time.perf_counter()
+    dropped = cache.vacuum(types, max_age_hours * 3600)
+    print(', '.join(f'{type}: {count} dropped' for type, count in dropped.items()) + f' in {time.perf_counter() - start:.1f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Crawl the Spotify API stage by stage, merge the crawl into the dataset snapshots and inspect the response cache.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    crawl_parser = commands.add_parser('crawl', help='run crawl stages, each writes its result to the staging directory')
+    crawl_parser.add_argument('stages', nargs='*', metavar='stage', help=f'stages to run ({", ".join(STAGES)}), in this order (all by default). a stage without its input stage reads it from the staging directory.')
+
+    enrich_parser = commands.add_parser('enrich', help='collapse re-releases, join the artists into the tracks and merge the staged crawl into the snapshots')
+    enrich_parser.add_argument('--dataset', default=SNAPSHOT_DIR)
+    enrich_parser.add_argument('--no-export', action='store_true', help="don't export the new version as csv")
+
+    export_parser = commands.add_parser('export', help='write tracks_with_features_demo.csv, artists.csv and aliases.csv of a snapshot version')
+    export_parser.add_argument('--dataset', default=SNAPSHOT_DIR)
+    export_parser.add_argument('--version', default='latest')
+
+    cache_parser = commands.add_parser('cache', help='inspect or clean up the response cache')
+    cache_parser.add_argument('action', choices=['stats', 'vacuum'])
+    cache_parser.add_argument('--directory', default=CACHE_DIR)
+    # the evaluation reads the playlists from the cache, they are kept by default
+    cache_parser.add_argument('--types', nargs='+', choices=CACHE_TYPES, default=[type for type in CACHE_TYPES if type != 'playlists'], help='types to vacuum')
+    cache_parser.add_argument('--max-age-hours', type=float, default=CACHE_TTL / 3600, help='vacuum drops entries older than this')
+    args = parser.parse_args()
+
+    if args.command == 'crawl':
+        # checked here, argparse on python < 3.12 rejects an empty list against choices
+        unknown = [stage for stage in args.stages if stage not in STAGES]
+        if unknown:
+            crawl_parser.error(f'unknown stages {", ".join(unknown)}, choose from {", ".join(STAGES)}')
+        import asyncio
+        # the stages always run in pipeline order
+        asyncio.run(crawl([stage for stage in STAGES if stage in (args.stages or STAGES)]))
+    elif args.command == 'enrich':
+        enrich(args.dataset, not args.no_export)
+    elif args.command == 'export':
+        export(args.dataset, args.version)
+    elif args.action == 'stats':
+        cache_stats(SpotifyCache(args.directory))
+    else:
+        cache_vacuum(SpotifyCache(args.directory), args.types, args.max_age_hours)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import asyncio
+import os
+import sys
+import aiohttp
+import dotenv
+import numpy as np
+import pandas as pd
+from SpotifyApi import SpotifyApi
+
+model_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model')
+sys.path.append(model_dir)
+from artist_graph import ArtistGraph
+from ids import IdCatalogue, is_valid
+
+ARTIST_GRAPH_PATH = 'artist_graph.npz'
+
+
+async def fetch_related(session: aiohttp.ClientSession, spotify: 'SpotifyApi', semaphore: asyncio.Semaphore, artist_id: str) -> list[str]:
+    async with semaphore:
+        (_, status, artists) = await spotify.fetch_related_artists(session, artist_id)
+    if status != 'OK':
+        print(f'No related artists for artist {artist_id}')
+        return None
+    return [artist.id for artist in artists]
+
+
+async def crawl(session: aiohttp.ClientSession, spotify: 'SpotifyApi', seed_ids: list[str], path: str = ARTIST_GRAPH_PATH, max_depth: int = 0, max_artists: int = None, concurrency: int = 8, chunk_size: int = 500) -> ArtistGraph:
+    # breadth first from the seed artists: depth 0 fetches the related artists of the
+    # seeds, every further depth those of the artists found in the previous one. the
+    # graph is saved after every chunk_size artists, and artists that are already in the
+    # graph at path are not fetched again, so an interrupted crawl resumes where it stopped.
+    if os.path.exists(path):
+        graph = ArtistGraph.load(path)
+        artists = graph.artists
+    else:
+        artists = IdCatalogue()
+        graph = ArtistGraph.from_edges(artists, np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0, dtype=bool))
+    sources, targets = [[edges] for edges in graph.edges()]
+
+    semaphore = asyncio.Semaphore(concurrency)
+    frontier = artists.intern(seed_ids)
+    # the seeds may add artists to the catalogue
+    graph = ArtistGraph.from_edges(artists, sources[0], targets[0], graph.crawled)
+    for depth in range(max_depth + 1):
+        crawled = graph.crawled
+        pending = frontier[~crawled[frontier]]
+        if max_artists is not None:
+            pending = pending[:max(0, max_artists - crawled.sum())]
+        print(f'Depth {depth}: fetching related artists of {len(pending)} artists')
+        for i in range(0, len(pending), chunk_size):
+            batch = pending[i:i + chunk_size]
+            related = await asyncio.gather(*[fetch_related(session, spotify, semaphore, artist_id) for artist_id in artists.ids(batch)])
+
+            # failed requests stay uncrawled and are retried by the next run
+            fetched = [(code, related_ids) for code, related_ids in zip(batch, related) if related_ids is not None]
+            related_ids = [artist_id for _, related_ids in fetched for artist_id in related_ids]
+            sources.append(np.repeat(np.array([code for code, _ in fetched], dtype=np.int32), [len(related_ids) for _, related_ids in fetched]))
+            targets.append(artists.intern(related_ids) if related_ids else np.empty(0, dtype=np.int32))
+            crawled[[code for code, _ in fetched]] = True
+
+            graph = ArtistGraph.from_edges(artists, np.concatenate(sources), np.concatenate(targets), crawled)
+            crawled = graph.crawled
+            graph.save(path)
+            print(f'Fetched related artists of artists {i} to {i + len(batch)}, {len(artists)} artists known')
+
+        # the next depth are the related artists of this one, including those crawled by
+        # an earlier run
+        frontier = pd.unique(graph.adjacency[frontier].indices)
+        if len(frontier) == 0:
+            break
+
+    return graph
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Crawl the related artists of the collected artists into a CSR artist graph.')
+    parser.add_argument('--artists', default='artists.csv', help='csv with an artist_id column, the seeds of the crawl')
+    parser.add_argument('--output', default=ARTIST_GRAPH_PATH)
+    parser.add_argument('--depth', type=int, default=0, help='also crawl the related artists found, this many levels deep')
+    parser.add_argument('--max-artists', type=int, help='stop after crawling this many artists in total')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--chunk-size', type=int, default=500)
+    args = parser.parse_args()
+
+    dotenv.load_dotenv()
+    seed_ids = pd.read_csv(args.artists, usecols=['artist_id'])['artist_id'].dropna().astype(str)
+    seed_ids = pd.unique(seed_ids[is_valid(seed_ids)])
+    async with aiohttp.ClientSession() as session:
+        async with SpotifyApi(client_id=os.getenv('SPOTIFY_CLIENT_ID'), client_secret=os.getenv('SPOTIFY_CLIENT_SECRET'), session=session) as spotify:
+            graph = await crawl(session, spotify, seed_ids, args.output, args.depth, args.max_artists, args.concurrency, args.chunk_size)
+            spotify.save_cache()
+
+    print(f'{len(graph)} artists, {graph.crawled.sum()} crawled, {graph.adjacency.nnz} edges in {args.output}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -2,18 +2,29 @@ import asyncio
 from datetime import datetime, timedelta
 import json
 import os
+import sys
 import aiohttp
 import dotenv
+import numpy as np
 from SpotifyApi import SpotifyApi 
 import pandas as pd
 from typing import MutableSequence
 
+model_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model')
+sys.path.append(model_dir)
+# ids only needs pandas. cluster_model and dedup load sklearn and scipy, they (and
+# snapshots) are imported by the functions that use them, so a single crawl stage
+# doesn't wait for them
+from ids import IdCatalogue, decode, explode, first_occurrences
+
 dotenv.load_dotenv()
 
 spotify_client_id = os.getenv('SPOTIFY_CLIENT_ID')
 spotify_client_secret = os.getenv('SPOTIFY_CLIENT_SECRET')
 spotify_access_token = None
 
+SNAPSHOT_DIR = 'dataset'
+
 
 def print_json(data: dict):
     print(json.dumps(data, indent=4))
@@ -101,8 +112,7 @@ async def get_all_playlists_for_category_dataframe(session: aiohttp.ClientSessio
         'id': [playlist.id for playlist in all_playlists],
         'name': [playlist.name for playlist in all_playlists],
     })
-    playlists_df.drop_duplicates(subset=['id'], inplace=True)
-    return playlists_df
+    return playlists_df[first_occurrences(playlists_df['id'])]
 
 async def get_all_tracks_in_playlists(session: aiohttp.ClientSession, spotify: 'SpotifyApi', playlists_df: pd.DataFrame, cache=False) -> pd.DataFrame:
     all_tracks = []
@@ -121,13 +131,13 @@ async def get_all_tracks_in_playlists(session: aiohttp.ClientSession, spotify: '
         spotify.save_cache()
 
     tracks_df = track_list_to_dataframe(all_tracks)
-    tracks_df.drop_duplicates(subset=['id'], inplace=True)
-    return tracks_df
+    return tracks_df[first_occurrences(tracks_df['id'])]
 
 async def get_all_artists(session: aiohttp.ClientSession, spotify: 'SpotifyApi', tracks_df: pd.DataFrame, cache=False) -> pd.DataFrame:
     all_artists = []
-    artist_ids = tracks_df['artists_ids'].str.split('/').explode().unique().tolist()
-    for i in range(0, len(tracks_df), 50):
+    _, artist_keys = explode(tracks_df['artists_ids'])
+    artist_ids = decode(artist_keys[first_occurrences(artist_keys, packed=True)]).tolist()
+    for i in range(0, len(artist_ids), 50):
         print(f'Fetching artists for tracks {i} to {i+50}')
         (_, _, data) = await spotify.fetch_many_artists(session, artist_ids[i:i+50])
 
@@ -142,10 +152,29 @@ async def get_all_artists(session: aiohttp.ClientSession, spotify: 'SpotifyApi',
         spotify.save_cache()
 
     artists_df = artists_list_to_dataframe(all_artists)
-    artists_df.drop_duplicates(subset=['artist_id'], inplace=True)
-    return artists_df
-
-async def get_all_audio_features(session: aiohttp.ClientSession, spotify: 'SpotifyApi', tracks_df: pd.DataFrame, cache=False) -> pd.DataFrame:
+    return artists_df[first_occurrences(artists_df['artist_id'])]
+
+def join_by_row(rows: np.ndarray, values: np.ndarray, n_rows: int) -> list[str]:
+    # '/'-joined values per row, rows ascending. missing values are skipped like str.cat does.
+    present = ~pd.isna(values)
+    rows, values = rows[present], values[present].tolist()
+    starts = np.searchsorted(rows, np.arange(n_rows), side='left').tolist()
+    ends = np.searchsorted(rows, np.arange(n_rows), side='right').tolist()
+    return ['/'.join(values[start:end]) for start, end in zip(starts, ends)]
+
+def artist_columns(tracks_df: pd.DataFrame, artists_df: pd.DataFrame) -> tuple[list[str], list[str]]:
+    # '/'-joined names and genres of every track's artists, joined on interned integer
+    # artist codes instead of an isin filter over artists_df per track
+    artists_df = artists_df[first_occurrences(artists_df['artist_id'])]
+    catalogue = IdCatalogue(artists_df['artist_id'])
+    rows, artist_keys = explode(tracks_df['artists_ids'])
+    codes = catalogue.lookup(artist_keys)
+    known = codes >= 0
+    names = join_by_row(rows[known], artists_df['name'].to_numpy()[codes[known]], len(tracks_df))
+    genres = join_by_row(rows[known], artists_df['genres'].to_numpy()[codes[known]], len(tracks_df))
+    return names, genres
+
+async def get_all_audio_features(session: aiohttp.ClientSession, spotify: 'SpotifyApi', tracks_df: pd.DataFrame, cache=False, cluster_model: 'ClusterModel' = None) -> pd.DataFrame:
     all_features = []
     for i in range(0, len(tracks_df), 100):
         print(f'Fetching features for tracks {i} to {i+100}')
@@ -161,14 +190,99 @@ async def get_all_audio_features(session: aiohttp.ClientSession, spotify: 'Spoti
         spotify.save_cache()
 
     features_df = features_list_to_dataframe(all_features)
+
+    if cluster_model is not None:
+        # assign the new tracks to the existing clusters without refitting
+        labels = cluster_model.update(features_df['track_id'], features_df)
+        print(f'Assigned {len(labels)} tracks to clusters')
+
     return features_df
 
+def collapse_duplicates(tracks_df: pd.DataFrame, features_df: pd.DataFrame, snapshots: 'Snapshots' = None) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, dict[str, list]]:
+    # the canonical tracks, their features, the alias map and the stored ids to remove
+    # per entity. the crawl is collapsed together with the latest snapshot, so
+    # re-releases of stored tracks are found, and a stored track replaced by a more
+    # popular release of the same song is removed and becomes an alias.
+    from dedup import AliasMap, deduplicate
+
+    stored_aliases_df = pd.DataFrame(columns=['id', 'canonical_id'])
+    stored_ids = pd.Series(dtype=object)
+    if snapshots is not None and len(snapshots):
+        stored_tracks_df = snapshots.load('tracks')
+        stored_ids = stored_tracks_df['id']
+        stored_aliases_df = snapshots.load('aliases').reindex(columns=['id', 'canonical_id'])
+        # rows of the crawl replace the stored ones
+        tracks_df = pd.concat([stored_tracks_df, tracks_df], ignore_index=True)
+        features_df = pd.concat([snapshots.load('features'), features_df], ignore_index=True)
+        # last occurrences
+        tracks_df = tracks_df[first_occurrences(tracks_df['id'].to_numpy()[::-1])[::-1]]
+    features_df = features_df[first_occurrences(features_df['track_id'].to_numpy()[::-1])[::-1]]
+
+    # tracks without features are never collapsed
+    tracks_with_features_df = pd.merge(tracks_df, features_df, how='left', left_on='id', right_on='track_id')
+    canonical_df, aliases_df = deduplicate(tracks_with_features_df)
+
+    # earlier aliases point to the canonical track of their canonical track, aliases
+    # that are canonical tracks again (crawled with a higher popularity) are removed
+    revived = stored_aliases_df['id'].isin(canonical_df['id'])
+    earlier_df = stored_aliases_df[~revived & ~stored_aliases_df['id'].isin(aliases_df['id'])]
+    earlier_df = earlier_df.assign(canonical_id=AliasMap(aliases_df).resolve(earlier_df['canonical_id']))
+    aliases_df = pd.concat([earlier_df, aliases_df], ignore_index=True)
+
+    collapsed = stored_ids[stored_ids.isin(aliases_df['id'])].tolist()
+    removed = {'tracks': collapsed, 'features': collapsed, 'aliases': stored_aliases_df['id'][revived].tolist()}
+    tracks_df = tracks_df[tracks_df['id'].isin(canonical_df['id'])]
+    return tracks_df, features_df[features_df['track_id'].isin(tracks_df['id'])], aliases_df, removed
+
+def enrich(tracks_df: pd.DataFrame, artists_df: pd.DataFrame, features_df: pd.DataFrame, snapshots: 'Snapshots', note: str = None) -> int:
+    # joins the artists into the tracks, collapses re-releases and merges the frames into
+    # the snapshots. returns the new snapshot version, None if nothing changed.
+
+    # set artist names and combined artist genres of every track
+    tracks_df = tracks_df.copy()
+    tracks_df['artist_names'], tracks_df['artist_genres'] = artist_columns(tracks_df, artists_df)
+
+    # re-releases of the same song (remasters, deluxe editions, ...) are kept as
+    # one canonical track, the others only in the alias map
+    tracks_df, features_df, aliases_df, removed = collapse_duplicates(tracks_df, features_df, snapshots)
+    print(f'Collapsed {len(aliases_df)} re-releases into their canonical tracks, {len(removed["tracks"])} of them stored before')
+
+    print(tracks_df)
+
+    # only the new and changed rows are written, as a new snapshot version
+    version = snapshots.merge({'tracks': tracks_df, 'artists': artists_df, 'features': features_df, 'aliases': aliases_df}, note=note, removed=removed)
+    if version is None:
+        print(f'Nothing changed since snapshot version {snapshots.versions()[-1]}')
+    else:
+        print(f'Wrote snapshot version {version}, changed rows: {snapshots.snapshot(version)["changes"]}')
+    return version
+
+def export(snapshots: 'Snapshots', version='latest', entities: list[str] = None):
+    # the tracks with features, and the artists and the alias map if they changed in
+    # version (or the given entities), as the csv files the model and the server read
+    tracks_with_features_df = snapshots.tracks_with_features(version)
+    print(tracks_with_features_df)
+
+    tracks_with_features_df.to_csv(
+        'tracks_with_features_demo.csv', index=False, sep=',')
+    entities = snapshots.snapshot(version)['changes'] if entities is None else entities
+    if 'artists' in entities:
+        snapshots.load('artists', version).to_csv('artists.csv', index=False, sep=',')
+    if 'aliases' in entities:
+        snapshots.load('aliases', version).to_csv('aliases.csv', index=False, sep=',')
+
 async def main():
+    from cluster_model import CLUSTER_MODEL_PATH, ClusterModel
+    from snapshots import Snapshots
+
     demo_track_id = '11dFghVXANMlKmJXsNCbNl'
 
     cois = read_text_file('categories_of_interest.txt')
     cois = cois.split('\n')
 
+    cluster_model_path = os.path.join(model_dir, CLUSTER_MODEL_PATH)
+    cluster_model = ClusterModel.load(cluster_model_path) if os.path.exists(cluster_model_path) else None
+
     async with aiohttp.ClientSession() as session:
         async with SpotifyApi(client_id=spotify_client_id, client_secret=spotify_client_secret, session=session) as spotify:
             try:
@@ -177,50 +291,18 @@ async def main():
                 playlists_df = await get_all_playlists_for_category_dataframe(session, spotify, cois, category_df, cache=True)
                 print(f'Had {spotify.cache_hits} cache hits')
                 tracks_df = await get_all_tracks_in_playlists(session, spotify, playlists_df, cache=True)
-                tracks_df = pd.read_csv('tracks.csv')
                 print(f'Had {spotify.cache_hits} cache hits')
-                artists_df = pd.read_csv('artists.csv')
                 artists_df = await get_all_artists(session, spotify, tracks_df, cache=True)
                 print(f'Had {spotify.cache_hits} cache hits')
-                features_df = pd.read_csv('features.csv')
-                features_df = await get_all_audio_features(session, spotify, tracks_df, cache=True)
+                features_df = await get_all_audio_features(session, spotify, tracks_df, cache=True, cluster_model=cluster_model)
+                if cluster_model is not None:
+                    cluster_model.save(cluster_model_path)
                 print(f'Had {spotify.cache_hits} cache hits')
 
-                # iterate through all tracks
-                for _, row in tracks_df.iterrows():
-                    # get artists for track
-                    artists = artists_df[artists_df['artist_id'].isin(row['artist_id'].split('/'))]
-                    # set artist names in artist_names column
-                    tracks_df.at[row.name, 'artist_names'] = artists['name'].str.cat(sep='/')
-                    # set combined artist genres in artist_genres column
-                    tracks_df.at[row.name, 'artist_genres'] = artists['genres'].str.cat(sep='/')
-
-                print(tracks_df)
-
-                tracks_df.to_csv(
-                    'tracks.csv', index=False, sep=',')
-                
-                artists_df.to_csv(
-                    'artists.csv', index=False, sep=',')
-
-                features_df.to_csv(
-                    'features.csv', index=False, sep=',')
-
-
-                tracks_df['artist_names'] = tracks_df['artists_ids'].apply(lambda x: artists_df[artists_df['artist_id'].isin(x.split('/'))]['name'].str.cat(sep='/'))
-                tracks_df['artist_genres'] = tracks_df['artists_ids'].apply(lambda x: artists_df[artists_df['artist_id'].isin(x.split('/'))]['genres'].str.cat(sep='/'))
-
-                tracks_df.to_csv(
-                    'tracks_with_artists.csv', index=False, sep=',')
-
-                tracks_with_artists_df = pd.read_csv('tracks_with_artists.csv')
-
-                tracks_with_features_df = pd.merge(
-                    tracks_with_artists_df, features_df, left_on='id', right_on='track_id').drop('track_id', axis=1)
-                print(tracks_with_features_df)
-
-                tracks_with_features_df.to_csv(
-                    'tracks_with_features_demo.csv', index=False, sep=',')
+                snapshots = Snapshots(SNAPSHOT_DIR)
+                version = enrich(tracks_df, artists_df, features_df, snapshots, note='script.py crawl')
+                if version is not None:
+                    export(snapshots, version)
             except Exception as e:
                 spotify.save_cache()
                 raise e
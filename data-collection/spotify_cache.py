@@ -0,0 +1,108 @@
+import json
+import os
+import time
+
+CACHE_DIR = 'cache'
+
+# cache.json of earlier versions, split into CACHE_DIR the first time it is read
+LEGACY_CACHE_PATH = 'cache.json'
+
+CACHE_TYPES = ['artists', 'playlists', 'tracks', 'categories', 'audio_features']
+
+# entries older than this are not served by SpotifyApi.get_from_cache
+CACHE_TTL = 60 * 60 * 24
+
+
+class SpotifyCache:
+    """
+    Response cache of SpotifyApi, one json file per type (cache/<type>.json) that is
+    only parsed when the type is first used, so commands that never touch the cache,
+    or only one type of it, don't wait for all of it to load. stats.json holds the
+    entry counts and timestamps per type, written on every save, for inspecting the
+    cache without loading it.
+    """
+
+    def __init__(self, directory: str = CACHE_DIR, legacy_path: str = LEGACY_CACHE_PATH):
+        self.directory = directory
+        self.legacy_path = legacy_path
+        self.types = {}
+        self.split_legacy = False
+
+    def path(self, type: str) -> str:
+        return os.path.join(self.directory, f'{type}.json')
+
+    def __getitem__(self, type: str) -> dict:
+        if type not in self.types:
+            self.load(type)
+        return self.types[type]
+
+    def __contains__(self, type: str) -> bool:
+        return type in CACHE_TYPES or type in self.types
+
+    def load(self, type: str):
+        if os.path.exists(self.path(type)):
+            with open(self.path(type)) as file:
+                self.types[type] = json.load(file)
+        elif not self.split_legacy and os.path.exists(self.legacy_path) and not os.path.exists(self.directory):
+            # all types at once, the next save writes them as separate files
+            print(f'Splitting {self.legacy_path} into {self.directory}/')
+            with open(self.legacy_path) as file:
+                legacy = json.load(file)
+            for legacy_type, entries in legacy.items():
+                self.types.setdefault(legacy_type, entries)
+            self.split_legacy = True
+        self.types.setdefault(type, {})
+
+    def load_all(self):
+        for type in CACHE_TYPES:
+            self[type]
+
+    def save(self):
+        # only the types that were loaded can have changed
+        os.makedirs(self.directory, exist_ok=True)
+        for type, entries in self.types.items():
+            with open(self.path(type) + '.tmp', 'w') as file:
+                json.dump(entries, file)
+            os.replace(self.path(type) + '.tmp', self.path(type))
+        stats = self.stats()
+        stats.update({type: entry_stats(entries, os.path.getsize(self.path(type))) for type, entries in self.types.items()})
+        with open(os.path.join(self.directory, 'stats.json.tmp'), 'w') as file:
+            json.dump(stats, file, indent=2)
+        os.replace(os.path.join(self.directory, 'stats.json.tmp'), os.path.join(self.directory, 'stats.json'))
+
+    def stats(self) -> dict:
+        # from stats.json, nothing is parsed but types without stats (e.g. files written
+        # by hand) are counted from their file
+        try:
+            with open(os.path.join(self.directory, 'stats.json')) as file:
+                stats = json.load(file)
+        except FileNotFoundError:
+            stats = {}
+        for type in CACHE_TYPES:
+            if type not in stats and os.path.exists(self.path(type)):
+                stats[type] = entry_stats(self[type], os.path.getsize(self.path(type)))
+        return stats
+
+    def vacuum(self, types: list[str], max_age: float = CACHE_TTL) -> dict[str, int]:
+        # drops the entries of the given types older than max_age seconds and saves, returns
+        # the number of entries dropped per type
+        now = time.time()
+        dropped = {}
+        for type in types:
+            entries = self[type]
+            expired = [key for key, entry in entries.items() if isinstance(entry, dict) and now - entry.get('timestamp', now) > max_age]
+            for key in expired:
+                del entries[key]
+            dropped[type] = len(expired)
+        self.save()
+        return dropped
+
+
+def entry_stats(entries: dict, size: int) -> dict:
+    timestamps = [entry['timestamp'] for entry in entries.values() if isinstance(entry, dict) and 'timestamp' in entry]
+    return {
+        'entries': len(entries),
+        'oldest': min(timestamps, default=None),
+        'newest': max(timestamps, default=None),
+        'bytes': size,
+    }
@@ -0,0 +1,201 @@
+import argparse
+import os
+import time
+from functools import cached_property
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from genres import ARTISTS_PATH
+from ids import IdCatalogue
+
+ARTIST_GRAPH_PATH = '../data-collection/artist_graph.npz'
+
+# probability of following an edge instead of jumping back to the seeds
+ALPHA = 0.85
+
+# residual probability below which a walk is not followed further, trades a little
+# accuracy in the tail of the ranking for walks that stay near their seeds
+EPSILON = 1e-4
+
+
+class ArtistGraph:
+    """
+    Directed related-artists graph as a CSR adjacency matrix over interned artist codes
+    (row = artist, columns = its related artists), with a mask of the artists whose
+    related artists were fetched. Stored in one npz file by related_artists.py.
+    """
+
+    def __init__(self, artists: IdCatalogue, adjacency: sp.csr_matrix, crawled: np.ndarray):
+        self.artists = artists
+        self.adjacency = adjacency
+        self.crawled = crawled
+
+    def __len__(self):
+        return len(self.artists)
+
+    @staticmethod
+    def from_edges(artists: IdCatalogue, sources: np.ndarray, targets: np.ndarray, crawled: np.ndarray) -> 'ArtistGraph':
+        n = len(artists)
+        adjacency = sp.csr_matrix((np.ones(len(sources), dtype=np.float32), (sources, targets)), shape=(n, n))
+        adjacency.sum_duplicates()
+        adjacency.data[:] = 1
+        adjacency.indices = adjacency.indices.astype(np.int32)
+        # artists interned after crawled was last extended have not been crawled
+        crawled_mask = np.zeros(n, dtype=bool)
+        crawled_mask[:len(crawled)] = crawled
+        return ArtistGraph(artists, adjacency, crawled_mask)
+
+    @staticmethod
+    def load(path: str = ARTIST_GRAPH_PATH) -> 'ArtistGraph':
+        with np.load(path) as data:
+            artists = IdCatalogue.from_keys(data['keys'])
+            n = len(artists)
+            adjacency = sp.csr_matrix((np.ones(len(data['indices']), dtype=np.float32), data['indices'], data['indptr']), shape=(n, n))
+            return ArtistGraph(artists, adjacency, data['crawled'])
+
+    def save(self, path: str = ARTIST_GRAPH_PATH):
+        # written next to the old file and renamed over it, an interrupted crawl keeps
+        # the last complete graph
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'wb') as file:
+            np.savez(file, keys=self.artists.keys, indptr=self.adjacency.indptr, indices=self.adjacency.indices.astype(np.int32), crawled=self.crawled)
+        os.replace(temporary, path)
+
+    def edges(self) -> tuple[np.ndarray, np.ndarray]:
+        # (source, target) codes of every edge
+        return np.repeat(np.arange(len(self), dtype=np.int32), np.diff(self.adjacency.indptr)), self.adjacency.indices
+
+    @cached_property
+    def transition(self) -> sp.csr_matrix:
+        # transposed row-stochastic transition matrix, so one step of a walk over a batch
+        # of distributions (one per column) is transition @ scores
+        out_degrees = np.asarray(self.adjacency.sum(axis=1)).ravel()
+        return (sp.diags(1 / np.maximum(out_degrees, 1)).astype(np.float32) @ self.adjacency).T.tocsr()
+
+    @cached_property
+    def dangling(self) -> sp.csr_matrix:
+        # 1 x artist indicator of the artists without related artists (or not crawled
+        # yet), walks restart from them
+        return sp.csr_matrix((np.diff(self.adjacency.indptr) == 0).astype(np.float32)[None, :])
+
+    def restart_matrix(self, seeds: list[np.ndarray]) -> sp.csr_matrix:
+        # artist x query matrix, column i is the uniform distribution over the seeds of
+        # query i (empty for a query without seeds)
+        lengths = np.array([len(query_seeds) for query_seeds in seeds], dtype=np.int64)
+        rows = np.concatenate(seeds).astype(np.int64) if len(seeds) else np.empty(0, dtype=np.int64)
+        columns = np.repeat(np.arange(len(seeds)), lengths)
+        restart = sp.csr_matrix(((1 / lengths[columns]).astype(np.float32), (rows, columns)), shape=(len(self), len(seeds)))
+        restart.sum_duplicates()
+        return restart
+
+    def personalised_pagerank(self, seeds: list[np.ndarray], alpha: float = ALPHA, epsilon: float = EPSILON, max_iter: int = 100) -> np.ndarray:
+        # random walk with restart of every query at once, returns the artist x query
+        # matrix of visit probabilities. the walks are expanded hop by hop as a sparse
+        # artist x query residual: every hop settles 1 - alpha of the residual into the
+        # scores and moves the rest one edge further with a single sparse product for the
+        # whole batch. residual entries below epsilon are dropped, which keeps the residual
+        # local to the seeds (epsilon=0 is exact power iteration).
+        restart = self.restart_matrix(seeds)
+        residual = restart.copy()
+        scores = np.zeros((len(self), len(seeds)), dtype=np.float32)
+        for _ in range(max_iter):
+            if sp.issparse(residual) and residual.nnz > 0.1 * np.prod(residual.shape):
+                # once the walks have spread over most artists dense products are faster
+                residual = residual.toarray()
+            if sp.issparse(residual):
+                if residual.nnz == 0:
+                    break
+                entries = residual.tocoo()
+                scores[entries.row, entries.col] += (1 - alpha) * entries.data
+            else:
+                scores += (1 - alpha) * residual
+            # the mass on dangling artists jumps back to the seeds instead of leaking away
+            leaked = self.dangling @ residual
+            leaked = (leaked.toarray() if sp.issparse(leaked) else np.asarray(leaked)).ravel()
+            residual = alpha * (self.transition @ residual)
+            if leaked.any():
+                residual = residual + restart.multiply(alpha * leaked[None, :])
+            if sp.issparse(residual):
+                residual = residual.tocsr()
+                residual.data[residual.data < epsilon] = 0
+                residual.eliminate_zeros()
+            else:
+                residual = np.asarray(residual)
+                residual[residual < epsilon] = 0
+        return scores
+
+    def recommend(self, seeds: list[np.ndarray], k: int, alpha: float = ALPHA, epsilon: float = EPSILON, batch_size: int = 256) -> tuple[np.ndarray, np.ndarray]:
+        # the k highest ranked artists of every query without its seeds, as a len(seeds) x k
+        # matrix of codes (-1 padded where fewer artists are reachable) and their scores.
+        # queries are ranked batch_size at a time, which bounds the dense matrices to
+        # len(self) x batch_size.
+        codes = np.full((len(seeds), k), -1, dtype=np.int32)
+        scores = np.zeros((len(seeds), k), dtype=np.float32)
+        for start in range(0, len(seeds), batch_size):
+            batch = seeds[start:start + batch_size]
+            ranks = self.personalised_pagerank(batch, alpha, epsilon).T
+            for i, query_seeds in enumerate(batch):
+                ranks[i, query_seeds] = 0
+            top = np.argpartition(-ranks, min(k, len(self) - 1), axis=1)[:, :k]
+            top_scores = np.take_along_axis(ranks, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            top = np.take_along_axis(top, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+            reachable = top_scores > 0
+            codes[start:start + len(batch), :top.shape[1]] = np.where(reachable, top, -1)
+            scores[start:start + len(batch), :top.shape[1]] = np.where(reachable, top_scores, 0)
+        return codes, scores
+
+    def recommend_ids(self, seed_ids: list[list[str]], k: int, alpha: float = ALPHA, epsilon: float = EPSILON) -> list[list[str]]:
+        # recommend() for artist id strings, seeds that are not in the graph are ignored
+        seeds = [codes[codes >= 0] for codes in (self.artists.codes(query_ids) for query_ids in seed_ids)]
+        codes, _ = self.recommend(seeds, k, alpha, epsilon)
+        return [self.artists.ids(row[row >= 0]).tolist() for row in codes]
+
+
+def synthetic_graph(n_artists: int, degree: int = 20, seed: int = 0) -> ArtistGraph:
+    # artists related to their neighbours on a ring and to a few popular artists, a rough
+    # stand-in for scenes plus mainstream acts
+    rng = np.random.default_rng(seed)
+    artists = IdCatalogue([f'0artist{i:015d}' for i in range(n_artists)])
+    sources = np.repeat(np.arange(n_artists), degree)
+    local = (sources + rng.integers(1, 200, len(sources))) % n_artists
+    popularity = 1 / np.arange(1, n_artists + 1)
+    popular = rng.choice(n_artists, len(sources), p=popularity / popularity.sum())
+    targets = np.where(rng.random(len(sources)) < 0.75, local, popular)
+    keep = sources != targets
+    return ArtistGraph.from_edges(artists, sources[keep], targets[keep], np.ones(n_artists, dtype=bool))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Artist recommendations by personalised PageRank on the related-artists graph.')
+    parser.add_argument('--graph', default=ARTIST_GRAPH_PATH, help='npz written by data-collection/related_artists.py')
+    parser.add_argument('--synthetic', type=int, help='use a synthetic graph of this many artists instead')
+    parser.add_argument('--artists', nargs='+', help='seed artist ids, recommends for all of them together')
+    parser.add_argument('--benchmark', type=int, default=2000, help='time this many random single-seed queries')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--alpha', type=float, default=ALPHA)
+    parser.add_argument('--epsilon', type=float, default=EPSILON, help='0 for exact scores')
+    parser.add_argument('--batch-size', type=int, default=256)
+    args = parser.parse_args()
+
+    graph = synthetic_graph(args.synthetic) if args.synthetic else ArtistGraph.load(args.graph)
+    print(f'{len(graph)} artists, {graph.adjacency.nnz} edges, {graph.crawled.sum()} crawled')
+
+    if args.artists:
+        names = pd.read_csv(ARTISTS_PATH, usecols=['artist_id', 'name']).drop_duplicates('artist_id').set_index('artist_id')['name'] if not args.synthetic else pd.Series(dtype=str)
+        for artist_id in graph.recommend_ids([args.artists], args.k, args.alpha, args.epsilon)[0]:
+            print(f'{artist_id} {names.get(artist_id, "")}')
+
+    if args.benchmark:
+        rng = np.random.default_rng(0)
+        linked = np.flatnonzero(np.diff(graph.adjacency.indptr) > 0)
+        seeds = [np.array([code]) for code in rng.choice(linked, min(args.benchmark, len(linked)), replace=False)]
+        start = time.perf_counter()
+        graph.recommend(seeds, args.k, args.alpha, args.epsilon, args.batch_size)
+        elapsed = time.perf_counter() - start
+        print(f'{len(seeds)} queries in {elapsed:.2f}s ({len(seeds) / elapsed:.0f} queries per second)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import os
+import time
+import numpy as np
+from sklearn.metrics import pairwise_distances
+from evaluation import membership_matrix, split, synthetic_playlists, weighted_track_genres
+from feature_store import FeatureStore, load_dataset
+from hybrid import DEFAULT_WEIGHTS, HybridRanker, scale_rows
+
+
+def full_scan(ranker: HybridRanker, seeds: list[np.ndarray], k: int) -> np.ndarray:
+    # the same fusion over every track of the catalogue, one dense row per signal and query
+    seed_matrix = ranker.seed_matrix(seeds)
+    centres = np.asarray(seed_matrix @ ranker.features, dtype=np.float32)
+    is_seed = seed_matrix.toarray() > 0
+    audio = 1 / (1 + pairwise_distances(centres, ranker.features))
+    cooccurrence = (seed_matrix @ ranker.track_playlists @ ranker.membership).toarray()
+    profiles = (seed_matrix @ ranker.track_genres).toarray()
+    profiles /= np.maximum(np.linalg.norm(profiles, axis=1, keepdims=True), np.finfo(np.float32).tiny)
+    # seeds are left out before the signals are scaled, like in HybridRanker.rank
+    audio[is_seed] = 0
+    cooccurrence[is_seed] = 0
+    fused = ranker.weights['audio'] * scale_rows(audio) + ranker.weights['cooccurrence'] * scale_rows(cooccurrence)
+    fused += ranker.weights['genre'] * (ranker.track_genres @ profiles.T).T
+    fused[is_seed] = -np.inf
+    return np.argsort(-fused, axis=1)[:, :k]
+
+
+def overlap(rows: np.ndarray, reference: np.ndarray) -> float:
+    return float(np.mean([len(np.intersect1d(row[row >= 0], expected)) / len(expected) for row, expected in zip(rows, reference)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cost of the fused hybrid ranker against the audio-only ranker and a full scan fusion.')
+    parser.add_argument('--synthetic', type=int, default=100_000)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--batches', type=int, default=10)
+    parser.add_argument('-k', type=int, default=10)
+    args = parser.parse_args()
+
+    tracks_df, features = load_dataset(synthetic=args.synthetic, columns=['id', 'artists_ids'])
+    store = FeatureStore(os.path.dirname(features.filename))
+    train, seeds, _ = split(membership_matrix(synthetic_playlists(features, np.asarray(store.track_ids)), store), test_share=0.5)
+    track_genres = weighted_track_genres(tracks_df, synthetic=True)
+    batches = [seeds[start:start + args.batch_size] for start in range(0, len(seeds), args.batch_size)][:args.batches]
+    print(f'tracks: {len(store)}, queries: {sum(len(batch) for batch in batches)} in batches of {args.batch_size}, k: {args.k}')
+
+    fused = HybridRanker(features, train, track_genres, DEFAULT_WEIGHTS)
+    rankers = {
+        'audio only': HybridRanker(features, weights={'audio': 1}, index=fused.index),
+        'fused': fused,
+    }
+    results = {}
+    for name, ranker in rankers.items():
+        start = time.perf_counter()
+        results[name] = np.concatenate([ranker.rank(batch, args.k)[0] for batch in batches])
+        latency = (time.perf_counter() - start) / len(results[name])
+        print(f'{name}: {latency * 1000:.3f}ms/query')
+
+    start = time.perf_counter()
+    reference = np.concatenate([full_scan(fused, batch, args.k) for batch in batches])
+    latency = (time.perf_counter() - start) / len(reference)
+    print(f'full scan fusion: {latency * 1000:.3f}ms/query, top {args.k} overlap of the fused ranker: {overlap(results["fused"], reference):.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from features import synthetic_tracks
+from metrics import album_codes, artist_codes, densities
+
+
+def groupby_density(groups: pd.Series, labels: np.ndarray) -> float:
+    # the same metric with pandas groupby, for comparison
+    df = pd.DataFrame({'group': groups.to_numpy(), 'label': labels})
+    df = df[df['label'] != -1]
+    counts = df.groupby(['group', 'label']).size()
+    return float((counts.groupby(level=0).max() / counts.groupby(level=0).sum()).mean())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cost of artist_density + album_density per labeling on synthetic tracks.')
+    parser.add_argument('--tracks', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--labelings', type=int, default=20)
+    parser.add_argument('--clusters', type=int, default=50)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for n_tracks in args.tracks:
+        tracks_df = synthetic_tracks(n_tracks)
+        # random labelings with roughly 10% noise
+        labelings = rng.integers(-1, args.clusters, (args.labelings, n_tracks))
+        labelings[rng.random(labelings.shape) < 0.1] = -1
+
+        start = time.perf_counter()
+        codes = [artist_codes(tracks_df), album_codes(tracks_df)]
+        encoding = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for rows, group_codes in codes:
+            densities(rows, group_codes, labelings)
+        vectorised = (time.perf_counter() - start) / args.labelings
+
+        start = time.perf_counter()
+        for labels in labelings[:3]:
+            groupby_density(tracks_df['artists_ids'], labels)
+            groupby_density(tracks_df['album'], labels)
+        groupby = (time.perf_counter() - start) / 3
+
+        print(f'tracks: {n_tracks}, id encoding: {encoding * 1000:.1f}ms (once per batch), '
+              f'vectorised: {vectorised * 1000:.2f}ms/labeling, pandas groupby: {groupby * 1000:.2f}ms/labeling')
+
+
+if __name__ == '__main__':
+    main()
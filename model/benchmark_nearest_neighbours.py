@@ -0,0 +1,66 @@
+import argparse
+import time
+import numpy as np
+from feature_store import FeatureStore
+from features import synthetic_feature_matrix
+from nearest_neighbours import DEFAULT_BUCKET_WIDTH, ExactIndex, LSHIndex
+
+# (n_tables, n_projections, bucket width relative to the metric's default)
+LSH_PARAMETERS = [
+    (32, 8, 1.0),
+    (8, 6, 1.0),
+    (16, 6, 1.0),
+    (16, 8, 1.5),
+    (8, 4, 1.0),
+    (16, 4, 1.0),
+]
+
+
+def recall(exact_ids: np.ndarray, approximate_ids: np.ndarray) -> float:
+    hits = sum(len(set(exact) & set(approximate)) for exact, approximate in zip(exact_ids, approximate_ids))
+    return hits / exact_ids.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recall vs latency of approximate nearest neighbour search against exact search.')
+    parser.add_argument('--dataset', help='csv with the audio feature columns, defaults to synthetic data')
+    parser.add_argument('--synthetic', type=int, default=100_000, help='number of synthetic tracks if no dataset is given')
+    parser.add_argument('--metric', default='euclidean')
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('-k', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.dataset:
+        store = FeatureStore.for_dataset(args.dataset)
+        track_ids, features = store.track_ids, store.features
+    else:
+        track_ids, features = synthetic_feature_matrix(args.synthetic)
+    rng = np.random.default_rng(0)
+    queries = features[rng.choice(len(features), min(args.queries, len(features)), replace=False)]
+
+    print(f'tracks: {len(features)}, queries: {len(queries)}, k: {args.k}, metric: {args.metric}')
+
+    exact = ExactIndex(metric=args.metric)
+    exact.add(track_ids, features)
+    start = time.perf_counter()
+    exact_ids, _ = exact.query(queries, k=args.k)
+    exact_latency = (time.perf_counter() - start) / len(queries)
+    print(f'exact: recall: 1.0000, build: 0.00s, latency: {exact_latency * 1000:.3f}ms/query')
+
+    for n_tables, n_projections, width_factor in LSH_PARAMETERS:
+        bucket_width = DEFAULT_BUCKET_WIDTH[args.metric] * width_factor
+        index = LSHIndex(features.shape[1], metric=args.metric, n_tables=n_tables, n_projections=n_projections, bucket_width=bucket_width)
+        start = time.perf_counter()
+        index.add(track_ids, features)
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        approximate_ids, _ = index.query(queries, k=args.k)
+        latency = (time.perf_counter() - start) / len(queries)
+        print(f'lsh(n_tables: {n_tables}, n_projections: {n_projections}, bucket_width: {bucket_width}): '
+              f'recall: {recall(exact_ids, approximate_ids):.4f}, build: {build:.2f}s, '
+              f'latency: {latency * 1000:.3f}ms/query, speedup: {exact_latency / latency:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import argparse
+import numpy as np
+import pandas as pd
+from sklearn.cluster import DBSCAN, KMeans
+from sklearn.preprocessing import StandardScaler
+from features import DATASET_PATH, FEATURE_COLUMNS, load_tracks
+from nearest_neighbours import ExactIndex
+
+CLUSTER_MODEL_PATH = 'cluster_model.npz'
+
+
+class ClusterModel:
+    """
+    A fitted clustering that can be saved and assign new tracks without refitting:
+    either k-means centroids (nearest centroid) or DBSCAN core samples (cluster of the
+    nearest core sample if it is within eps, noise otherwise). Keeps an inverted index
+    of cluster id -> sorted array of the track ids in that cluster.
+    """
+
+    def __init__(self, mean: np.ndarray, scale: np.ndarray, points: np.ndarray, point_labels: np.ndarray, metric: str = 'euclidean', eps: float = None):
+        self.mean = mean
+        self.scale = scale
+        # centroids (point_labels = 0..k-1) or core samples with their cluster ids
+        self.points = points.astype(np.float32)
+        self.point_labels = point_labels
+        self.metric = metric
+        self.eps = eps
+        self.index = ExactIndex(metric=metric)
+        self.index.add(np.arange(len(points)), self.points)
+        self.clusters = {}
+        self.track_clusters = {}
+
+    @staticmethod
+    def standardisation(tracks_df: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+        scaler = StandardScaler().fit(tracks_df[FEATURE_COLUMNS].to_numpy(dtype=np.float64))
+        return scaler.mean_, scaler.scale_
+
+    @staticmethod
+    def fit_kmeans(tracks_df: pd.DataFrame, k: int, seed: int = 0) -> 'ClusterModel':
+        mean, scale = ClusterModel.standardisation(tracks_df)
+        features = (tracks_df[FEATURE_COLUMNS].to_numpy(dtype=np.float64) - mean) / scale
+        kmeans = KMeans(n_clusters=k, n_init=1, random_state=seed).fit(features)
+        model = ClusterModel(mean, scale, kmeans.cluster_centers_, np.arange(k))
+        model.add_to_index(tracks_df['id'].to_numpy(), kmeans.labels_)
+        return model
+
+    @staticmethod
+    def fit_dbscan(tracks_df: pd.DataFrame, eps: float, min_samples: int, metric: str = 'euclidean') -> 'ClusterModel':
+        mean, scale = ClusterModel.standardisation(tracks_df)
+        features = (tracks_df[FEATURE_COLUMNS].to_numpy(dtype=np.float64) - mean) / scale
+        dbscan = DBSCAN(eps=eps, min_samples=min_samples, metric=metric).fit(features)
+        core = dbscan.core_sample_indices_
+        model = ClusterModel(mean, scale, features[core], dbscan.labels_[core], metric=metric, eps=eps)
+        model.add_to_index(tracks_df['id'].to_numpy(), dbscan.labels_)
+        return model
+
+    def assign(self, feature_rows) -> np.ndarray:
+        # cluster ids for raw (unstandardised) rows of the FEATURE_COLUMNS
+        if isinstance(feature_rows, pd.DataFrame):
+            feature_rows = feature_rows[FEATURE_COLUMNS]
+        features = (np.asarray(feature_rows, dtype=np.float64) - self.mean) / self.scale
+        if len(self.points) == 0:
+            # a DBSCAN fit without core samples, every track is noise
+            return np.full(len(features), -1, dtype=np.int64)
+        nearest, distances = self.index.query(features, k=1)
+        labels = self.point_labels[nearest[:, 0].astype(np.int64)]
+        if self.eps is not None:
+            labels = np.where(distances[:, 0] <= self.eps, labels, -1)
+        return labels
+
+    def add_to_index(self, track_ids, labels: np.ndarray):
+        # tracks already in the index (or earlier in the batch) are skipped, each
+        # cluster's array stays sorted
+        track_ids, first = np.unique(np.asarray(track_ids, dtype=str), return_index=True)
+        labels = np.asarray(labels)[first]
+        new = np.array([track_id not in self.track_clusters for track_id in track_ids], dtype=bool)
+        track_ids, labels = track_ids[new], labels[new]
+        for label in np.unique(labels):
+            ids = np.sort(track_ids[labels == label])
+            members = self.clusters.get(int(label), np.empty(0, dtype=ids.dtype))
+            members = members.astype(np.promote_types(members.dtype, ids.dtype), copy=False)
+            self.clusters[int(label)] = np.insert(members, np.searchsorted(members, ids), ids)
+        self.track_clusters.update(zip(track_ids.tolist(), labels.tolist()))
+
+    def update(self, track_ids, feature_rows) -> np.ndarray:
+        # assign newly crawled tracks and add them to the index in place
+        labels = self.assign(feature_rows)
+        self.add_to_index(track_ids, labels)
+        return labels
+
+    def tracks_in_cluster(self, cluster_id: int) -> np.ndarray:
+        return self.clusters.get(cluster_id, np.empty(0, dtype=str))
+
+    def cluster_of(self, track_id: str) -> int:
+        return self.track_clusters.get(track_id)
+
+    def save(self, filename: str = CLUSTER_MODEL_PATH):
+        cluster_ids = np.array(sorted(self.clusters), dtype=np.int64)
+        members = [self.clusters[cluster_id] for cluster_id in cluster_ids]
+        np.savez(
+            filename,
+            mean=self.mean,
+            scale=self.scale,
+            points=self.points,
+            point_labels=self.point_labels,
+            metric=np.array(self.metric),
+            eps=np.array(np.nan if self.eps is None else self.eps),
+            cluster_ids=cluster_ids,
+            cluster_offsets=np.cumsum([0] + [len(ids) for ids in members]),
+            cluster_members=np.concatenate(members) if members else np.empty(0, dtype=str),
+        )
+
+    @staticmethod
+    def load(filename: str = CLUSTER_MODEL_PATH) -> 'ClusterModel':
+        with np.load(filename) as data:
+            eps = float(data['eps'])
+            model = ClusterModel(data['mean'], data['scale'], data['points'], data['point_labels'], metric=str(data['metric']), eps=None if np.isnan(eps) else eps)
+            offsets = data['cluster_offsets']
+            members = data['cluster_members']
+            for i, cluster_id in enumerate(data['cluster_ids']):
+                ids = members[offsets[i]:offsets[i + 1]]
+                model.clusters[int(cluster_id)] = ids
+                model.track_clusters.update(dict.fromkeys(ids.tolist(), int(cluster_id)))
+        return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit a cluster model on the dataset and save it for incremental assignment.')
+    parser.add_argument('--dataset', default=DATASET_PATH)
+    parser.add_argument('--k', type=int, help='fit k-means with k clusters')
+    parser.add_argument('--eps', type=float, help='fit DBSCAN with this eps')
+    parser.add_argument('--min-samples', type=int, default=10)
+    parser.add_argument('--metric', default='euclidean')
+    parser.add_argument('--output', default=CLUSTER_MODEL_PATH)
+    args = parser.parse_args()
+
+    tracks_df = load_tracks(args.dataset)
+    if args.k is not None:
+        model = ClusterModel.fit_kmeans(tracks_df, args.k)
+    elif args.eps is not None:
+        model = ClusterModel.fit_dbscan(tracks_df, args.eps, args.min_samples, metric=args.metric)
+    else:
+        parser.error('either --k or --eps is required')
+
+    model.save(args.output)
+    print(f'Saved model with {len(model.clusters)} clusters to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
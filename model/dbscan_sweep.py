@@ -0,0 +1,64 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.cluster import DBSCAN
+from feature_store import load_dataset
+from features import DATASET_PATH
+from memo import memoise
+from metrics import GROUP_COLUMNS, evaluate_batch
+from neighbour_graph import GRAPH_CACHE_DIR, neighbour_graph, threshold
+from scores import EPS_VALUES, METRICS, MIN_SAMPLES_VALUES, write_scores
+
+
+@memoise(ignore=['graph', 'cache_dir'])
+def dbscan_labels(features: np.ndarray, eps: float, min_samples: int, metric: str, graph: sp.csr_matrix = None, cache_dir: str = GRAPH_CACHE_DIR) -> np.ndarray:
+    # graph is the neighbour graph of the features at radius eps, if the caller has it
+    print(f'fitting eps: {eps}, min_samples: {min_samples}, metric: {metric}')
+    if graph is None:
+        graph = neighbour_graph(features, eps, metric, cache_dir=cache_dir)
+    return DBSCAN(eps=eps, min_samples=min_samples, metric='precomputed').fit(graph).labels_
+
+
+def sweep(tracks_df: pd.DataFrame, features: np.ndarray, eps_values: list[float], min_samples_values: list[int], metrics: list[str], cache_dir: str = GRAPH_CACHE_DIR, sample_size: int = None):
+    # the radius neighbour search runs once per metric at the largest eps (or not at all
+    # if it is cached), every DBSCAN fit works on a thresholded copy of that graph.
+    # fits that ran before with the same features and parameters come from the memo cache.
+    for metric in metrics:
+        graph = neighbour_graph(features, max(eps_values), metric, cache_dir=cache_dir)
+        for eps in eps_values:
+            eps_graph = threshold(graph, eps)
+            labelings = [dbscan_labels(features, eps, min_samples, metric, graph=eps_graph) for min_samples in min_samples_values]
+
+            results = evaluate_batch(tracks_df, features, labelings, metric=metric, sample_size=sample_size)
+            for min_samples, result in zip(min_samples_values, results):
+                yield {
+                    'eps': eps,
+                    'min_samples': min_samples,
+                    'metric': metric,
+                    **result,
+                }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DBSCAN eps x min_samples sweep on a shared, cached radius neighbour graph.')
+    parser.add_argument('--dataset', default=DATASET_PATH)
+    parser.add_argument('--synthetic', type=int, help='use this many synthetic tracks instead of the dataset')
+    parser.add_argument('--eps', type=float, nargs='+', default=EPS_VALUES)
+    parser.add_argument('--min-samples', type=int, nargs='+', default=MIN_SAMPLES_VALUES)
+    parser.add_argument('--metrics', nargs='+', default=METRICS)
+    parser.add_argument('--sample-size', type=int, help='estimate the score from a stratified sample of this many tracks')
+    parser.add_argument('--cache-dir', default=GRAPH_CACHE_DIR)
+    parser.add_argument('--output', default='dbscan_scores.txt')
+    args = parser.parse_args()
+
+    tracks_df, features = load_dataset(args.dataset, args.synthetic, columns=GROUP_COLUMNS)
+
+    start = time.perf_counter()
+    write_scores(sweep(tracks_df, features, args.eps, args.min_samples, args.metrics, cache_dir=args.cache_dir, sample_size=args.sample_size), args.output)
+    print(f'sweep took {time.perf_counter() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from features import DATASET_PATH, FEATURE_COLUMNS, load_tracks, synthetic_tracks
+from ids import encode_valid, search, sort_order
+
+# tracks with the same key count as one song if their standardised audio features are
+# at most this far apart (euclidean). a remaster moves the loudness by about half a
+# standard deviation, a live or acoustic version moves most of the features.
+MAX_DISTANCE = 1.0
+
+# every round collapses one group per key, tracks of a key still apart after this many
+# rounds (many different songs under one title, e.g. 'Rain Sounds' or an empty name)
+# stay canonical tracks of their own, so a crowded key costs O(rounds x tracks) instead
+# of O(tracks^2)
+MAX_ROUNDS = 16
+
+# bracketed or ' - ' suffixes with these words name a release of a song, not a new one.
+# remixes and live versions are left alone, the audio check would keep most of them
+# apart anyway.
+VERSION_WORDS = r'(?:remaster(?:ed)?|deluxe|edition|version|mono|stereo|single|radio edit|bonus track|anniversary|expanded)'
+VERSION_PATTERNS = [
+    rf'\s*[\(\[][^\)\]]*\b{VERSION_WORDS}\b[^\)\]]*[\)\]]',
+    rf'\s+-\s+[^-]*\b{VERSION_WORDS}\b.*$',
+    r'\s*[\(\[]\s*(?:feat|ft|with)\.?\s[^\)\]]*[\)\]]',
+    r'\s+(?:feat|ft)\.\s.*$',
+]
+
+
+def normalise_titles(names: pd.Series) -> pd.Series:
+    # lower case ascii titles without version suffixes, featured artists and punctuation
+    titles = names.fillna('').astype(str).str.normalize('NFKD').str.encode('ascii', 'ignore').str.decode('ascii').str.lower()
+    for pattern in VERSION_PATTERNS:
+        titles = titles.str.replace(pattern, '', regex=True)
+    return titles.str.replace(r'[^a-z0-9]+', ' ', regex=True).str.strip()
+
+
+def song_keys(tracks_df: pd.DataFrame) -> np.ndarray:
+    # uint64 hash of the normalised title and the primary (first) artist of every track
+    primary_artists = tracks_df['artists_ids'].fillna('').astype(str).str.split('/').str[0]
+    return pd.util.hash_pandas_object(normalise_titles(tracks_df['name']) + '\x00' + primary_artists, index=False).to_numpy()
+
+
+def standardised(tracks_df: pd.DataFrame) -> np.ndarray:
+    columns = [column for column in FEATURE_COLUMNS if column in tracks_df]
+    values = tracks_df[columns].to_numpy(dtype=np.float64)
+    return ((values - np.nanmean(values, axis=0)) / np.maximum(np.nanstd(values, axis=0), 1e-12)).astype(np.float32)
+
+
+def canonical_rows(keys: np.ndarray, features: np.ndarray, priority: np.ndarray = None, max_distance: float = MAX_DISTANCE, max_rounds: int = MAX_ROUNDS) -> np.ndarray:
+    # the row of the canonical track of every row. tracks of one key are collapsed into
+    # the one with the highest priority (e.g. popularity, earlier rows win ties) if they
+    # are close enough to it, the rest of the key is resolved the same way in the next
+    # round, for at most max_rounds rounds. tracks without features are never collapsed.
+    n = len(keys)
+    priority = np.zeros(n) if priority is None else np.nan_to_num(np.asarray(priority, dtype=np.float64), nan=-np.inf)
+    order = np.lexsort((np.arange(n), -priority, keys))
+    keys, features = keys[order], features[order]
+    canonical = np.arange(n)
+    pending = np.ones(n, dtype=bool)
+    # keys of a single track are settled without any distance
+    alone = np.ones(n, dtype=bool)
+    alone[1:] &= keys[1:] != keys[:-1]
+    alone[:-1] &= keys[:-1] != keys[1:]
+    pending[alone] = False
+    for _ in range(max_rounds):
+        if not pending.any():
+            break
+        rows = np.flatnonzero(pending)
+        heads = np.ones(len(rows), dtype=bool)
+        heads[1:] = keys[rows[1:]] != keys[rows[:-1]]
+        head_rows = rows[np.flatnonzero(heads)[np.cumsum(heads) - 1]]
+        distances = np.linalg.norm(features[rows] - features[head_rows], axis=1)
+        collapsed = heads | (distances <= max_distance)
+        canonical[rows[collapsed]] = head_rows[collapsed]
+        pending[rows[collapsed]] = False
+    result = np.empty(n, dtype=np.int64)
+    result[order] = order[canonical]
+    return result
+
+
+def deduplicate(tracks_df: pd.DataFrame, features: np.ndarray = None, max_distance: float = MAX_DISTANCE, max_rounds: int = MAX_ROUNDS) -> tuple[pd.DataFrame, pd.DataFrame]:
+    # the canonical tracks and the alias map (id -> canonical_id) of the collapsed ones.
+    # features are the audio features of the rows, standardised over tracks_df by default.
+    features = standardised(tracks_df) if features is None else np.asarray(features, dtype=np.float32)
+    priority = tracks_df['popularity'].to_numpy() if 'popularity' in tracks_df else None
+    canonical = canonical_rows(song_keys(tracks_df), features, priority, max_distance, max_rounds)
+    aliases = np.flatnonzero(canonical != np.arange(len(tracks_df)))
+    ids = tracks_df['id'].to_numpy()
+    alias_df = pd.DataFrame({'id': ids[aliases], 'canonical_id': ids[canonical[aliases]]})
+    return tracks_df[canonical == np.arange(len(tracks_df))], alias_df
+
+
+class AliasMap:
+    """
+    Track id -> canonical track id of the alias map from deduplicate, as packed keys
+    sorted for vectorised lookups. Ids that are not aliases map to themselves.
+    """
+
+    def __init__(self, alias_df: pd.DataFrame):
+        valid, keys = encode_valid(alias_df['id'].to_numpy(dtype=str))
+        order = sort_order(keys)
+        self.sorted_keys = keys[order]
+        self.canonical_ids = alias_df['canonical_id'].to_numpy(dtype=str)[valid][order]
+
+    def __len__(self):
+        return len(self.sorted_keys)
+
+    def resolve(self, track_ids) -> np.ndarray:
+        track_ids = np.asarray(track_ids, dtype=str).ravel()
+        if not len(self):
+            return track_ids
+        valid, keys = encode_valid(track_ids)
+        positions = np.full(len(track_ids), -1, dtype=np.int64)
+        positions[valid] = search(self.sorted_keys, keys)
+        return np.where(positions >= 0, self.canonical_ids[np.maximum(positions, 0)], track_ids)
+
+
+def synthetic_duplicates(tracks_df: pd.DataFrame, share: float = 0.2, seed: int = 0) -> pd.DataFrame:
+    # tracks_df plus re-releases of a share of its tracks: the same title with a version
+    # suffix and slightly different features, and some other songs under a taken title
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(tracks_df), int(len(tracks_df) * share))
+    copies = tracks_df.iloc[rows].reset_index(drop=True)
+    suffixes = np.array([' - Remastered 2011', ' (Deluxe Edition)', ' (feat. Someone)', ' - Single Version', ' [Mono]'])
+    copies['name'] = copies['name'] + suffixes[rng.integers(0, len(suffixes), len(copies))]
+    copies['id'] = [f'1duplicate{i:012d}' for i in range(len(copies))]
+    columns = [column for column in FEATURE_COLUMNS if column in copies]
+    noise = rng.normal(scale=0.05, size=(len(copies), len(columns)))
+    # every tenth copy is a different recording, far from the original
+    noise[::10] += rng.normal(scale=3, size=(len(noise[::10]), len(columns)))
+    copies[columns] = copies[columns].to_numpy() + noise * tracks_df[columns].std().to_numpy()
+    return pd.concat([tracks_df, copies], ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Collapse re-releases of the same song into canonical tracks with an alias map.')
+    parser.add_argument('--dataset', default=DATASET_PATH)
+    parser.add_argument('--synthetic', type=int, help='use this many synthetic tracks plus synthetic re-releases instead of the dataset')
+    parser.add_argument('--max-distance', type=float, default=MAX_DISTANCE)
+    parser.add_argument('--output', help='write the canonical tracks to this csv')
+    parser.add_argument('--aliases', help='write the alias map (id, canonical_id) to this csv')
+    args = parser.parse_args()
+
+    tracks_df = synthetic_duplicates(synthetic_tracks(args.synthetic)) if args.synthetic else load_tracks(args.dataset)
+    start = time.perf_counter()
+    canonical_df, alias_df = deduplicate(tracks_df, max_distance=args.max_distance)
+    print(f'{len(tracks_df)} tracks collapsed into {len(canonical_df)} ({len(alias_df)} aliases, {1 - len(canonical_df) / len(tracks_df):.1%} fewer) in {time.perf_counter() - start:.2f}s')
+
+    if args.output:
+        canonical_df.to_csv(args.output, index=False, sep=',')
+    if args.aliases:
+        alias_df.to_csv(args.aliases, index=False, sep=',')
+
+
+if __name__ == '__main__':
+    main()
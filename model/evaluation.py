@@ -0,0 +1,254 @@
+import argparse
+import json
+import os
+import time
+import tracemalloc
+import numpy as np
+import scipy.sparse as sp
+from feature_store import FeatureStore, load_dataset
+from features import DATASET_PATH
+from genres import ARTISTS_PATH, GenreEncoder, synthetic_artists
+from hybrid import HybridRanker
+from nearest_neighbours import ExactIndex, LSHIndex
+
+CACHE_PATH = '../data-collection/cache'
+
+K_VALUES = [10, 50]
+
+
+def load_playlists(path: str = CACHE_PATH) -> dict[str, list[str]]:
+    # playlist id -> track ids, as cached by SpotifyApi.fetch_all_tracks_in_playlist. path
+    # is the cache directory, or a cache.json of earlier versions of the data collection
+    if os.path.isdir(path):
+        with open(os.path.join(path, 'playlists.json'), 'r') as file:
+            playlists = json.load(file)
+    else:
+        with open(path, 'r') as file:
+            playlists = json.load(file).get('playlists', {})
+    return {playlist_id: entry['value'] for playlist_id, entry in playlists.items()}
+
+
+def synthetic_playlists(features: np.ndarray, track_ids: np.ndarray, n_playlists: int = 2000, size: int = 30, neighbourhood: int = 300, seed: int = 0) -> dict[str, list[str]]:
+    # playlists of tracks drawn from the neighbourhood of a random track, so tracks that
+    # sound alike share playlists like they (hopefully) do in the real data
+    rng = np.random.default_rng(seed)
+    index = ExactIndex()
+    index.add(np.arange(len(features)), features)
+    anchors = rng.choice(len(features), n_playlists, replace=False)
+    neighbours, _ = index.query(features[np.sort(anchors)], k=neighbourhood)
+    return {
+        f'playlist{i}': track_ids[rng.choice(neighbours[i].astype(np.int64), size, replace=False)].tolist()
+        for i in range(n_playlists)
+    }
+
+
+def membership_matrix(playlists: dict[str, list[str]], store: FeatureStore) -> sp.csr_matrix:
+    # playlist x track matrix over the store rows, tracks without features are dropped
+    lengths = [len(track_ids) for track_ids in playlists.values()]
+    rows = store.rows(np.concatenate([np.asarray(track_ids, dtype=str) for track_ids in playlists.values()]) if lengths else np.empty(0, dtype=str))
+    playlist_rows = np.repeat(np.arange(len(playlists)), lengths)
+    known = rows >= 0
+    membership = sp.csr_matrix((np.ones(known.sum(), dtype=np.float32), (playlist_rows[known], rows[known])), shape=(len(playlists), len(store)))
+    membership.sum_duplicates()
+    membership.data[:] = 1
+    return membership
+
+
+def split(membership: sp.csr_matrix, test_share: float = 0.2, holdout: float = 0.5, min_size: int = 5, seed: int = 0) -> tuple[sp.csr_matrix, list[np.ndarray], sp.csr_matrix]:
+    # test_share of the playlists with at least min_size tracks are held out: holdout of
+    # their tracks become the targets, the rest the seeds of the query. returns the
+    # training membership (all other playlists plus the seeds), the seeds of every query
+    # and the query x track target matrix.
+    rng = np.random.default_rng(seed)
+    sizes = np.diff(membership.indptr)
+    eligible = np.flatnonzero(sizes >= min_size)
+    test = np.sort(rng.choice(eligible, int(len(eligible) * test_share), replace=False))
+
+    # a random rank within its playlist for every entry, the lowest ranks are seeds
+    playlists = np.repeat(np.arange(membership.shape[0]), sizes)
+    order = np.lexsort((rng.random(len(playlists)), playlists))
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - membership.indptr[playlists[order]]
+    n_seeds = np.maximum(1, np.round(sizes * (1 - holdout)).astype(np.int64))
+    is_target = np.isin(playlists, test) & (rank >= n_seeds[playlists])
+
+    train = membership.copy()
+    train.data = (~is_target).astype(np.float32)
+    train.eliminate_zeros()
+    targets = membership.copy()
+    targets.data = is_target.astype(np.float32)
+    targets = targets[test]
+    targets.eliminate_zeros()
+    seeds = [train.indices[train.indptr[playlist]:train.indptr[playlist + 1]] for playlist in test]
+    return train, seeds, targets
+
+
+def exclude_seeds(rows: np.ndarray, seeds: list[np.ndarray], k: int) -> np.ndarray:
+    # the first k rows of every query that are not one of its seeds, -1 padded
+    result = np.full((len(seeds), k), -1, dtype=np.int64)
+    for i, query_seeds in enumerate(seeds):
+        kept = rows[i][(rows[i] >= 0) & ~np.isin(rows[i], query_seeds)][:k]
+        result[i, :len(kept)] = kept
+    return result
+
+
+def centroid_recommender(features: np.ndarray, train: sp.csr_matrix, track_genres: sp.csr_matrix = None):
+    # tracks closest to the mean features of the seeds
+    index = ExactIndex()
+    index.add(np.arange(len(features)), features)
+
+    def recommend(seeds: list[np.ndarray], k: int) -> np.ndarray:
+        centres = np.stack([np.asarray(features[np.sort(query_seeds)]).mean(axis=0) for query_seeds in seeds])
+        rows, _ = index.query(centres, k + max(len(query_seeds) for query_seeds in seeds))
+        return exclude_seeds(rows.astype(np.int64), seeds, k)
+
+    return recommend
+
+
+def lsh_recommender(features: np.ndarray, train: sp.csr_matrix, track_genres: sp.csr_matrix = None):
+    index = LSHIndex(features.shape[1])
+    index.add(np.arange(len(features)), features)
+
+    def recommend(seeds: list[np.ndarray], k: int) -> np.ndarray:
+        centres = np.stack([np.asarray(features[np.sort(query_seeds)]).mean(axis=0) for query_seeds in seeds])
+        ids, _ = index.query(centres, k + max(len(query_seeds) for query_seeds in seeds))
+        return exclude_seeds(np.where(ids == None, -1, ids).astype(np.int64), seeds, k)
+
+    return recommend
+
+
+def popularity_recommender(features: np.ndarray, train: sp.csr_matrix, track_genres: sp.csr_matrix = None):
+    # the tracks in the most training playlists, the same for every query
+    popular = np.argsort(-np.asarray(train.sum(axis=0)).ravel(), kind='stable')
+
+    def recommend(seeds: list[np.ndarray], k: int) -> np.ndarray:
+        rows = popular[:k + max(len(query_seeds) for query_seeds in seeds)]
+        return exclude_seeds(np.tile(rows, (len(seeds), 1)), seeds, k)
+
+    return recommend
+
+
+def hybrid_recommender(features: np.ndarray, train: sp.csr_matrix, track_genres: sp.csr_matrix = None):
+    # audio, co-occurrence and genre signals fused by hybrid.HybridRanker
+    ranker = HybridRanker(features, train, track_genres)
+
+    def recommend(seeds: list[np.ndarray], k: int) -> np.ndarray:
+        rows, _ = ranker.rank(seeds, k)
+        return rows
+
+    return recommend
+
+
+# name -> function(features, train membership, weighted track genres or None) returning
+# recommend(seeds, k), which returns a len(seeds) x k matrix of track rows (-1 padded)
+# without the seeds
+RECOMMENDERS = {
+    'centroid': centroid_recommender,
+    'lsh': lsh_recommender,
+    'popularity': popularity_recommender,
+    'hybrid': hybrid_recommender,
+}
+
+
+def weighted_track_genres(tracks_df, synthetic: bool = False) -> sp.csr_matrix:
+    # GenreEncoder.weighted rows of the tracks, None without artists.csv
+    if synthetic:
+        encoder = GenreEncoder(synthetic_artists(tracks_df))
+    elif os.path.exists(ARTISTS_PATH):
+        encoder = GenreEncoder.from_csv()
+    else:
+        return None
+    return encoder.weighted(encoder.encode(tracks_df['artists_ids']))
+
+
+def ranking_metrics(recommendations: np.ndarray, targets: sp.csr_matrix, n_tracks: int) -> dict[str, float]:
+    # recall@k, NDCG@k and catalogue coverage of all queries at once
+    n_queries, k = recommendations.shape
+    valid = recommendations >= 0
+    hits = np.zeros(recommendations.shape, dtype=bool)
+    query_rows = np.repeat(np.arange(n_queries), k)[valid.ravel()]
+    hits[valid] = np.asarray(targets[query_rows, recommendations[valid]]).ravel() > 0
+
+    n_targets = np.diff(targets.indptr)
+    discounts = 1 / np.log2(np.arange(k) + 2)
+    ideal = np.concatenate([[0], np.cumsum(discounts)])[np.minimum(n_targets, k)]
+    answered = n_targets > 0
+    return {
+        'recall': float((hits.sum(axis=1)[answered] / n_targets[answered]).mean()),
+        'ndcg': float(((hits * discounts).sum(axis=1)[answered] / ideal[answered]).mean()),
+        'coverage': float(len(np.unique(recommendations[valid])) / n_tracks),
+    }
+
+
+def evaluate(recommend, seeds: list[np.ndarray], targets: sp.csr_matrix, n_tracks: int, k_values: list[int] = K_VALUES, batch_size: int = 1) -> dict[str, float]:
+    # quality at every k from one run at the largest k, latency per batch of batch_size
+    # queries (1 for per-request latency) and the peak memory allocated while recommending
+    k = max(k_values)
+    latencies = []
+    batches = []
+    for start in range(0, len(seeds), batch_size):
+        batch_start = time.perf_counter()
+        batches.append(recommend(seeds[start:start + batch_size], k))
+        latencies.append(time.perf_counter() - batch_start)
+
+    # tracing slows every allocation down, so the peak memory comes from a separate run of
+    # the first batch instead of the timed one
+    tracemalloc.start()
+    recommend(seeds[:batch_size], k)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    recommendations = np.concatenate(batches)
+    latencies = np.array(latencies) * 1000
+    result = {}
+    for k in k_values:
+        result.update({f'{name}@{k}': value for name, value in ranking_metrics(recommendations[:, :k], targets, n_tracks).items()})
+    result.update({
+        'latency_p50_ms': float(np.percentile(latencies, 50)),
+        'latency_p95_ms': float(np.percentile(latencies, 95)),
+        'latency_p99_ms': float(np.percentile(latencies, 99)),
+        'queries_per_second': len(seeds) / (latencies.sum() / 1000),
+        'peak_memory_mb': peak / 2 ** 20,
+    })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate recommenders against held-out playlist co-membership.')
+    parser.add_argument('--dataset', default=DATASET_PATH)
+    parser.add_argument('--synthetic', type=int, help='use this many synthetic tracks and playlists instead of the dataset')
+    parser.add_argument('--playlists', default=CACHE_PATH, help='response cache directory (or cache.json) of the data collection')
+    parser.add_argument('--recommenders', nargs='+', choices=list(RECOMMENDERS), default=list(RECOMMENDERS))
+    parser.add_argument('--k', type=int, nargs='+', default=K_VALUES)
+    parser.add_argument('--test-share', type=float, default=0.2)
+    parser.add_argument('--holdout', type=float, default=0.5)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results as json to this file')
+    args = parser.parse_args()
+
+    tracks_df, features = load_dataset(args.dataset, args.synthetic, columns=['id', 'artists_ids'])
+    store = FeatureStore(os.path.dirname(features.filename))
+    track_genres = weighted_track_genres(tracks_df, bool(args.synthetic)) if 'hybrid' in args.recommenders else None
+    if args.synthetic:
+        playlists = synthetic_playlists(features, np.asarray(store.track_ids), seed=args.seed)
+    else:
+        playlists = load_playlists(args.playlists)
+    train, seeds, targets = split(membership_matrix(playlists, store), args.test_share, args.holdout, seed=args.seed)
+    print(f'{len(playlists)} playlists, {len(seeds)} held out queries, {targets.nnz} targets')
+
+    results = {}
+    for name in args.recommenders:
+        start = time.perf_counter()
+        recommend = RECOMMENDERS[name](features, train, track_genres)
+        print(f'{name}: built in {time.perf_counter() - start:.1f}s')
+        results[name] = evaluate(recommend, seeds, targets, len(store), args.k, args.batch_size)
+        print(f'{name}: ' + ', '.join(f'{metric}: {value:.4g}' for metric, value in results[name].items()))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
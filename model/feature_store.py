@@ -0,0 +1,162 @@
+import functools
+import hashlib
+import os
+import re
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+from features import DATASET_PATH, FEATURE_COLUMNS, load_tracks, synthetic_tracks
+from ids import decode, encode, encode_valid, search, sort_order
+from snapshots import SNAPSHOT_DIR, Snapshots
+
+FEATURE_STORE_DIR = 'feature_store'
+
+# part of the store directory name, bumped when the files of a store change
+STORE_LAYOUT = 2
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def frame_hash(tracks_df: pd.DataFrame) -> str:
+    hashes = pd.util.hash_pandas_object(tracks_df[['id'] + FEATURE_COLUMNS], index=False)
+    return hashlib.sha1(hashes.to_numpy().tobytes()).hexdigest()[:16]
+
+
+class FeatureStore:
+    """
+    The standardised float32 feature matrix of a dataset, written once to
+    feature_store/<content hash>/ and opened as a read-only memory map. Every process
+    opening the same store shares the pages of one copy through the OS page cache.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.features = np.load(os.path.join(directory, 'features.npy'), mmap_mode='r')
+        # track ids packed into two uint64 (see ids.py) per row
+        self.track_keys = np.load(os.path.join(directory, 'track_keys.npy'), mmap_mode='r')
+        with np.load(os.path.join(directory, 'scaler.npz')) as scaler:
+            self.mean = scaler['mean']
+            self.scale = scaler['scale']
+        # track keys sorted, with their rows, for vectorised id -> row lookups
+        self.sorted_keys = np.load(os.path.join(directory, 'sorted_keys.npy'), mmap_mode='r')
+        self.sorted_rows = np.load(os.path.join(directory, 'sorted_rows.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.track_keys)
+
+    @functools.cached_property
+    def track_ids(self) -> np.ndarray:
+        return decode(self.track_keys)
+
+    def rows(self, track_ids) -> np.ndarray:
+        # rows of the given track ids, -1 for ids that are not in the store
+        valid, keys = encode_valid(track_ids)
+        positions = search(self.sorted_keys, keys)
+        rows = np.full(len(valid), -1, dtype=np.int64)
+        rows[np.flatnonzero(valid)[positions >= 0]] = self.sorted_rows[positions[positions >= 0]]
+        return rows
+
+    def standardise(self, feature_rows) -> np.ndarray:
+        # raw FEATURE_COLUMNS rows (e.g. of newly crawled tracks) with the stored scaler
+        if isinstance(feature_rows, pd.DataFrame):
+            feature_rows = feature_rows[FEATURE_COLUMNS]
+        return ((np.asarray(feature_rows, dtype=np.float64) - self.mean) / self.scale).astype(np.float32)
+
+    @staticmethod
+    def build(tracks_df: pd.DataFrame, directory: str) -> 'FeatureStore':
+        # written to a temporary directory first, so readers never see a partial store
+        temporary = f'{directory}.{os.getpid()}.tmp'
+        os.makedirs(temporary, exist_ok=True)
+        scaler = StandardScaler().fit(tracks_df[FEATURE_COLUMNS].to_numpy(dtype=np.float64))
+        features = scaler.transform(tracks_df[FEATURE_COLUMNS].to_numpy(dtype=np.float64)).astype(np.float32)
+        track_keys = encode(tracks_df['id'].to_numpy(dtype=str))
+        order = sort_order(track_keys)
+
+        np.save(os.path.join(temporary, 'features.npy'), features)
+        np.save(os.path.join(temporary, 'track_keys.npy'), track_keys)
+        np.save(os.path.join(temporary, 'sorted_keys.npy'), track_keys[order])
+        np.save(os.path.join(temporary, 'sorted_rows.npy'), order)
+        np.savez(os.path.join(temporary, 'scaler.npz'), mean=scaler.mean_, scale=scaler.scale_)
+        try:
+            os.rename(temporary, directory)
+        except OSError:
+            # another process built the same store in the meantime
+            for filename in os.listdir(temporary):
+                os.remove(os.path.join(temporary, filename))
+            os.rmdir(temporary)
+        return FeatureStore(directory)
+
+    @staticmethod
+    def for_tracks(tracks_df: pd.DataFrame, store_dir: str = FEATURE_STORE_DIR) -> 'FeatureStore':
+        directory = os.path.join(store_dir, f'{frame_hash(tracks_df)}_{STORE_LAYOUT}')
+        if os.path.exists(directory):
+            return FeatureStore(directory)
+        print(f'Building feature store {directory}')
+        os.makedirs(store_dir, exist_ok=True)
+        return FeatureStore.build(tracks_df, directory)
+
+    @staticmethod
+    def for_dataset(path: str = DATASET_PATH, store_dir: str = FEATURE_STORE_DIR) -> 'FeatureStore':
+        # keyed by the hash of the csv, so it's only parsed if it changed
+        directory = os.path.join(store_dir, f'{file_hash(path)}_{STORE_LAYOUT}')
+        if os.path.exists(directory):
+            return FeatureStore(directory)
+        print(f'Building feature store {directory}')
+        os.makedirs(store_dir, exist_ok=True)
+        return FeatureStore.build(load_tracks(path), directory)
+
+
+def load_dataset(path: str = DATASET_PATH, synthetic: int = None, columns: list[str] = None, store_dir: str = FEATURE_STORE_DIR, snapshot=None, snapshot_dir: str = SNAPSHOT_DIR) -> tuple[pd.DataFrame, np.ndarray]:
+    # the tracks (only the given columns) and their standardised features from the store.
+    # snapshot reads a version ('latest' or a number) of the snapshots instead of the csv.
+    if synthetic:
+        tracks_df = synthetic_tracks(synthetic)
+        return tracks_df, FeatureStore.for_tracks(tracks_df, store_dir).features
+    if snapshot is not None:
+        tracks_df = Snapshots(snapshot_dir).tracks_with_features(snapshot)
+        store = FeatureStore.for_tracks(tracks_df, store_dir)
+        return tracks_df[columns] if columns is not None else tracks_df, store.features
+    store = FeatureStore.for_dataset(path, store_dir)
+    return load_tracks(path, columns), store.features
+
+
+def whole_matrix(features) -> bool:
+    # a memory map of a whole .npy file, not a slice, reversed, strided or reinterpreted
+    # view of it (those share the filename of the map they were taken from)
+    if not (isinstance(features, np.memmap) and features.filename and features.filename.endswith('.npy')):
+        return False
+    root = features
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    if features.ctypes.data != root.ctypes.data:
+        return False
+    whole = np.load(features.filename, mmap_mode='r')
+    return whole.shape == features.shape and whole.dtype == features.dtype and whole.strides == features.strides
+
+
+def shareable(features: np.ndarray):
+    # what to send to worker processes: the .npy path for a whole memory-mapped store
+    # matrix (workers map the same pages), the array itself otherwise
+    return features.filename if whole_matrix(features) else features
+
+
+def store_key(features: np.ndarray) -> str:
+    # the directory name of the feature store a whole store matrix belongs to, which is a
+    # content hash of its tracks, None for any other array
+    if not whole_matrix(features):
+        return None
+    name = os.path.basename(os.path.dirname(features.filename))
+    if re.fullmatch(rf'[0-9a-f]{{16}}_{STORE_LAYOUT}', name) is None:
+        # built into a directory of another name (FeatureStore.build), not content-addressed
+        return None
+    return name
+
+
+def materialise(features) -> np.ndarray:
+    return np.load(features, mmap_mode='r') if isinstance(features, str) else features
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+
+DATASET_PATH = '../data-collection/tracks_with_features_demo.csv'
+
+# numeric columns produced by features_list_to_dataframe in data-collection/script.py
+FEATURE_COLUMNS = [
+    'danceability',
+    'energy',
+    'key',
+    'loudness',
+    'mode',
+    'speechiness',
+    'acousticness',
+    'instrumentalness',
+    'liveness',
+    'valence',
+    'tempo',
+    'time_signature',
+]
+
+
+def load_tracks(path: str = DATASET_PATH, columns: list[str] = None) -> pd.DataFrame:
+    return pd.read_csv(path, usecols=columns)
+
+
+def feature_matrix(tracks_df: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+    scaler = StandardScaler()
+    features = scaler.fit_transform(tracks_df[FEATURE_COLUMNS].to_numpy(dtype=np.float64))
+    return tracks_df['id'].to_numpy(dtype=object), features.astype(np.float32)
+
+
+def load_feature_matrix(path: str = DATASET_PATH) -> tuple[np.ndarray, np.ndarray]:
+    return feature_matrix(load_tracks(path))
+
+
+def synthetic_tracks(n_tracks: int, seed: int = 0) -> pd.DataFrame:
+    # a gaussian mixture roughly shaped like the standardised audio features, where
+    # every artist (and album) sticks to a few mixture components. used for
+    # benchmarking without the dataset. ids are valid 22 digit base62 spotify ids.
+    rng = np.random.default_rng(seed)
+    n_centers = max(2, n_tracks // 2000)
+    n_artists = max(1, n_tracks // 10)
+    centers = rng.normal(scale=1.5, size=(n_centers, len(FEATURE_COLUMNS)))
+    artists = rng.integers(0, n_artists, n_tracks)
+    albums = artists * 4 + rng.integers(0, 4, n_tracks)
+    assignment = (albums * 7919 + rng.integers(0, 2, n_tracks)) % n_centers
+    features = centers[assignment] + rng.normal(scale=0.15, size=(n_tracks, len(FEATURE_COLUMNS)))
+
+    tracks_df = pd.DataFrame(data={
+        'id': [f'0synthetic{i:012d}' for i in range(n_tracks)],
+        'name': [f'Track {i}' for i in range(n_tracks)],
+        'artists_ids': [f'0artist{artist:015d}' for artist in artists],
+        'album': [f'Album {album}' for album in albums],
+    })
+    for i, column in enumerate(FEATURE_COLUMNS):
+        tracks_df[column] = features[:, i]
+    return tracks_df
+
+
+def synthetic_feature_matrix(n_tracks: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    return feature_matrix(synthetic_tracks(n_tracks, seed))
@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.metrics import pairwise_distances_argmin
+from features import DATASET_PATH, FEATURE_COLUMNS, load_tracks
+from ids import IdCatalogue, explode, first_occurrences
+
+ARTISTS_PATH = '../data-collection/artists.csv'
+
+
+def split_column(values: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    # '/'-joined strings as (row, item) pairs, empty and missing values have no items
+    items = values.fillna('').astype(str).str.split('/').explode()
+    items = items[items != '']
+    return items.index.to_numpy(dtype=np.int64), items.to_numpy(dtype=str)
+
+
+def synthetic_artists(tracks_df: pd.DataFrame, n_genres: int = 200, seed: int = 0) -> pd.DataFrame:
+    # artists.csv rows for the artists of synthetic_tracks: the genre closest to the mean
+    # features of an artist's tracks, plus a random second genre for half of them, so
+    # genres agree with the audio features about as loosely as real ones
+    rng = np.random.default_rng(seed)
+    artist_means = tracks_df.groupby('artists_ids')[FEATURE_COLUMNS].mean()
+    centres = artist_means.to_numpy()[rng.choice(len(artist_means), min(n_genres, len(artist_means)), replace=False)]
+    closest = pairwise_distances_argmin(artist_means.to_numpy(), centres)
+    second = np.where(rng.random(len(artist_means)) < 0.5, rng.integers(0, len(centres), len(artist_means)), closest)
+    return pd.DataFrame({
+        'artist_id': artist_means.index,
+        'name': [f'Artist {i}' for i in range(len(artist_means))],
+        'genres': [f'genre {a}' if a == b else f'genre {a}/genre {b}' for a, b in zip(closest, second)],
+    })
+
+
+class GenreEncoder:
+    """
+    Interned genre vocabulary of artists.csv and the artist x genre multi-hot matrix, so
+    track genres are encoded as sparse rows once instead of splitting '/'-joined strings
+    every time they are used.
+    """
+
+    def __init__(self, artists_df: pd.DataFrame):
+        artists_df = artists_df[first_occurrences(artists_df['artist_id'])].reset_index(drop=True)
+        rows, genres = split_column(artists_df['genres'])
+        self.genres, genre_codes = np.unique(genres, return_inverse=True)
+        self.genre_index = {genre: code for code, genre in enumerate(self.genres.tolist())}
+
+        # interned artist ids, the code of an artist is its row in artist_genres
+        self.artists = IdCatalogue(artists_df['artist_id'])
+        self.artist_genres = sp.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, genre_codes)),
+            shape=(len(self.artists), len(self.genres)),
+        )
+        self.artist_genres.sum_duplicates()
+        self.artist_genres.data[:] = 1
+
+        # inverse document frequency of every genre over the artists, rare genres say more
+        # about a track than 'pop' does
+        self.idf = np.log((1 + len(self.artists)) / (1 + np.bincount(self.artist_genres.indices, minlength=len(self.genres)))).astype(np.float32) + 1
+
+    @staticmethod
+    def from_csv(path: str = ARTISTS_PATH) -> 'GenreEncoder':
+        return GenreEncoder(pd.read_csv(path, usecols=['artist_id', 'genres']))
+
+    def encode(self, artists_ids: pd.Series) -> sp.csr_matrix:
+        # track x genre matrix from the '/'-joined artists_ids column of a tracks dataframe.
+        # an entry counts how many of the track's artists have the genre.
+        tracks, artist_keys = explode(artists_ids)
+        rows = self.artists.lookup(artist_keys)
+        known = rows >= 0
+        track_artists = sp.csr_matrix(
+            (np.ones(known.sum(), dtype=np.float32), (tracks[known], rows[known])),
+            shape=(len(artists_ids), len(self.artists)),
+        )
+        return (track_artists @ self.artist_genres).tocsr()
+
+    def codes(self, genres: list[str]) -> np.ndarray:
+        unknown = [genre for genre in genres if genre not in self.genre_index]
+        if unknown:
+            raise KeyError(f'unknown genres {unknown}')
+        return np.array([self.genre_index[genre] for genre in genres], dtype=np.int64)
+
+    def mask(self, track_genres: sp.csr_matrix, genres: list[str], require_all: bool = False) -> np.ndarray:
+        # boolean mask of the tracks that have any (or all) of the given genres
+        matches = np.asarray((track_genres[:, self.codes(genres)] > 0).sum(axis=1)).ravel()
+        return matches == len(genres) if require_all else matches > 0
+
+    def weighted(self, track_genres: sp.csr_matrix) -> sp.csr_matrix:
+        # binary rows weighted by idf and scaled to unit length, so the dot product of two
+        # rows is their genre cosine similarity
+        weighted = track_genres.copy()
+        weighted.data[:] = 1
+        weighted = (weighted @ sp.diags(self.idf)).tocsr()
+        norms = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+        return (sp.diags(1 / np.maximum(norms, np.finfo(np.float32).tiny)) @ weighted).tocsr()
+
+    def similarity(self, track_genres: sp.csr_matrix, rows: np.ndarray, weighted: sp.csr_matrix = None) -> sp.csr_matrix:
+        # idf-weighted genre cosine similarity of the tracks in rows to every track, sparse
+        # since tracks that share no genre have a similarity of 0. pass weighted (from
+        # self.weighted) to reuse it across calls.
+        if weighted is None:
+            weighted = self.weighted(track_genres)
+        return (weighted[rows] @ weighted.T).tocsr()
+
+
+def main():
+    encoder = GenreEncoder.from_csv()
+    tracks_df = load_tracks(DATASET_PATH, ['id', 'artists_ids'])
+    track_genres = encoder.encode(tracks_df['artists_ids'])
+    print(f'{len(encoder.genres)} genres of {len(encoder.artists)} artists, {track_genres.nnz} track genres of {len(tracks_df)} tracks')
+    top = np.argsort(-np.asarray((track_genres > 0).sum(axis=0)).ravel())[:10]
+    for code in top:
+        print(f'{encoder.genres[code]}: {encoder.mask(track_genres, [encoder.genres[code]]).sum()} tracks')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import numpy as np
+import scipy.sparse as sp
+from nearest_neighbours import ExactIndex
+
+# in the order they are scored: the genre signal is the most expensive to gather, so it
+# is only computed for the candidates that can still make the top k
+SIGNALS = ['audio', 'cooccurrence', 'genre']
+
+DEFAULT_WEIGHTS = {
+    'audio': 1.0,
+    'cooccurrence': 1.0,
+    'genre': 0.5,
+}
+
+
+def top_per_row(matrix: sp.csr_matrix, n: int) -> np.ndarray:
+    # columns of the n largest entries of every row of a sparse matrix, as a rows x n
+    # matrix padded with -1
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    order = np.lexsort((-matrix.data, rows))
+    rank = np.arange(len(order)) - matrix.indptr[rows[order]]
+    kept = rank < n
+    result = np.full((matrix.shape[0], n), -1, dtype=np.int64)
+    result[rows[order][kept], rank[kept]] = matrix.indices[order][kept]
+    return result
+
+
+def unique_per_row(candidates: np.ndarray) -> np.ndarray:
+    # every row sorted with repeated entries replaced by -1
+    candidates = np.sort(candidates, axis=1)
+    candidates[:, 1:][candidates[:, 1:] == candidates[:, :-1]] = -1
+    return candidates
+
+
+def gather(matrix: sp.csr_matrix, rows: np.ndarray, columns: np.ndarray) -> np.ndarray:
+    # matrix[rows[i], columns[i]] for all i as a flat array
+    return np.asarray(matrix[rows, columns]).ravel() if len(rows) else np.empty(0, dtype=matrix.dtype)
+
+
+def scale_rows(scores: np.ndarray) -> np.ndarray:
+    # every row divided by its maximum, so each signal ranges over [0, 1] per query
+    maximum = scores.max(axis=1, initial=0, keepdims=True)
+    return scores / np.where(maximum > 0, maximum, 1)
+
+
+class HybridRanker:
+    """
+    Ranks tracks for batches of seed sets by a weighted sum of several signals: audio
+    feature similarity to the seed centroid, playlist co-occurrence with the seeds and
+    idf-weighted genre similarity (track_genres from GenreEncoder.weighted). Candidates
+    come from the feature index and the co-occurrence counts only, and every signal is
+    gathered for them as an aligned queries x candidates array, so no signal scans the
+    whole catalogue per query.
+    """
+
+    def __init__(self, features: np.ndarray, membership: sp.csr_matrix = None, track_genres: sp.csr_matrix = None, weights: dict[str, float] = None, n_candidates: int = 200, index=None):
+        self.features = features
+        if index is None:
+            index = ExactIndex()
+            index.add(np.arange(len(features)), features)
+        self.index = index
+        self.membership = membership.tocsr() if membership is not None else None
+        self.track_playlists = membership.T.tocsr() if membership is not None else None
+        self.track_genres = track_genres.tocsr() if track_genres is not None else None
+        self.n_candidates = n_candidates
+
+        # signals without data have no weight
+        weights = DEFAULT_WEIGHTS if weights is None else weights
+        self.weights = {signal: float(weights.get(signal, 0)) for signal in SIGNALS}
+        if membership is None:
+            self.weights['cooccurrence'] = 0
+        if track_genres is None:
+            self.weights['genre'] = 0
+
+    def seed_matrix(self, seeds: list[np.ndarray]) -> sp.csr_matrix:
+        # query x track matrix, row i is the mean over the seeds of query i
+        lengths = np.array([len(query_seeds) for query_seeds in seeds], dtype=np.int64)
+        queries = np.repeat(np.arange(len(seeds)), lengths)
+        matrix = sp.csr_matrix(((1 / lengths[queries]).astype(np.float32), (queries, np.concatenate(seeds).astype(np.int64))), shape=(len(seeds), len(self.features)))
+        matrix.sum_duplicates()
+        return matrix
+
+    def rank(self, seeds: list[np.ndarray], k: int) -> tuple[np.ndarray, np.ndarray]:
+        # the k best tracks of every seed set without the seeds, as len(seeds) x k matrices
+        # of rows (-1 padded) and fused scores
+        seed_matrix = self.seed_matrix(seeds)
+        centres = np.asarray(seed_matrix @ self.features, dtype=np.float32)
+        n_candidates = self.n_candidates + max(len(query_seeds) for query_seeds in seeds)
+
+        # candidates of all queries from the cheap signals, one row per query
+        audio_rows, _ = self.index.query(centres, n_candidates)
+        candidates = [np.where(audio_rows == None, -1, audio_rows).astype(np.int64)]
+        if self.weights['cooccurrence'] > 0:
+            cooccurrence = (seed_matrix @ self.track_playlists @ self.membership).tocsr()
+            candidates.append(top_per_row(cooccurrence, n_candidates))
+        candidates = unique_per_row(np.concatenate(candidates, axis=1))
+
+        queries = np.repeat(np.arange(len(seeds)), candidates.shape[1]).reshape(candidates.shape)
+        valid = candidates >= 0
+        valid[valid] = gather(seed_matrix, queries[valid], candidates[valid]) == 0
+        query_rows, candidate_rows = queries[valid], candidates[valid]
+
+        # aligned queries x candidates scores, fused as they are gathered
+        fused = np.full(candidates.shape, -np.inf, dtype=np.float32)
+        fused[valid] = 0
+        if self.weights['audio'] > 0:
+            audio = np.zeros(candidates.shape, dtype=np.float32)
+            distances = np.linalg.norm(np.asarray(self.features[candidate_rows]) - centres[query_rows], axis=1)
+            audio[valid] = 1 / (1 + distances)
+            fused += self.weights['audio'] * scale_rows(audio)
+        if self.weights['cooccurrence'] > 0:
+            counts = np.zeros(candidates.shape, dtype=np.float32)
+            counts[valid] = gather(cooccurrence, query_rows, candidate_rows)
+            fused += self.weights['cooccurrence'] * scale_rows(counts)
+
+        if self.weights['genre'] > 0:
+            # genre similarity is at most 1, so candidates whose score plus the genre
+            # weight stays below the k-th best score so far can't make the top k
+            kth = -np.partition(-fused, min(k, fused.shape[1]) - 1, axis=1)[:, min(k, fused.shape[1]) - 1]
+            alive = valid & (fused + self.weights['genre'] >= kth[:, None])
+            profiles = seed_matrix @ self.track_genres
+            norms = np.sqrt(np.asarray(profiles.multiply(profiles).sum(axis=1)).ravel())
+            profiles = (sp.diags(1 / np.maximum(norms, np.finfo(np.float32).tiny)) @ profiles).tocsr()
+            alive_queries, alive_rows = queries[alive], candidates[alive]
+            similarity = np.asarray(profiles[alive_queries].multiply(self.track_genres[alive_rows]).sum(axis=1)).ravel()
+            fused[valid & ~alive] = -np.inf
+            fused[alive] += self.weights['genre'] * similarity
+
+        top = np.argsort(-fused, axis=1, kind='stable')[:, :k]
+        scores = np.take_along_axis(fused, top, axis=1)
+        rows = np.where(np.isfinite(scores), np.take_along_axis(candidates, top, axis=1), -1)
+        result_rows = np.full((len(seeds), k), -1, dtype=np.int64)
+        result_scores = np.full((len(seeds), k), -np.inf, dtype=np.float32)
+        result_rows[:, :rows.shape[1]] = rows
+        result_scores[:, :rows.shape[1]] = scores
+        return result_rows, result_scores
@@ -0,0 +1,205 @@
+import numpy as np
+import pandas as pd
+
+# spotify ids are 128 bit numbers written as 22 base62 digits
+ALPHABET = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+ID_LENGTH = 22
+
+# an id packed into two uint64, 16 bytes instead of 88 for a numpy unicode string
+KEY_DTYPE = np.dtype([('hi', '<u8'), ('lo', '<u8')])
+
+# character code -> base62 digit, 255 for characters outside the alphabet
+DIGITS = np.full(256, 255, dtype=np.uint8)
+DIGITS[np.frombuffer(ALPHABET.encode(), dtype=np.uint8)] = np.arange(62, dtype=np.uint8)
+
+MASK_32 = np.uint64(0xFFFFFFFF)
+SHIFT_32 = np.uint64(32)
+
+# digits are packed GROUP digits at a time, 62^5 < 2^30 keeps every step within uint64
+GROUP = 5
+GROUP_BASE = np.uint64(62 ** GROUP)
+
+# digits of 2^128 - 1, the largest id
+MAX_DIGITS = DIGITS[np.frombuffer(b'7N42dgm5tFLK9N8MT7fHC7', dtype=np.uint8)]
+
+
+def digit_matrix(ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # which strings are packable spotify ids, and the base62 digits of those
+    valid = np.char.str_len(ids) == ID_LENGTH
+    # the UCS4 code points of the strings, without converting them to bytes first
+    characters = ids[valid].astype(f'U{ID_LENGTH}').view(np.uint32).reshape(valid.sum(), ID_LENGTH)
+    digits = DIGITS[np.minimum(characters, 255)]
+    # compared digit by digit with the largest id, the first differing digit decides
+    differs = digits != MAX_DIGITS
+    first = differs.argmax(axis=1)
+    fits = ~differs.any(axis=1) | (digits[np.arange(len(digits)), first] < MAX_DIGITS[first])
+    packable = (digits != 255).all(axis=1) & fits
+    valid[valid] = packable
+    return valid, digits[packable]
+
+
+def pack(digits: np.ndarray) -> np.ndarray:
+    # the number is held as four 32 bit limbs and multiplied by 62^GROUP per group
+    limbs = np.zeros((4, len(digits)), dtype=np.uint64)
+    for start in range(0, ID_LENGTH, GROUP):
+        group = digits[:, start:start + GROUP]
+        carry = np.zeros(len(digits), dtype=np.uint64)
+        for column in range(group.shape[1]):
+            carry = carry * np.uint64(62) + group[:, column].astype(np.uint64)
+        base = np.uint64(62 ** group.shape[1])
+        for limb in range(4):
+            value = limbs[limb] * base + carry
+            limbs[limb] = value & MASK_32
+            carry = value >> SHIFT_32
+
+    keys = np.empty(len(digits), dtype=KEY_DTYPE)
+    keys['hi'] = (limbs[3] << SHIFT_32) | limbs[2]
+    keys['lo'] = (limbs[1] << SHIFT_32) | limbs[0]
+    return keys
+
+
+def is_valid(ids) -> np.ndarray:
+    return digit_matrix(np.asarray(ids, dtype=str).ravel())[0]
+
+
+def encode(ids) -> np.ndarray:
+    # base62 ids -> KEY_DTYPE keys
+    valid, digits = digit_matrix(np.asarray(ids, dtype=str).ravel())
+    if not valid.all():
+        raise ValueError(f'not a spotify id (22 base62 digits): {np.asarray(ids, dtype=str).ravel()[~valid][0]}')
+    return pack(digits)
+
+
+def encode_valid(ids) -> tuple[np.ndarray, np.ndarray]:
+    # mask of the strings that are spotify ids and the keys of those, for input that may
+    # contain other values
+    valid, digits = digit_matrix(np.asarray(ids, dtype=str).ravel())
+    return valid, pack(digits)
+
+
+def decode(keys: np.ndarray) -> np.ndarray:
+    # KEY_DTYPE keys -> base62 id strings, by repeated long division of the limbs by 62^GROUP
+    keys = np.asarray(keys, dtype=KEY_DTYPE).ravel()
+    limbs = np.stack([keys['lo'] & MASK_32, keys['lo'] >> SHIFT_32, keys['hi'] & MASK_32, keys['hi'] >> SHIFT_32])
+    alphabet = np.frombuffer(ALPHABET.encode(), dtype=np.uint8)
+    characters = np.empty((len(keys), ID_LENGTH), dtype=np.uint8)
+    for end in range(ID_LENGTH, 0, -GROUP):
+        width = min(GROUP, end)
+        base = np.uint64(62 ** width)
+        remainder = np.zeros(len(keys), dtype=np.uint64)
+        for limb in range(3, -1, -1):
+            value = (remainder << SHIFT_32) | limbs[limb]
+            limbs[limb] = value // base
+            remainder = value % base
+        for column in range(end - 1, end - width - 1, -1):
+            characters[:, column] = alphabet[(remainder % np.uint64(62)).astype(np.int64)]
+            remainder //= np.uint64(62)
+    return characters.view(f'S{ID_LENGTH}').ravel().astype(str)
+
+
+def sort_order(keys: np.ndarray) -> np.ndarray:
+    # argsort of keys, lexsort on the two uint64 is much faster than sorting the records
+    return np.lexsort((keys['lo'], keys['hi']))
+
+
+def search(sorted_keys: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    # positions of keys in sorted_keys, -1 for keys that are not in it. searches the high
+    # words, which are practically unique, and compares the low words.
+    sorted_hi = np.ascontiguousarray(sorted_keys['hi'])
+    left = np.searchsorted(sorted_hi, keys['hi'], side='left')
+    right = np.searchsorted(sorted_hi, keys['hi'], side='right')
+    positions = np.full(len(keys), -1, dtype=np.int64)
+    single = np.flatnonzero(right - left == 1)
+    found = sorted_keys['lo'][left[single]] == keys['lo'][single]
+    positions[single[found]] = left[single[found]]
+    for i in np.flatnonzero(right - left > 1):
+        position = left[i] + np.searchsorted(sorted_keys['lo'][left[i]:right[i]], keys['lo'][i])
+        if position < right[i] and sorted_keys['lo'][position] == keys['lo'][i]:
+            positions[i] = position
+    return positions
+
+
+def explode(joined: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    # '/'-joined id columns (like artists_ids) as (row position, key) pairs, anything
+    # that is not a spotify id is skipped
+    items = joined.reset_index(drop=True).fillna('').astype(str).str.split('/').explode()
+    valid, keys = encode_valid(items.to_numpy(dtype=str))
+    return items.index.to_numpy(dtype=np.int64)[valid], keys
+
+
+def first_occurrences(ids, packed: bool = False) -> np.ndarray:
+    # mask of the first occurrence of every id, like ~pd.Series.duplicated() on the
+    # strings. packed=True for KEY_DTYPE keys. values that are not spotify ids (e.g. the
+    # missing ids of local tracks) are compared as strings.
+    if packed:
+        valid, keys = np.ones(len(ids), dtype=bool), ids
+    else:
+        valid, keys = encode_valid(ids)
+    order = sort_order(keys)
+    sorted_keys = keys[order]
+    starts = np.ones(len(keys), dtype=bool)
+    starts[1:] = (sorted_keys['hi'][1:] != sorted_keys['hi'][:-1]) | (sorted_keys['lo'][1:] != sorted_keys['lo'][:-1])
+    mask = np.zeros(len(valid), dtype=bool)
+    mask[np.flatnonzero(valid)[order[starts]]] = True
+    if not valid.all():
+        others = pd.Series(np.asarray(ids, dtype=object).ravel()[~valid])
+        mask[~valid] = ~others.duplicated().to_numpy()
+    return mask
+
+
+class IdCatalogue:
+    """
+    Dense int32 codes for spotify ids, in the order they were first interned, with the
+    packed keys sorted alongside for vectorised id -> code lookups. Reversible:
+    ids(codes) decodes the keys back to strings.
+    """
+
+    def __init__(self, ids=None):
+        self.keys = np.empty(0, dtype=KEY_DTYPE)
+        self.sorted_keys = np.empty(0, dtype=KEY_DTYPE)
+        self.sorted_codes = np.empty(0, dtype=np.int32)
+        if ids is not None:
+            self.intern(ids)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        positions = search(self.sorted_keys, keys)
+        codes = np.full(len(keys), -1, dtype=np.int32)
+        codes[positions >= 0] = self.sorted_codes[positions[positions >= 0]]
+        return codes
+
+    def codes(self, ids) -> np.ndarray:
+        # codes of the given ids, -1 for ids that were never interned
+        return self.lookup(encode(ids))
+
+    @staticmethod
+    def from_keys(keys: np.ndarray) -> 'IdCatalogue':
+        # catalogue of unique KEY_DTYPE keys, e.g. catalogue.keys saved earlier, without
+        # decoding them to strings
+        catalogue = IdCatalogue()
+        catalogue.intern_keys(keys)
+        return catalogue
+
+    def intern(self, ids) -> np.ndarray:
+        # codes of the given ids, unseen ids get the next free codes
+        return self.intern_keys(encode(ids))
+
+    def intern_keys(self, keys: np.ndarray) -> np.ndarray:
+        codes = self.lookup(keys)
+        new_keys = keys[codes < 0]
+        # new ids are numbered in the order they first appear in ids
+        new_keys = new_keys[np.sort(first_occurrences(new_keys, packed=True).nonzero()[0])]
+        new_codes = np.arange(len(self), len(self) + len(new_keys), dtype=np.int32)
+        self.keys = np.concatenate([self.keys, new_keys])
+
+        self.sorted_keys = np.concatenate([self.sorted_keys, new_keys])
+        self.sorted_codes = np.concatenate([self.sorted_codes, new_codes])
+        order = sort_order(self.sorted_keys)
+        self.sorted_keys = self.sorted_keys[order]
+        self.sorted_codes = self.sorted_codes[order]
+        return np.where(codes < 0, self.lookup(keys), codes)
+
+    def ids(self, codes) -> np.ndarray:
+        return decode(self.keys[np.asarray(codes)])
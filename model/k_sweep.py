@@ -0,0 +1,151 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from feature_store import FeatureStore, load_dataset
+from features import DATASET_PATH, load_tracks, synthetic_tracks
+from memo import memoise
+from metrics import GROUP_COLUMNS, album_codes, artist_codes, densities, score
+
+PROGRESS_PATH = 'progress.txt'
+
+# set by init_worker in every worker process, so the dataset is loaded once per worker
+worker_state = {}
+
+
+def read_progress(filename: str) -> dict[int, list[float]]:
+    # progress.txt lines are k,score,artist_density,album_density,score_error. the error
+    # (half width of the sampled score's confidence interval) is missing in older files.
+    progress = {}
+    try:
+        with open(filename, 'r') as file:
+            for line in file:
+                if line.strip():
+                    values = line.strip().split(',')
+                    progress[int(values[0])] = [float(value) for value in values[1:]]
+    except FileNotFoundError:
+        pass
+    return progress
+
+
+def format_progress_line(k: int, values: list[float]) -> str:
+    return ','.join([str(k)] + [str(value) for value in values])
+
+
+def warm_start(features: np.ndarray, centroids: np.ndarray, rng: np.random.Generator, sample_size: int = 10_000) -> np.ndarray:
+    # the centroids of k-1 plus one new centroid, drawn like a k-means++ step (with
+    # probability proportional to the squared distance to the nearest centroid) from a
+    # sample of the tracks. if every sampled track sits on a centroid (duplicate tracks,
+    # k close to the number of distinct tracks) it is drawn uniformly.
+    sample = features[np.sort(rng.choice(len(features), min(sample_size, len(features)), replace=False))]
+    squared_distances = ((sample[:, np.newaxis, :] - centroids[np.newaxis]) ** 2).sum(axis=2).min(axis=1)
+    total = squared_distances.sum()
+    new_centroid = sample[rng.choice(len(sample), p=squared_distances / total if total > 0 else None)]
+    return np.vstack([centroids, new_centroid])
+
+
+@memoise
+def fit(features: np.ndarray, k: int, init, minibatch: bool, batch_size: int = 4096, epochs: int = 3, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    if not minibatch:
+        model = KMeans(n_clusters=k, init=init, n_init=1, random_state=seed).fit(features)
+        return model.cluster_centers_, model.labels_
+
+    # streaming variant: features are only ever read batch_size rows at a time, so the
+    # memory-mapped store matrix can be larger than RAM
+    model = MiniBatchKMeans(n_clusters=k, init=init, n_init=1, batch_size=batch_size, random_state=seed)
+    for _ in range(epochs):
+        for start in range(0, len(features), batch_size):
+            model.partial_fit(np.asarray(features[start:start + batch_size]))
+    labels = np.concatenate([model.predict(np.asarray(features[start:start + batch_size])) for start in range(0, len(features), batch_size)])
+    return model.cluster_centers_, labels
+
+
+def init_worker(dataset: str, synthetic: int, store_directory: str, minibatch: bool, sample_size: int):
+    # features are memory-mapped from the store, all workers share one copy
+    tracks_df = synthetic_tracks(synthetic) if synthetic else load_tracks(dataset, GROUP_COLUMNS)
+    worker_state.update(
+        features=FeatureStore(store_directory).features,
+        artist_codes=artist_codes(tracks_df),
+        album_codes=album_codes(tracks_df),
+        minibatch=minibatch,
+        sample_size=sample_size,
+    )
+
+
+def run_segment(ks: list[int]) -> list[tuple[int, list[float]]]:
+    # consecutive k values, each warm started from the centroids of the one before.
+    # the first k of a segment starts from k-means++.
+    features = worker_state['features']
+    rng = np.random.default_rng(ks[0])
+    results = []
+    centroids = None
+    for k in ks:
+        start = time.perf_counter()
+        init = 'k-means++' if centroids is None else warm_start(features, centroids, rng)
+        centroids, labels = fit(features, k, init, worker_state['minibatch'])
+        value, error = score(features, labels, sample_size=worker_state['sample_size'])
+        values = [
+            value,
+            densities(*worker_state['artist_codes'], labels)[0],
+            densities(*worker_state['album_codes'], labels)[0],
+            error,
+        ]
+        print(f'k: {k} took {time.perf_counter() - start:.1f}s')
+        results.append((k, values))
+    return results
+
+
+def segments(ks: list[int], segment_size: int) -> list[list[int]]:
+    # runs of consecutive pending k values, split into segments of at most segment_size
+    runs = []
+    for k in ks:
+        if runs and runs[-1][-1] == k - 1 and len(runs[-1]) < segment_size:
+            runs[-1].append(k)
+        else:
+            runs.append([k])
+    return runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Warm-started, parallel k-means sweep writing progress.txt rows.')
+    parser.add_argument('--dataset', default=DATASET_PATH)
+    parser.add_argument('--synthetic', type=int, help='use this many synthetic tracks instead of the dataset')
+    parser.add_argument('--k-min', type=int, default=2)
+    parser.add_argument('--k-max', type=int, default=55)
+    parser.add_argument('--minibatch', action='store_true', help='fit with MiniBatchKMeans, streaming over the features')
+    parser.add_argument('--sample-size', type=int, help='estimate the score from a stratified sample of this many tracks')
+    parser.add_argument('--segment-size', type=int, default=4, help='number of consecutive k values a worker warm starts through')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--output', default=PROGRESS_PATH)
+    args = parser.parse_args()
+
+    progress = read_progress(args.output)
+    pending = [k for k in range(args.k_min, args.k_max + 1) if k not in progress]
+    print(f'{len(pending)} k values pending')
+    if not pending:
+        return
+
+    start = time.perf_counter()
+    _, features = load_dataset(args.dataset, args.synthetic, columns=GROUP_COLUMNS)
+    initargs = (args.dataset, args.synthetic, os.path.dirname(features.filename), args.minibatch, args.sample_size)
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=initargs) as executor:
+        futures = [executor.submit(run_segment, segment) for segment in segments(pending, args.segment_size)]
+        # every finished segment is appended right away, so the sweep can be resumed
+        with open(args.output, 'a') as file:
+            for future in as_completed(futures):
+                for k, values in future.result():
+                    progress[k] = values
+                    file.write(format_progress_line(k, values) + '\n')
+                file.flush()
+
+    # segments finish out of order, leave the file sorted by k
+    with open(args.output, 'w') as file:
+        for k in sorted(progress):
+            file.write(format_progress_line(k, progress[k]) + '\n')
+    print(f'sweep took {time.perf_counter() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from feature_store import store_key
+
+MEMO_DIR = 'memo_cache'
+
+# least recently used results are evicted once the cache grows beyond this
+MEMO_MAX_BYTES = 2 * 2 ** 30
+
+
+def update_fingerprint(digest, value):
+    if isinstance(value, np.ndarray):
+        key = store_key(value)
+        if key is not None:
+            # a whole feature store matrix, whose directory name is already a content hash
+            digest.update(f'feature_store:{key}:{value.dtype}:{value.shape}:{value.strides}'.encode())
+        else:
+            digest.update(f'ndarray:{value.dtype}:{value.shape}:'.encode())
+            digest.update(np.ascontiguousarray(value).tobytes())
+    elif sp.issparse(value):
+        value = value.tocsr()
+        digest.update(f'sparse:{value.shape}:'.encode())
+        for part in (value.data, value.indices, value.indptr):
+            update_fingerprint(digest, part)
+    elif isinstance(value, (pd.DataFrame, pd.Series)):
+        digest.update(f'pandas:{list(value.columns) if isinstance(value, pd.DataFrame) else value.name}:'.encode())
+        digest.update(pd.util.hash_pandas_object(value).to_numpy().tobytes())
+    elif isinstance(value, (list, tuple)):
+        digest.update(f'{type(value).__name__}:{len(value)}:'.encode())
+        for item in value:
+            update_fingerprint(digest, item)
+    elif isinstance(value, dict):
+        digest.update(f'dict:{len(value)}:'.encode())
+        for key in sorted(value, key=repr):
+            update_fingerprint(digest, key)
+            update_fingerprint(digest, value[key])
+    else:
+        digest.update(f'{type(value).__name__}:{value!r}:'.encode())
+
+
+def fingerprint(*values) -> str:
+    digest = hashlib.sha1()
+    for value in values:
+        update_fingerprint(digest, value)
+    return digest.hexdigest()
+
+
+class Memo:
+    """
+    Disk cache for the results of expensive modelling steps (fits, scores, embeddings),
+    keyed by a hash of the function and all of its arguments, so every step runs once
+    per unique input. Results are pickled to one file each and evicted least recently
+    used first once the cache exceeds max_bytes.
+
+    Bump version when the implementation of a memoised function changes its results.
+    Arguments named in ignore are left out of the key, for inputs that follow from the
+    others (e.g. a precomputed graph of the features).
+    """
+
+    def __init__(self, directory: str = MEMO_DIR, max_bytes: int = MEMO_MAX_BYTES, enabled: bool = True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        # running total of the cache size, read from disk on the first store and again
+        # whenever it exceeds max_bytes (other processes may have written or evicted)
+        self.size = None
+
+    def __call__(self, function=None, version: int = 0, ignore: tuple = ()):
+        # usable as @memoise and as @memoise(version=2, ignore=['graph'])
+        if function is None:
+            return functools.partial(self, version=version, ignore=tuple(ignore))
+
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return function(*args, **kwargs)
+
+            # keyed by the bound arguments, so f(x, 1) and f(x, k=1) share a result
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            keyed = {name: value for name, value in arguments.arguments.items() if name not in ignore}
+            key = fingerprint(function.__module__, function.__qualname__, version, keyed)
+            filename = os.path.join(self.directory, key[:2], f'{key}.pickle')
+            try:
+                with open(filename, 'rb') as file:
+                    result = pickle.load(file)
+                os.utime(filename)
+                self.hits += 1
+                return result
+            except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+                pass
+
+            self.misses += 1
+            result = function(*args, **kwargs)
+            self.store(filename, result)
+            return result
+
+        return wrapper
+
+    def store(self, filename: str, result):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        temporary = f'{filename}.{os.getpid()}.tmp'
+        with open(temporary, 'wb') as file:
+            pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.entries())
+        self.size += os.path.getsize(temporary)
+        os.replace(temporary, filename)
+        # the cache is only walked once the running total is over budget
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def entries(self) -> list[tuple[float, int, str]]:
+        entries = []
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith('.pickle'):
+                    try:
+                        stat = os.stat(os.path.join(root, filename))
+                    except FileNotFoundError:
+                        # evicted by another process since the walk listed it
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(root, filename)))
+        return entries
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.size = total
+
+    def clear(self):
+        for _, _, filename in self.entries():
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+        self.size = 0
+
+
+# the cache shared by the modelling code, set memoise.enabled = False to bypass it
+memoise = Memo()
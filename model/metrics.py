@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+from silhouette import sampled_silhouette, silhouette
+
+# the track columns artist_density and album_density need
+GROUP_COLUMNS = ['artists_ids', 'album']
+
+# silhouette scores lie in [-1, 1], labelings it is undefined for (a single label or
+# one label per track) are stored with this value, as in full_scores.txt
+INVALID_SCORE = 2
+
+
+def n_labels(labels: np.ndarray) -> int:
+    return len(np.unique(labels))
+
+
+def score(features: np.ndarray, labels: np.ndarray, metric: str = 'euclidean', sample_size: int = None) -> tuple[float, float]:
+    # exact silhouette, or a stratified estimate from sample_size tracks, and the half
+    # width of the estimate's 95% confidence interval (0 for the exact score)
+    if not 2 <= n_labels(labels) <= len(labels) - 1:
+        return INVALID_SCORE, 0.0
+    if sample_size is not None and sample_size < len(labels):
+        return sampled_silhouette(features, labels, metric=metric, sample_size=sample_size)
+    return silhouette(features, labels, metric=metric), 0.0
+
+
+def artist_codes(tracks_df: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+    # (track row, artist code) pairs. tracks with several artists count towards each of them
+    artists = tracks_df['artists_ids'].str.split('/')
+    rows = np.repeat(np.arange(len(tracks_df)), artists.str.len().to_numpy())
+    return rows, pd.factorize(artists.explode().to_numpy())[0]
+
+
+def album_codes(tracks_df: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+    return np.arange(len(tracks_df)), pd.factorize(tracks_df['album'])[0]
+
+
+# the contingency table is counted densely while it has at most this many cells per
+# (track, group) entry, sparse counting is faster for tables that are mostly empty
+DENSE_TABLE_RATIO = 8
+
+
+def labeling_density(rows: np.ndarray, codes: np.ndarray, n_groups: int, labels: np.ndarray) -> float:
+    entry_labels = labels[rows]
+    clustered = entry_labels != -1
+    if not clustered.any():
+        return 0.0
+    groups = codes[clustered]
+    n_columns = int(labels.max()) + 1
+    cells = groups * n_columns + entry_labels[clustered]
+
+    totals = np.bincount(groups, minlength=n_groups)
+    if n_groups * n_columns <= DENSE_TABLE_RATIO * len(cells):
+        largest = np.bincount(cells, minlength=n_groups * n_columns).reshape(n_groups, n_columns).max(axis=1)
+    else:
+        cells, counts = np.unique(cells, return_counts=True)
+        largest = np.zeros(n_groups, dtype=np.int64)
+        np.maximum.at(largest, cells // n_columns, counts)
+
+    present = totals > 0
+    return float((largest[present] / totals[present]).mean())
+
+
+def densities(rows: np.ndarray, codes: np.ndarray, labelings: np.ndarray) -> np.ndarray:
+    # share of a group's (artist's, album's) tracks that fall into the group's most
+    # common cluster, averaged over all groups, for every labeling (one per row of
+    # labelings). noise (-1) is left out. the (group x label) contingency table of a
+    # labeling is counted with bincount, or with np.unique if it would be mostly empty
+    # (many small groups, or labelings with thousands of labels). labelings are counted
+    # one at a time on purpose, stacking them is slower once the arrays leave the cache.
+    n_groups = int(codes.max()) + 1 if len(codes) else 0
+    return np.array([labeling_density(rows, codes, n_groups, labels) for labels in np.atleast_2d(labelings)])
+
+
+def artist_density(tracks_df: pd.DataFrame, labels: np.ndarray) -> float:
+    return float(densities(*artist_codes(tracks_df), labels)[0])
+
+
+def album_density(tracks_df: pd.DataFrame, labels: np.ndarray) -> float:
+    return float(densities(*album_codes(tracks_df), labels)[0])
+
+
+def evaluate(tracks_df: pd.DataFrame, features: np.ndarray, labels: np.ndarray, metric: str = 'euclidean', sample_size: int = None) -> dict:
+    value, error = score(features, labels, metric=metric, sample_size=sample_size)
+    return {
+        'score': value,
+        'score_error': error,
+        'n_labels': n_labels(labels),
+        'artist_density': artist_density(tracks_df, labels),
+        'album_density': album_density(tracks_df, labels),
+    }
+
+
+def evaluate_batch(tracks_df: pd.DataFrame, features: np.ndarray, labelings: list[np.ndarray], metric: str = 'euclidean', sample_size: int = None) -> list[dict]:
+    # evaluate for several labelings of the same tracks, the densities of all of them are
+    # computed in one pass
+    labelings = np.stack(labelings)
+    artist = densities(*artist_codes(tracks_df), labelings)
+    album = densities(*album_codes(tracks_df), labelings)
+    scores = [score(features, labels, metric=metric, sample_size=sample_size) for labels in labelings]
+    return [
+        {
+            'score': scores[i][0],
+            'score_error': scores[i][1],
+            'n_labels': n_labels(labels),
+            'artist_density': float(artist[i]),
+            'album_density': float(album[i]),
+        }
+        for i, labels in enumerate(labelings)
+    ]
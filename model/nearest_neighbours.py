@@ -0,0 +1,151 @@
+import numpy as np
+from sklearn.metrics import pairwise_distances
+
+METRICS = ['euclidean', 'manhattan']
+
+# bytes a chunk of exact queries may take, float64 distances plus the int64 argpartition
+# of every (query, track) pair
+QUERY_MEMORY = 256 * 2 ** 20
+
+# manhattan distances between standardised tracks are roughly five times their
+# euclidean distances, so the buckets have to be wider to keep the same recall
+DEFAULT_BUCKET_WIDTH = {
+    'euclidean': 4.0,
+    'manhattan': 20.0,
+}
+
+
+def top_k(distances: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    k = min(k, distances.shape[1])
+    partition = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    partition_distances = np.take_along_axis(distances, partition, axis=1)
+    order = np.argsort(partition_distances, axis=1)
+    return np.take_along_axis(partition, order, axis=1), np.take_along_axis(partition_distances, order, axis=1)
+
+
+class ExactIndex:
+    def __init__(self, metric: str = 'euclidean', chunk_size: int = None, memory: int = QUERY_MEMORY):
+        # queries are chunked by chunk_size, or to keep a chunk within memory bytes
+        if metric not in METRICS:
+            raise ValueError(f'Unsupported metric {metric}, expected one of {METRICS}')
+        self.metric = metric
+        self.chunk_size = chunk_size
+        self.memory = memory
+        self.ids = np.empty(0, dtype=object)
+        self.data = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, ids, features: np.ndarray):
+        features = np.asarray(features, dtype=np.float32)
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=object)])
+        self.data = features if self.data is None else np.concatenate([self.data, features])
+
+    def query(self, features: np.ndarray, k: int = 10) -> tuple[np.ndarray, np.ndarray]:
+        features = np.atleast_2d(np.asarray(features, dtype=np.float32))
+        rows = np.empty((len(features), min(k, len(self))), dtype=np.int64)
+        distances = np.empty(rows.shape, dtype=np.float32)
+        if len(self) == 0:
+            # no neighbours for any query
+            return self.ids[rows], distances
+        # chunk the queries so the distance matrix never exceeds chunk_size x n_tracks
+        chunk_size = self.chunk_size or max(1, self.memory // (16 * len(self)))
+        for start in range(0, len(features), chunk_size):
+            chunk = features[start:start + chunk_size]
+            chunk_rows, chunk_distances = top_k(pairwise_distances(chunk, self.data, metric=self.metric), k)
+            rows[start:start + len(chunk)] = chunk_rows
+            distances[start:start + len(chunk)] = chunk_distances
+        return self.ids[rows], distances
+
+
+class LSHIndex:
+    """
+    Approximate index based on p-stable locality sensitive hashing. Every table hashes a
+    track to floor((a.x + b) / bucket_width) over n_projections random projections a,
+    drawn from a gaussian (euclidean) or cauchy (manhattan) distribution. Queries only
+    compute exact distances to tracks sharing a bucket in at least one table.
+
+    More tables raise recall, more projections per table make buckets smaller (faster,
+    lower recall) and a wider bucket_width makes them larger (slower, higher recall).
+    """
+
+    def __init__(self, n_features: int, metric: str = 'euclidean', n_tables: int = 16, n_projections: int = 6, bucket_width: float = None, seed: int = 0):
+        if metric not in METRICS:
+            raise ValueError(f'Unsupported metric {metric}, expected one of {METRICS}')
+        if bucket_width is None:
+            bucket_width = DEFAULT_BUCKET_WIDTH[metric]
+        rng = np.random.default_rng(seed)
+        self.metric = metric
+        self.n_tables = n_tables
+        self.bucket_width = bucket_width
+
+        shape = (n_tables, n_features, n_projections)
+        self.projections = (rng.standard_normal(shape) if metric == 'euclidean' else rng.standard_cauchy(shape)).astype(np.float32)
+        self.offsets = rng.uniform(0, bucket_width, (n_tables, n_projections)).astype(np.float32)
+        # combines the per-projection bucket numbers of a table into one int64 key
+        self.mixing = rng.integers(1, 2 ** 31, n_projections, dtype=np.int64)
+
+        self.ids = np.empty(0, dtype=object)
+        self.data = np.empty((0, n_features), dtype=np.float32)
+        # per table: bucket keys sorted ascending and the rows they belong to
+        self.sorted_keys = [np.empty(0, dtype=np.int64) for _ in range(n_tables)]
+        self.sorted_rows = [np.empty(0, dtype=np.int64) for _ in range(n_tables)]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def hash(self, features: np.ndarray) -> np.ndarray:
+        projected = np.einsum('nf,tfp->ntp', features, self.projections) + self.offsets
+        buckets = np.floor(projected / self.bucket_width).astype(np.int64)
+        return (buckets * self.mixing).sum(axis=2)
+
+    def add(self, ids, features: np.ndarray):
+        # incremental insertion: newly crawled tracks are merged into the sorted bucket
+        # arrays of every table without rehashing the existing catalogue
+        features = np.asarray(features, dtype=np.float32)
+        first_row = len(self)
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=object)])
+        self.data = np.concatenate([self.data, features])
+
+        keys = self.hash(features)
+        rows = np.arange(first_row, first_row + len(features), dtype=np.int64)
+        for table in range(self.n_tables):
+            order = np.argsort(keys[:, table], kind='stable')
+            new_keys = keys[order, table]
+            positions = np.searchsorted(self.sorted_keys[table], new_keys, side='right')
+            self.sorted_keys[table] = np.insert(self.sorted_keys[table], positions, new_keys)
+            self.sorted_rows[table] = np.insert(self.sorted_rows[table], positions, rows[order])
+
+    def candidates(self, features: np.ndarray) -> list[np.ndarray]:
+        keys = self.hash(features)
+        lower = np.empty(keys.shape, dtype=np.int64)
+        upper = np.empty(keys.shape, dtype=np.int64)
+        for table in range(self.n_tables):
+            lower[:, table] = np.searchsorted(self.sorted_keys[table], keys[:, table], side='left')
+            upper[:, table] = np.searchsorted(self.sorted_keys[table], keys[:, table], side='right')
+
+        candidates = []
+        for i in range(len(features)):
+            buckets = [self.sorted_rows[table][lower[i, table]:upper[i, table]] for table in range(self.n_tables)]
+            candidates.append(np.unique(np.concatenate(buckets)))
+        return candidates
+
+    def query(self, features: np.ndarray, k: int = 10) -> tuple[np.ndarray, np.ndarray]:
+        features = np.atleast_2d(np.asarray(features, dtype=np.float32))
+        # queries without enough candidates are padded with None / inf
+        ids = np.full((len(features), k), None, dtype=object)
+        distances = np.full((len(features), k), np.inf, dtype=np.float32)
+        for i, rows in enumerate(self.candidates(features)):
+            if len(rows) == 0:
+                continue
+            difference = self.data[rows] - features[i]
+            if self.metric == 'euclidean':
+                candidate_distances = np.sqrt(np.einsum('nf,nf->n', difference, difference))
+            else:
+                candidate_distances = np.abs(difference).sum(axis=1)
+            candidate_rows, candidate_distances = top_k(candidate_distances[np.newaxis], k)
+            found = candidate_rows.shape[1]
+            ids[i, :found] = self.ids[rows[candidate_rows[0]]]
+            distances[i, :found] = candidate_distances[0]
+        return ids, distances
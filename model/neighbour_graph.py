@@ -0,0 +1,97 @@
+import glob
+import hashlib
+import os
+import shutil
+import numpy as np
+import scipy.sparse as sp
+from sklearn.neighbors import NearestNeighbors
+
+GRAPH_CACHE_DIR = 'graph_cache'
+
+# graphs already read from the cache in this process, by filename
+loaded_graphs = {}
+
+
+def features_hash(features: np.ndarray) -> str:
+    # of the content, so cached graphs stay valid when the repo or the feature store moves
+    return hashlib.sha1(np.ascontiguousarray(features).tobytes()).hexdigest()[:16]
+
+
+def build_neighbour_graph(features: np.ndarray, radius: float, metric: str, chunk_size: int = 4096) -> sp.csr_matrix:
+    # sparse radius neighbour graph built chunk_size rows at a time, so peak memory is
+    # the graph itself plus the neighbourhoods of one chunk, never n_tracks x n_tracks.
+    # rows are sorted by distance and duplicate tracks keep their explicit zero entries.
+    neighbours = NearestNeighbors(radius=radius, metric=metric).fit(features)
+    indptr = [np.zeros(1, dtype=np.int64)]
+    indices = []
+    data = []
+    n_entries = 0
+    for start in range(0, len(features), chunk_size):
+        distances, neighbour_indices = neighbours.radius_neighbors(features[start:start + chunk_size], sort_results=True)
+        counts = np.array([len(row) for row in neighbour_indices], dtype=np.int64)
+        indptr.append(n_entries + np.cumsum(counts))
+        n_entries += counts.sum()
+        indices.append(np.concatenate(neighbour_indices).astype(np.int32))
+        data.append(np.concatenate(distances).astype(np.float32))
+
+    return sp.csr_matrix(
+        (np.concatenate(data), np.concatenate(indices), np.concatenate(indptr)),
+        shape=(len(features), len(features)),
+    )
+
+
+def threshold(graph: sp.csr_matrix, eps: float) -> sp.csr_matrix:
+    # the graph restricted to edges <= eps, usable with metric='precomputed'
+    keep = graph.data <= eps
+    indptr = np.concatenate([[0], np.cumsum(keep)])[graph.indptr]
+    return sp.csr_matrix((graph.data[keep], graph.indices[keep], indptr), shape=graph.shape)
+
+
+def neighbour_graph(features: np.ndarray, radius: float, metric: str, cache_dir: str = GRAPH_CACHE_DIR) -> sp.csr_matrix:
+    # one graph per (features, metric) is cached on disk; any cached graph with a radius
+    # at least as large serves the request, thresholded down to the requested radius
+    key = features_hash(features)
+    cached = []
+    for filename in glob.glob(os.path.join(cache_dir, f'{key}_{metric}_*.npz')):
+        cached_radius = float(os.path.basename(filename)[:-len('.npz')].split('_')[-1])
+        if cached_radius >= radius:
+            cached.append((cached_radius, filename))
+
+    if cached:
+        cached_radius, filename = min(cached)
+        if filename not in loaded_graphs:
+            print(f'Using cached neighbour graph {filename}')
+            loaded_graphs[filename] = sp.load_npz(filename).tocsr()
+        graph = loaded_graphs[filename]
+        return graph if cached_radius == radius else threshold(graph, radius)
+
+    print(f'Building neighbour graph for radius {radius} and metric {metric}')
+    graph = build_neighbour_graph(features, radius, metric)
+    os.makedirs(cache_dir, exist_ok=True)
+    sp.save_npz(os.path.join(cache_dir, f'{key}_{metric}_{radius}.npz'), graph, compressed=False)
+    return graph
+
+
+def shared_graph(features: np.ndarray, radius: float, metric: str, cache_dir: str = GRAPH_CACHE_DIR) -> str:
+    # directory of the graph's indptr, indices and data as .npy files, written once next
+    # to the cached graph, so worker processes can memory-map one copy of it instead of
+    # every worker loading (or building) the graph itself
+    directory = os.path.join(cache_dir, f'{features_hash(features)}_{metric}_{radius}_arrays')
+    if not os.path.exists(directory):
+        graph = neighbour_graph(features, radius, metric, cache_dir=cache_dir)
+        temporary = f'{directory}.{os.getpid()}.tmp'
+        os.makedirs(temporary, exist_ok=True)
+        for name in ('indptr', 'indices', 'data'):
+            np.save(os.path.join(temporary, f'{name}.npy'), getattr(graph, name))
+        try:
+            os.replace(temporary, directory)
+        except OSError:
+            # another process wrote it first
+            shutil.rmtree(temporary, ignore_errors=True)
+    return directory
+
+
+def open_shared_graph(directory: str, n_tracks: int) -> sp.csr_matrix:
+    # the graph of shared_graph over read-only memory maps of its arrays
+    indptr, indices, data = (np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r') for name in ('indptr', 'indices', 'data'))
+    return sp.csr_matrix((data, indices, indptr), shape=(n_tracks, n_tracks), copy=False)
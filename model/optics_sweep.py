@@ -0,0 +1,89 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+from sklearn.cluster import OPTICS, cluster_optics_dbscan
+from feature_store import load_dataset
+from features import DATASET_PATH
+from memo import memoise
+from metrics import GROUP_COLUMNS, evaluate_batch
+from neighbour_graph import neighbour_graph
+from scores import EPS_VALUES, METRICS, MIN_SAMPLES_VALUES, write_scores
+
+
+def single_linkage_labelings(features: np.ndarray, eps_values: list[float], metric: str):
+    # OPTICS needs min_samples > 1. with min_samples=1 every track is a core sample and
+    # DBSCAN reduces to the connected components of the eps-neighbourhood graph, so the
+    # labels for every eps come from one minimum spanning tree of the max eps graph.
+    graph = neighbour_graph(features, max(eps_values), metric).copy()
+    # csgraph ignores explicit zeros, keep duplicate tracks connected
+    graph.data[graph.data == 0] = np.finfo(np.float32).tiny
+    tree = minimum_spanning_tree(graph).tocsr()
+    for eps in eps_values:
+        thresholded = tree.copy()
+        thresholded.data[thresholded.data > eps] = 0
+        thresholded.eliminate_zeros()
+        yield eps, connected_components(thresholded, directed=False)[1]
+
+
+@memoise
+def fit_optics(features: np.ndarray, min_samples: int, max_eps: float, metric: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    optics = OPTICS(min_samples=min_samples, max_eps=max_eps, metric=metric, cluster_method='dbscan', eps=max_eps, n_jobs=-1)
+    optics.fit(features)
+    return optics.reachability_, optics.core_distances_, optics.ordering_
+
+
+def optics_labelings(features: np.ndarray, eps_values: list[float], min_samples: int, metric: str):
+    # one OPTICS fit per (min_samples, metric). the reachability plot it computes holds
+    # the DBSCAN labeling for every eps <= max_eps, extracting one is linear in n_tracks.
+    reachability, core_distances, ordering = fit_optics(features, min_samples, max(eps_values), metric)
+    for eps in eps_values:
+        yield eps, cluster_optics_dbscan(
+            reachability=reachability,
+            core_distances=core_distances,
+            ordering=ordering,
+            eps=eps,
+        )
+
+
+def sweep(tracks_df: pd.DataFrame, features: np.ndarray, eps_values: list[float], min_samples_values: list[int], metrics: list[str], sample_size: int = None):
+    for metric in metrics:
+        for min_samples in min_samples_values:
+            print(f'fitting min_samples: {min_samples}, metric: {metric}')
+            if min_samples == 1:
+                labelings = single_linkage_labelings(features, eps_values, metric)
+            else:
+                labelings = optics_labelings(features, eps_values, min_samples, metric)
+
+            eps_labelings = dict(labelings)
+            results = evaluate_batch(tracks_df, features, list(eps_labelings.values()), metric=metric, sample_size=sample_size)
+            for eps, result in zip(eps_labelings, results):
+                yield {
+                    'eps': eps,
+                    'min_samples': min_samples,
+                    'metric': metric,
+                    **result,
+                }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DBSCAN eps x min_samples sweep using one OPTICS fit per (min_samples, metric).')
+    parser.add_argument('--dataset', default=DATASET_PATH)
+    parser.add_argument('--synthetic', type=int, help='use this many synthetic tracks instead of the dataset')
+    parser.add_argument('--eps', type=float, nargs='+', default=EPS_VALUES)
+    parser.add_argument('--min-samples', type=int, nargs='+', default=MIN_SAMPLES_VALUES)
+    parser.add_argument('--metrics', nargs='+', default=METRICS)
+    parser.add_argument('--sample-size', type=int, help='estimate the score from a stratified sample of this many tracks')
+    parser.add_argument('--output', default='optics_scores.txt')
+    args = parser.parse_args()
+
+    tracks_df, features = load_dataset(args.dataset, args.synthetic, columns=GROUP_COLUMNS)
+
+    start = time.perf_counter()
+    write_scores(sweep(tracks_df, features, args.eps, args.min_samples, args.metrics, sample_size=args.sample_size), args.output)
+    print(f'sweep took {time.perf_counter() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from evaluation import CACHE_PATH, load_playlists, synthetic_playlists
+from feature_store import FeatureStore, load_dataset
+from features import DATASET_PATH
+from ids import IdCatalogue, explode
+from nearest_neighbours import ExactIndex
+
+# share of the score spent on being unlike the tracks picked so far
+DIVERSITY = 0.3
+
+# at most this many new tracks of one artist per continuation
+MAX_PER_ARTIST = 2
+
+# the playlist is summarised by up to this many centres, so playlists mixing several
+# styles get candidates from all of them instead of from the space between them
+N_CENTRES = 8
+
+# candidates retrieved per requested track
+CANDIDATE_FACTOR = 10
+
+
+def track_artists(artists_ids: pd.Series) -> sp.csr_matrix:
+    # binary track x artist matrix from the '/'-joined artists_ids column
+    rows, keys = explode(artists_ids)
+    codes = IdCatalogue().intern_keys(keys)
+    matrix = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, codes)), shape=(len(artists_ids), codes.max(initial=-1) + 1))
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return matrix
+
+
+def profile_centres(seed_features: np.ndarray, n_centres: int = N_CENTRES, iterations: int = 5, seed: int = 0) -> np.ndarray:
+    # a few rounds of k-means over the feature rows of the playlist
+    seed_features = np.asarray(seed_features, dtype=np.float32)
+    n_centres = min(n_centres, len(seed_features))
+    centres = seed_features[np.random.default_rng(seed).choice(len(seed_features), n_centres, replace=False)]
+    for _ in range(iterations):
+        distances = (seed_features ** 2).sum(axis=1)[:, None] - 2 * seed_features @ centres.T + (centres ** 2).sum(axis=1)[None, :]
+        assignment = distances.argmin(axis=1)
+        members = sp.csr_matrix((np.ones(len(seed_features), dtype=np.float32), (assignment, np.arange(len(seed_features)))), shape=(n_centres, len(seed_features)))
+        counts = np.asarray(members.sum(axis=1))
+        # empty centres keep their position
+        centres = np.where(counts > 0, (members @ seed_features) / np.maximum(counts, 1), centres).astype(np.float32)
+    return centres
+
+
+def similarities(features_a: np.ndarray, features_b: np.ndarray) -> np.ndarray:
+    # 1 / (1 + euclidean distance) of every pair of rows
+    squared = (features_a ** 2).sum(axis=1)[:, None] - 2 * features_a @ features_b.T + (features_b ** 2).sum(axis=1)[None, :]
+    return 1 / (1 + np.sqrt(np.maximum(squared, 0)))
+
+
+def row_entries(matrix: sp.csr_matrix, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # (position in rows, column) of every stored entry of the given rows
+    starts, ends = matrix.indptr[rows], matrix.indptr[rows + 1]
+    lengths = ends - starts
+    positions = np.repeat(np.arange(len(rows)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return positions, matrix.indices[starts[positions] + offsets]
+
+
+def column_ranks(positions: np.ndarray, columns: np.ndarray) -> np.ndarray:
+    # for every entry, the number of entries above it (lower position) in its column
+    order = np.lexsort((positions, columns))
+    sorted_columns = columns[order]
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = sorted_columns[1:] != sorted_columns[:-1]
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order)) - np.flatnonzero(starts)[np.cumsum(starts) - 1]
+    return ranks
+
+
+def mmr(candidate_features: np.ndarray, relevance: np.ndarray, n: int, diversity: float = DIVERSITY, candidate_artists: sp.csr_matrix = None, max_per_artist: int = MAX_PER_ARTIST) -> np.ndarray:
+    # maximal marginal relevance: every pick maximises (1 - diversity) * relevance minus
+    # diversity * the similarity to the closest track picked so far, skipping tracks of
+    # artists that already have max_per_artist picks. picks are made in rounds of matrix
+    # operations instead of one at a time: a round ranks the available candidates,
+    # penalises each of the top ones by its similarity to the ones ranked above it and
+    # picks those still scoring at least as well as the best candidate outside the round
+    # (always the first, which is the exact greedy pick) within the artist caps. the
+    # others wait for the next round. returns the positions of the picks in the candidates.
+    n = min(n, len(candidate_features))
+    closest = np.zeros(len(candidate_features), dtype=np.float32)
+    available = np.ones(len(candidate_features), dtype=bool)
+    artist_picks = np.zeros(candidate_artists.shape[1] if candidate_artists is not None else 0, dtype=np.int64)
+    picks = []
+    while len(picks) < n:
+        scores = np.where(available, (1 - diversity) * relevance - diversity * closest, -np.inf)
+        remaining = n - len(picks)
+        ranked = np.argsort(-scores, kind='stable')[:remaining + 1]
+        batch = ranked[:remaining][np.isfinite(scores[ranked[:remaining]])]
+        if not len(batch):
+            break
+        threshold = scores[ranked[remaining]] if len(ranked) > remaining else -np.inf
+
+        above = np.triu(similarities(candidate_features[batch], candidate_features[batch]), k=1).max(axis=0, initial=0)
+        accepted = (1 - diversity) * relevance[batch] - diversity * np.maximum(closest[batch], above) >= threshold
+        accepted[0] = True
+        if candidate_artists is not None:
+            # tracks that would take an artist past its cap together with the accepted
+            # tracks of the artist ranked above them
+            positions, artists = row_entries(candidate_artists, batch[accepted])
+            over = artist_picks[artists] + column_ranks(positions, artists) >= max_per_artist
+            accepted[np.flatnonzero(accepted)[positions[over]]] = False
+
+        new = batch[accepted]
+        picks.extend(new.tolist())
+        available[new] = False
+        closest = np.maximum(closest, similarities(candidate_features[new], candidate_features).max(axis=0))
+        if candidate_artists is not None:
+            artist_picks += np.bincount(row_entries(candidate_artists, new)[1], minlength=len(artist_picks))
+            # every track of a capped artist is taken out in one sparse product
+            capped = (artist_picks >= max_per_artist).astype(np.float32)
+            available &= candidate_artists @ capped == 0
+    return np.array(picks, dtype=np.int64)
+
+
+def rerank(features: np.ndarray, artists: sp.csr_matrix, seed_rows: np.ndarray, centres: np.ndarray, neighbour_rows: np.ndarray, n: int, diversity: float = DIVERSITY, max_per_artist: int = MAX_PER_ARTIST) -> tuple[np.ndarray, np.ndarray]:
+    # the neighbours of all centres (one row per centre, -1 padded) that are not in the
+    # playlist, diversified by mmr. relevance is the similarity to the closest centre.
+    candidates = np.unique(neighbour_rows[neighbour_rows >= 0])
+    candidates = candidates[~np.isin(candidates, seed_rows)]
+    candidate_features = np.asarray(features[candidates], dtype=np.float32)
+    distances = np.sqrt(np.maximum((candidate_features ** 2).sum(axis=1)[:, None] - 2 * candidate_features @ centres.T + (centres ** 2).sum(axis=1)[None, :], 0))
+    relevance = 1 / (1 + distances.min(axis=1))
+    # only the most relevant CANDIDATE_FACTOR * n candidates are diversified
+    if len(candidates) > CANDIDATE_FACTOR * n:
+        kept = np.argpartition(-relevance, CANDIDATE_FACTOR * n)[:CANDIDATE_FACTOR * n]
+        candidates, candidate_features, relevance = candidates[kept], candidate_features[kept], relevance[kept]
+    # artist columns restricted to the artists of the candidates
+    candidate_artists = artists[candidates] if artists is not None else None
+    if candidate_artists is not None:
+        candidate_artists = candidate_artists[:, np.unique(candidate_artists.indices)].tocsr()
+    picks = mmr(candidate_features, relevance, n, diversity, candidate_artists, max_per_artist)
+    return candidates[picks], relevance[picks]
+
+
+def continue_playlist(features: np.ndarray, index, artists: sp.csr_matrix, seed_rows: np.ndarray, n: int, diversity: float = DIVERSITY, max_per_artist: int = MAX_PER_ARTIST, n_centres: int = N_CENTRES) -> tuple[np.ndarray, np.ndarray]:
+    # n tracks extending the playlist of the given feature rows, as rows and relevance.
+    # the candidates of all centres come from one batched index query.
+    seed_rows = np.unique(seed_rows)
+    centres = profile_centres(features[seed_rows], n_centres)
+    per_centre = -(-CANDIDATE_FACTOR * n // len(centres)) + len(seed_rows)
+    neighbour_rows, _ = index.query(centres, per_centre)
+    neighbour_rows = np.where(neighbour_rows == None, -1, neighbour_rows).astype(np.int64)
+    return rerank(features, artists, seed_rows, centres, neighbour_rows, n, diversity, max_per_artist)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Continue playlists with diversified, artist capped recommendations and time it.')
+    parser.add_argument('--dataset', default=DATASET_PATH)
+    parser.add_argument('--synthetic', type=int, help='use this many synthetic tracks and playlists instead of the dataset')
+    parser.add_argument('--playlists', default=CACHE_PATH, help='response cache directory (or cache.json) of the data collection')
+    parser.add_argument('--playlist-size', type=int, default=1000, help='tracks per synthetic playlist')
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('-n', type=int, default=50)
+    parser.add_argument('--diversity', type=float, default=DIVERSITY)
+    parser.add_argument('--max-per-artist', type=int, default=MAX_PER_ARTIST)
+    args = parser.parse_args()
+
+    tracks_df, features = load_dataset(args.dataset, args.synthetic, columns=['id', 'artists_ids'])
+    store = FeatureStore(os.path.dirname(features.filename))
+    if args.synthetic:
+        playlists = synthetic_playlists(features, np.asarray(store.track_ids), n_playlists=args.queries, size=args.playlist_size, neighbourhood=4 * args.playlist_size)
+    else:
+        playlists = load_playlists(args.playlists)
+    seeds = [rows[rows >= 0] for rows in (store.rows(track_ids) for track_ids in list(playlists.values())[:args.queries])]
+    seeds = [rows for rows in seeds if len(rows)]
+
+    start = time.perf_counter()
+    index = ExactIndex()
+    index.add(np.arange(len(store)), features)
+    artists = track_artists(tracks_df['artists_ids'])
+    print(f'{len(store)} tracks, {artists.shape[1]} artists, built in {time.perf_counter() - start:.1f}s')
+
+    latencies = []
+    for rows in seeds:
+        start = time.perf_counter()
+        picks, _ = continue_playlist(features, index, artists, rows, args.n, args.diversity, args.max_per_artist)
+        latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000
+    print(f'{len(seeds)} playlists of {np.mean([len(rows) for rows in seeds]):.0f} tracks on average, {args.n} tracks each')
+    print(f'latency p50: {np.percentile(latencies, 50):.1f}ms, p95: {np.percentile(latencies, 95):.1f}ms, p99: {np.percentile(latencies, 99):.1f}ms')
+    print(f'last continuation: {len(picks)} tracks of {len(np.unique(artists[picks].indices))} artists')
+
+
+if __name__ == '__main__':
+    main()
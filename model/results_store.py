@@ -0,0 +1,115 @@
+import sqlite3
+import time
+import pandas as pd
+from scores import SCORE_COLUMNS, format_score_line, read_scores
+
+RESULTS_PATH = 'sweep_results.sqlite'
+
+# eps values are stored rounded so 0.1 * 3 and 0.3 end up as the same key
+EPS_DECIMALS = 6
+
+# runs are also keyed by the dataset (the content-hashed feature store directory name,
+# '' for rows imported from score files or from stores of earlier versions) and the
+# sample size of the score (0 for the exact score), so runs on other data or with
+# sampled scores don't count as finished
+RUNS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS runs (
+        algorithm TEXT NOT NULL,
+        eps REAL NOT NULL,
+        min_samples INTEGER NOT NULL,
+        metric TEXT NOT NULL,
+        score REAL,
+        n_labels INTEGER,
+        artist_density REAL,
+        album_density REAL,
+        seconds REAL,
+        peak_memory_mb REAL,
+        finished_at REAL,
+        score_error REAL,
+        dataset TEXT NOT NULL DEFAULT '',
+        sample_size INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (algorithm, dataset, sample_size, eps, min_samples, metric)
+    )
+'''
+
+
+class ResultsStore:
+    def __init__(self, path: str = RESULTS_PATH):
+        self.connection = sqlite3.connect(path)
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(runs)')]
+        if columns and 'dataset' not in columns:
+            # a store of an earlier version, keyed without dataset and sample size. its
+            # rows are kept under the unknown dataset ''.
+            self.connection.execute('ALTER TABLE runs RENAME TO runs_without_dataset')
+            self.connection.execute(RUNS_TABLE)
+            kept = ', '.join(columns)
+            self.connection.execute(f'INSERT INTO runs ({kept}) SELECT {kept} FROM runs_without_dataset')
+            self.connection.execute('DROP TABLE runs_without_dataset')
+        self.connection.execute(RUNS_TABLE)
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def save(self, algorithm: str, row: dict):
+        self.connection.execute(
+            '''
+            INSERT OR REPLACE INTO runs
+            (algorithm, eps, min_samples, metric, score, n_labels, artist_density, album_density, seconds, peak_memory_mb, finished_at, score_error, dataset, sample_size)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''',
+            (
+                algorithm,
+                round(row['eps'], EPS_DECIMALS),
+                row['min_samples'],
+                row['metric'],
+                row['score'],
+                row['n_labels'],
+                row['artist_density'],
+                row['album_density'],
+                row.get('seconds'),
+                row.get('peak_memory_mb'),
+                time.time(),
+                row.get('score_error'),
+                row.get('dataset') or '',
+                row.get('sample_size') or 0,
+            ),
+        )
+        self.connection.commit()
+
+    def finished(self, algorithm: str, dataset: str, sample_size: int = None) -> set[tuple[float, int, str]]:
+        # (eps, min_samples, metric) of every run stored for the dataset and sample size
+        # (None for the exact score), eps rounded to EPS_DECIMALS
+        cursor = self.connection.execute(
+            'SELECT eps, min_samples, metric FROM runs WHERE algorithm = ? AND dataset = ? AND sample_size = ?',
+            (algorithm, dataset, sample_size or 0),
+        )
+        return {(eps, min_samples, metric) for eps, min_samples, metric in cursor}
+
+    def query(self, **filters) -> pd.DataFrame:
+        # e.g. store.query(algorithm='dbscan', metric='euclidean', min_samples=10)
+        where = ' AND '.join(f'{column} = ?' for column in filters) or '1'
+        return pd.read_sql_query(
+            f'SELECT * FROM runs WHERE {where} ORDER BY algorithm, metric, eps, min_samples',
+            self.connection,
+            params=list(filters.values()),
+        )
+
+    def import_scores(self, filename: str, algorithm: str = 'dbscan', dataset: str = '', sample_size: int = None):
+        # loads rows in the scores.txt format, e.g. the results of earlier sweeps, as runs
+        # on the given dataset and sample size (unknown by default)
+        for row in read_scores(filename):
+            self.save(algorithm, {**row, 'dataset': dataset, 'sample_size': sample_size})
+
+    def export_scores(self, filename: str, **filters):
+        with open(filename, 'w') as file:
+            rows = self.query(**filters)[SCORE_COLUMNS]
+            # missing score errors as None, so they are left out of the lines
+            for row in rows.astype(object).where(rows.notna(), None).to_dict('records'):
+                file.write(format_score_line(row) + '\n')
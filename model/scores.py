@@ -0,0 +1,54 @@
+# the grid behind scores.txt / full_scores.txt
+EPS_VALUES = [i / 10 for i in range(1, 10)]
+MIN_SAMPLES_VALUES = [i for i in range(1, 10)]
+METRICS = ['manhattan', 'euclidean']
+
+SCORE_COLUMNS = ['eps', 'min_samples', 'metric', 'score', 'n_labels', 'artist_density', 'album_density', 'score_error']
+
+# columns missing from the files of earlier sweeps, left out of a line when a row has none
+OPTIONAL_COLUMNS = ['score_error']
+
+COLUMN_TYPES = {
+    'eps': float,
+    'min_samples': int,
+    'metric': str,
+    'score': float,
+    'n_labels': int,
+    'artist_density': float,
+    'album_density': float,
+    'score_error': float,
+}
+
+
+def format_score_line(row: dict) -> str:
+    # same format as scores.txt, e.g.
+    # eps: 0.76, min_samples: 10, metric: euclidean, score: -0.46, n_labels: 58, artist_density: 0.45, album_density: 0.74, score_error: 0.004
+    # score_error is the half width of the confidence interval of a sampled score
+    return ', '.join(f'{column}: {row[column]}' for column in SCORE_COLUMNS if column not in OPTIONAL_COLUMNS or row.get(column) is not None)
+
+
+def parse_score_line(line: str) -> dict:
+    row = {}
+    for field in line.strip().split(','):
+        key, value = field.split(':')
+        key = key.strip()
+        row[key] = COLUMN_TYPES[key](value.strip())
+    return row
+
+
+def read_scores(filename: str) -> list[dict]:
+    try:
+        with open(filename, 'r') as file:
+            return [parse_score_line(line) for line in file if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def write_scores(rows, filename: str):
+    # rows are written as they come in, so an interrupted sweep keeps its results
+    with open(filename, 'w') as file:
+        for row in rows:
+            line = format_score_line(row)
+            print(line)
+            file.write(line + '\n')
+            file.flush()
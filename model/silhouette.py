@@ -0,0 +1,104 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy.sparse as sp
+from scipy.stats import norm
+from sklearn.metrics import pairwise_distances
+from feature_store import materialise, shareable
+from memo import memoise
+
+# bytes of distances a chunk of tracks may take, chunks shrink as the dataset grows
+SILHOUETTE_MEMORY = 256 * 2 ** 20
+
+# set by init_worker in every worker process
+worker_state = {}
+
+
+def encode_labels(labels: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # labels as 0..n_labels-1 (noise is treated as a cluster of its own, like
+    # sklearn.metrics.silhouette_score does) and the size of every label
+    _, codes = np.unique(labels, return_inverse=True)
+    return codes, np.bincount(codes)
+
+
+def budget_chunk_size(n_tracks: int, memory: int = SILHOUETTE_MEMORY) -> int:
+    # tracks per chunk whose float64 distances to all n_tracks fit into memory
+    return max(1, memory // (8 * max(n_tracks, 1)))
+
+
+def samples_silhouette(features: np.ndarray, codes: np.ndarray, sizes: np.ndarray, rows: np.ndarray, metric: str) -> np.ndarray:
+    # silhouette of the tracks in rows against all tracks. the distances of rows to every
+    # track are summed per cluster with one sparse one-hot product, so memory is
+    # len(rows) x n_tracks for the distances and len(rows) x n_labels for the sums.
+    one_hot = sp.csr_matrix((np.ones(len(codes), dtype=np.float64), (np.arange(len(codes)), codes)), shape=(len(codes), len(sizes)))
+    cluster_sums = (one_hot.T @ pairwise_distances(features, features[rows], metric=metric)).T
+
+    own = codes[rows]
+    own_sizes = sizes[own]
+    a = cluster_sums[np.arange(len(rows)), own] / np.maximum(own_sizes - 1, 1)
+    means = cluster_sums / sizes
+    means[np.arange(len(rows)), own] = np.inf
+    b = means.min(axis=1)
+    s = (b - a) / np.maximum(a, b)
+    # tracks in singleton clusters have a silhouette of 0 by convention
+    s[own_sizes == 1] = 0
+    return s
+
+
+def init_worker(features, codes: np.ndarray, sizes: np.ndarray, metric: str):
+    worker_state.update(features=materialise(features), codes=codes, sizes=sizes, metric=metric)
+
+
+def run_chunk(rows: np.ndarray) -> np.ndarray:
+    return samples_silhouette(worker_state['features'], worker_state['codes'], worker_state['sizes'], rows, worker_state['metric'])
+
+
+@memoise(ignore=['chunk_size', 'n_jobs'])
+def silhouette(features: np.ndarray, labels: np.ndarray, metric: str = 'euclidean', chunk_size: int = None, n_jobs: int = 1) -> float:
+    # exact mean silhouette computed chunk_size tracks at a time (SILHOUETTE_MEMORY of
+    # distances by default), optionally spread over n_jobs worker processes (-1 for all cores)
+    codes, sizes = encode_labels(labels)
+    chunk_size = chunk_size or budget_chunk_size(len(features))
+    chunks = [np.arange(start, min(start + chunk_size, len(features))) for start in range(0, len(features), chunk_size)]
+    if n_jobs == 1:
+        return float(np.concatenate([samples_silhouette(features, codes, sizes, rows, metric) for rows in chunks]).mean())
+
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=init_worker, initargs=(shareable(features), codes, sizes, metric)) as executor:
+        return float(np.concatenate(list(executor.map(run_chunk, chunks))).mean())
+
+
+@memoise(version=1, ignore=['chunk_size'])
+def sampled_silhouette(features: np.ndarray, labels: np.ndarray, metric: str = 'euclidean', sample_size: int = 2000, confidence: float = 0.95, seed: int = 0, chunk_size: int = None) -> tuple[float, float]:
+    # estimate of the mean silhouette from a stratified sample: every cluster contributes
+    # in proportion to its size, the exact silhouette of each sampled track is computed
+    # against all tracks, chunk_size sampled tracks at a time. returns the estimate and
+    # the half width of its confidence interval.
+    rng = np.random.default_rng(seed)
+    codes, sizes = encode_labels(labels)
+    n_tracks = len(codes)
+    # clusters too small for two sampled tracks of their own are pooled into one stratum,
+    # so the sample stays near sample_size however many clusters there are
+    large = np.round(sample_size * sizes / n_tracks) >= 2
+    _, strata, stratum_sizes = np.unique(np.where(large[codes], codes, -1), return_inverse=True, return_counts=True)
+    allocation = np.minimum(stratum_sizes, np.maximum(2, np.round(sample_size * stratum_sizes / n_tracks).astype(np.int64)))
+
+    order = np.argsort(strata, kind='stable')
+    starts = np.concatenate([[0], np.cumsum(stratum_sizes)[:-1]])
+    rows = np.concatenate([
+        order[start + rng.choice(size, n, replace=False)]
+        for start, size, n in zip(starts, stratum_sizes, allocation)
+    ])
+    chunk_size = chunk_size or budget_chunk_size(n_tracks)
+    s = np.concatenate([samples_silhouette(features, codes, sizes, rows[start:start + chunk_size], metric) for start in range(0, len(rows), chunk_size)])
+
+    sampled_strata = strata[rows]
+    weights = stratum_sizes / n_tracks
+    stratum_means = np.bincount(sampled_strata, weights=s, minlength=len(stratum_sizes)) / allocation
+    squared_deviations = np.bincount(sampled_strata, weights=(s - stratum_means[sampled_strata]) ** 2, minlength=len(stratum_sizes))
+    stratum_variances = squared_deviations / np.maximum(allocation - 1, 1)
+    # finite population correction, fully sampled strata contribute no variance
+    variance = (weights ** 2 * stratum_variances / allocation * (1 - allocation / stratum_sizes)).sum()
+
+    estimate = float((weights * stratum_means).sum())
+    return estimate, float(norm.ppf(0.5 + confidence / 2) * np.sqrt(variance))
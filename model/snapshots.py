@@ -0,0 +1,203 @@
+import argparse
+import io
+import json
+import os
+import time
+import pandas as pd
+
+SNAPSHOT_DIR = '../data-collection/dataset'
+
+# the column identifying a row of every entity
+ENTITY_KEYS = {
+    'tracks': 'id',
+    'artists': 'artist_id',
+    'features': 'track_id',
+    # id -> canonical_id of the tracks collapsed by dedup.py
+    'aliases': 'id',
+}
+
+# partitions mark removed rows with a row of their key and this column set, rows of
+# later partitions bring them back
+DELETED_COLUMN = 'deleted'
+
+
+def row_hashes(df: pd.DataFrame, columns: list[str]) -> pd.Series:
+    # one hash per row over the given columns, so changed rows are found without
+    # comparing them column by column. missing columns hash as missing values.
+    return pd.util.hash_pandas_object(df.reindex(columns=columns).astype(str), index=False)
+
+
+class Snapshots:
+    """
+    Versioned dataset of the data collection, partitioned by entity and crawl batch.
+    Every merge writes the new and changed rows of each entity as one immutable
+    partition (<entity>/batch_<n>.csv) and records a snapshot version in manifest.json
+    that lists the partitions it is made of. Reading a version stacks its partitions,
+    where a row of a later partition replaces the row with the same key of an earlier
+    one, and tombstones (rows with the deleted column set) remove it.
+    """
+
+    def __init__(self, directory: str = SNAPSHOT_DIR):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as file:
+                self.manifest = json.load(file)
+        else:
+            self.manifest = {'batches': 0, 'snapshots': []}
+
+    def __len__(self) -> int:
+        return len(self.manifest['snapshots'])
+
+    def versions(self) -> list[int]:
+        return [snapshot['version'] for snapshot in self.manifest['snapshots']]
+
+    def snapshot(self, version='latest') -> dict:
+        # the manifest entry of a version, 'latest' (or None) for the newest one
+        if not self.manifest['snapshots']:
+            raise ValueError(f'No snapshots in {self.directory}')
+        if version in (None, 'latest'):
+            return self.manifest['snapshots'][-1]
+        for snapshot in self.manifest['snapshots']:
+            if snapshot['version'] == int(version):
+                return snapshot
+        raise ValueError(f'No snapshot version {version} in {self.directory}, versions are {self.versions()}')
+
+    def read_partitions(self, entity: str, partitions: list[str], columns: list[str] = None) -> pd.DataFrame:
+        key = ENTITY_KEYS[entity]
+        if columns is not None and key not in columns:
+            columns = [key] + columns
+        frames = [pd.read_csv(os.path.join(self.directory, partition), usecols=lambda column: columns is None or column in columns or column == DELETED_COLUMN, float_precision='round_trip') for partition in partitions]
+        if not frames:
+            return pd.DataFrame(columns=columns if columns is not None else [key])
+        df = pd.concat(frames, ignore_index=True)
+        # later partitions win
+        df = df.drop_duplicates(key, keep='last')
+        if DELETED_COLUMN in df:
+            df = df[df[DELETED_COLUMN] != True].drop(columns=DELETED_COLUMN)
+        return df.reset_index(drop=True)
+
+    def load(self, entity: str, version='latest', columns: list[str] = None) -> pd.DataFrame:
+        if not self.manifest['snapshots']:
+            return self.read_partitions(entity, [], columns)
+        return self.read_partitions(entity, self.snapshot(version)['partitions'].get(entity, []), columns)
+
+    def changed_partitions(self, entity: str, since: int, version='latest') -> list[str]:
+        # the partitions of version that are not in version since, which hold every row
+        # added or changed in between
+        old = set(self.snapshot(since)['partitions'].get(entity, [])) if since is not None else set()
+        return [partition for partition in self.snapshot(version)['partitions'].get(entity, []) if partition not in old]
+
+    def changes(self, entity: str, since: int, version='latest', columns: list[str] = None) -> pd.DataFrame:
+        # the rows added or changed after version since, as they are in version
+        return self.read_partitions(entity, self.changed_partitions(entity, since, version), columns)
+
+    def tracks_with_features(self, version='latest') -> pd.DataFrame:
+        # the same table as tracks_with_features_demo.csv, for one version
+        tracks_df = self.load('tracks', version)
+        features_df = self.load('features', version)
+        return pd.merge(tracks_df, features_df, left_on='id', right_on='track_id').drop('track_id', axis=1)
+
+    def delta(self, entity: str, df: pd.DataFrame, current: pd.DataFrame) -> pd.DataFrame:
+        # the rows of df that are not in current or differ from their row there
+        key = ENTITY_KEYS[entity]
+        # through csv and back, so values compare as they are read from the partitions
+        df = pd.read_csv(io.StringIO(df.drop_duplicates(key, keep='last').to_csv(index=False)), float_precision='round_trip')
+        if current.empty:
+            return df
+        columns = list(df.columns)
+        old = pd.Series(row_hashes(current, columns).to_numpy(), index=current[key].to_numpy())
+        new = row_hashes(df, columns).to_numpy()
+        previous = old.reindex(df[key].to_numpy()).to_numpy()
+        return df[pd.isna(previous) | (previous != new)]
+
+    def write_partition(self, entity: str, df: pd.DataFrame, batch: int) -> str:
+        partition = os.path.join(entity, f'batch_{batch:05d}.csv')
+        path = os.path.join(self.directory, partition)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        df.to_csv(path + '.tmp', index=False, sep=',')
+        os.replace(path + '.tmp', path)
+        return partition
+
+    def commit(self, partitions: dict[str, list[str]], changes: dict[str, int], note: str = None) -> int:
+        version = self.versions()[-1] + 1 if len(self) else 1
+        self.manifest['snapshots'].append({
+            'version': version,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'note': note,
+            'partitions': partitions,
+            'changes': changes,
+        })
+        # the manifest is replaced in one step, so readers see the old or the new version
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.manifest_path + '.tmp', 'w') as file:
+            json.dump(self.manifest, file, indent=2)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+        return version
+
+    def merge(self, frames: dict[str, pd.DataFrame], note: str = None, removed: dict[str, list] = None) -> int:
+        # writes the new and changed rows of every entity as a new partition and returns
+        # the new version, or None if nothing changed. rows missing from the frames are
+        # kept, a crawl of a slice of the catalogue only adds to it. removed lists the
+        # keys per entity to drop (e.g. tracks collapsed into another), which are written
+        # as tombstones.
+        removed = removed or {}
+        partitions = dict(self.snapshot()['partitions']) if len(self) else {}
+        changes = {}
+        batch = self.manifest['batches'] + 1
+        for entity in list(frames) + [entity for entity in removed if entity not in frames]:
+            key = ENTITY_KEYS[entity]
+            current = self.load(entity)
+            delta = self.delta(entity, frames[entity], current) if entity in frames else pd.DataFrame(columns=[key])
+            # removals win over the frame, only stored rows need a tombstone
+            delta = delta[~delta[key].isin(removed.get(entity, []))]
+            gone = pd.Index(removed.get(entity, [])).intersection(pd.Index(current[key]))
+            if len(gone):
+                delta = pd.concat([delta, pd.DataFrame({key: gone, DELETED_COLUMN: True})], ignore_index=True)
+            if len(delta) == 0:
+                continue
+            partitions[entity] = partitions.get(entity, []) + [self.write_partition(entity, delta, batch)]
+            changes[entity] = len(delta)
+        if not changes:
+            return None
+        self.manifest['batches'] = batch
+        return self.commit(partitions, changes, note)
+
+    def compact(self, version='latest') -> int:
+        # a new version with the rows of version in one partition per entity, so reading
+        # it doesn't stack every crawl batch. older versions keep their partitions.
+        snapshot = self.snapshot(version)
+        batch = self.manifest['batches'] + 1
+        partitions = {entity: [self.write_partition(entity, self.load(entity, snapshot['version']), batch)] for entity in snapshot['partitions']}
+        self.manifest['batches'] = batch
+        return self.commit(partitions, {}, f'compaction of version {snapshot["version"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List, export or compact the dataset snapshots of the data collection.')
+    parser.add_argument('--directory', default=SNAPSHOT_DIR)
+    parser.add_argument('--version', default='latest')
+    parser.add_argument('--since', type=int, help='with --export, only the rows added or changed after this version')
+    parser.add_argument('--export', help='write the tracks with features of the version to this csv')
+    parser.add_argument('--compact', action='store_true', help='write the version as one partition per entity')
+    args = parser.parse_args()
+
+    snapshots = Snapshots(args.directory)
+    for snapshot in snapshots.manifest['snapshots']:
+        partitions = ', '.join(f'{entity}: {len(files)}' for entity, files in snapshot['partitions'].items())
+        changes = ', '.join(f'{entity}: {count}' for entity, count in snapshot['changes'].items())
+        print(f'version {snapshot["version"]} ({snapshot["created"]}) partitions {partitions}, changed rows {changes or "none"}')
+
+    if args.export:
+        tracks_df = snapshots.tracks_with_features(args.version)
+        if args.since is not None:
+            changed = pd.concat([snapshots.changes('tracks', args.since, args.version, ['id'])['id'], snapshots.changes('features', args.since, args.version, ['track_id'])['track_id']])
+            tracks_df = tracks_df[tracks_df['id'].isin(changed)]
+        tracks_df.to_csv(args.export, index=False, sep=',')
+        print(f'Wrote {len(tracks_df)} tracks to {args.export}')
+    if args.compact:
+        print(f'Compacted into version {snapshots.compact(args.version)}')
+
+
+if __name__ == '__main__':
+    main()
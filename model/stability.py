@@ -0,0 +1,192 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.cluster import DBSCAN, KMeans
+from dbscan_sweep import dbscan_labels
+from feature_store import FeatureStore, load_dataset
+from features import DATASET_PATH
+from k_sweep import fit
+from neighbour_graph import GRAPH_CACHE_DIR, open_shared_graph, shared_graph
+
+ALGORITHMS = ['kmeans', 'dbscan']
+
+# clusters recovered with a jaccard similarity of at least this in a refit count as
+# recovered, clusters with a mean below ~0.6 are usually dissolved (Hennig 2007)
+RECOVERED_JACCARD = 0.75
+
+# set by init_worker in every worker process, so the store is opened once per worker
+worker_state = {}
+
+
+def init_worker(store_directory: str, graph_directory: str = None):
+    # features and the neighbour graph are memory-mapped, all workers share one copy
+    features = FeatureStore(store_directory).features
+    worker_state.update(features=features, graph=open_shared_graph(graph_directory, len(features)) if graph_directory else None)
+
+
+def subsample(n_tracks: int, fraction: float, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(n_tracks, int(n_tracks * fraction), replace=False))
+
+
+def refit(algorithm: str, parameters: dict, fraction: float, seed: int, centres: np.ndarray = None) -> tuple[np.ndarray, float]:
+    # labels of one fit on the subsample of the given seed, and the seconds it took
+    features = worker_state['features']
+    rows = subsample(len(features), fraction, seed)
+    start = time.perf_counter()
+    if algorithm == 'kmeans':
+        # warm started from the reference centres, so a refit measures how the clusters
+        # move with the data rather than which local optimum a random start finds
+        init = centres if centres is not None else 'k-means++'
+        labels = KMeans(n_clusters=parameters['k'], init=init, n_init=1, random_state=seed).fit(np.asarray(features[rows])).labels_
+    else:
+        # the subgraph of the shared neighbour graph of all tracks, nothing is searched
+        # again. min_samples shrinks with the subsample so the same density is a core.
+        graph = worker_state['graph']
+        min_samples = max(2, round(parameters['min_samples'] * fraction))
+        labels = DBSCAN(eps=parameters['eps'], min_samples=min_samples, metric='precomputed').fit(graph[rows][:, rows]).labels_
+    return labels.astype(np.int32), time.perf_counter() - start
+
+
+def contingency(labels: np.ndarray, other_labels: np.ndarray) -> sp.csr_matrix:
+    # sparse table of how often every pair of labels occurs together. labels are shifted
+    # by one, so row and column 0 hold the noise (-1) of DBSCAN.
+    table = sp.csr_matrix(
+        (np.ones(len(labels), dtype=np.int64), (labels + 1, other_labels + 1)),
+        shape=(labels.max(initial=-1) + 2, other_labels.max(initial=-1) + 2),
+    )
+    table.sum_duplicates()
+    return table
+
+
+def pairs(counts) -> np.ndarray:
+    counts = np.asarray(counts, dtype=np.float64)
+    return counts * (counts - 1) / 2
+
+
+def adjusted_rand_index(table: sp.csr_matrix) -> float:
+    # from the contingency table alone, never from pairs of tracks
+    together = pairs(table.data).sum()
+    rows = pairs(np.asarray(table.sum(axis=1)).ravel()).sum()
+    columns = pairs(np.asarray(table.sum(axis=0)).ravel()).sum()
+    expected = rows * columns / max(pairs(table.sum()), 1)
+    maximum = (rows + columns) / 2
+    return float((together - expected) / (maximum - expected)) if maximum != expected else 1.0
+
+
+def cluster_scores(table: sp.csr_matrix) -> tuple[np.ndarray, np.ndarray]:
+    # per reference cluster of a contingency table against a refit: the jaccard
+    # similarity of its best match in the refit, and the share of its pairs of tracks the
+    # refit puts in one cluster. tracks the refit calls noise match nothing.
+    sizes = np.asarray(table.sum(axis=1)).ravel()[1:]
+    column_sizes = np.asarray(table.sum(axis=0)).ravel()[1:]
+    clusters = table[1:, 1:].tocsr()
+    rows = np.repeat(np.arange(clusters.shape[0]), np.diff(clusters.indptr))
+    jaccard = clusters.astype(np.float64)
+    jaccard.data = clusters.data / (sizes[rows] + column_sizes[clusters.indices] - clusters.data)
+    together = clusters.astype(np.float64)
+    together.data = pairs(clusters.data)
+    co_assignment = np.asarray(together.sum(axis=1)).ravel() / np.maximum(pairs(sizes), 1)
+    return jaccard.max(axis=1).toarray().ravel(), co_assignment
+
+
+def stability_report(reference: np.ndarray, runs: list[tuple[np.ndarray, np.ndarray]]) -> tuple[pd.DataFrame, dict]:
+    # per reference cluster stability over all refits of (rows, labels), and the ARI of
+    # every refit with the reference and of every two refits on the tracks they share
+    n_clusters = reference.max(initial=-1) + 1
+    jaccards = np.zeros((len(runs), n_clusters))
+    co_assignments = np.zeros((len(runs), n_clusters))
+    reference_ari = []
+    full_labels = np.full((len(runs), len(reference)), -2, dtype=np.int32)
+    for i, (rows, labels) in enumerate(runs):
+        table = contingency(reference[rows], labels)
+        reference_ari.append(adjusted_rand_index(table))
+        jaccard, co_assignment = cluster_scores(table)
+        jaccards[i, :len(jaccard)] = jaccard
+        co_assignments[i, :len(co_assignment)] = co_assignment
+        full_labels[i, rows] = labels
+
+    pairwise_ari = []
+    for i in range(len(runs)):
+        for j in range(i + 1, len(runs)):
+            shared = (full_labels[i] > -2) & (full_labels[j] > -2)
+            pairwise_ari.append(adjusted_rand_index(contingency(full_labels[i, shared], full_labels[j, shared])))
+
+    report = pd.DataFrame({
+        'cluster': np.arange(n_clusters),
+        'size': np.bincount(reference[reference >= 0], minlength=n_clusters),
+        'mean_jaccard': jaccards.mean(axis=0),
+        'recovered_share': (jaccards >= RECOVERED_JACCARD).mean(axis=0),
+        'co_assignment': co_assignments.mean(axis=0),
+    })
+    summary = {
+        'runs': len(runs),
+        'clusters': int(n_clusters),
+        'noise_share': float((reference < 0).mean()),
+        'stable_clusters': int((report['mean_jaccard'] >= RECOVERED_JACCARD).sum()),
+        'reference_ari_mean': float(np.mean(reference_ari)),
+        'reference_ari_std': float(np.std(reference_ari)),
+        'pairwise_ari_mean': float(np.mean(pairwise_ari)) if pairwise_ari else None,
+    }
+    return report, summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-cluster stability of a clustering over parallel subsample refits.')
+    parser.add_argument('--algorithm', choices=ALGORITHMS, default='kmeans')
+    parser.add_argument('--dataset', default=DATASET_PATH)
+    parser.add_argument('--synthetic', type=int, help='use this many synthetic tracks instead of the dataset')
+    parser.add_argument('--k', type=int, default=20)
+    parser.add_argument('--eps', type=float, default=0.5)
+    parser.add_argument('--min-samples', type=int, default=10)
+    parser.add_argument('--metric', default='euclidean')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--fraction', type=float, default=0.8, help='share of the tracks in every refit')
+    parser.add_argument('--no-warm-start', action='store_true', help='start k-means refits from k-means++ instead of the reference centres')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--cache-dir', default=GRAPH_CACHE_DIR)
+    parser.add_argument('--output', help='write the per-cluster report to this csv and the summary next to it as json')
+    args = parser.parse_args()
+
+    _, features = load_dataset(args.dataset, args.synthetic, columns=['id'])
+    start = time.perf_counter()
+    if args.algorithm == 'kmeans':
+        parameters = {'k': args.k}
+        centres, reference = fit(features, args.k, 'k-means++', minibatch=False)
+        centres = None if args.no_warm_start else centres
+    else:
+        parameters = {'eps': args.eps, 'min_samples': args.min_samples, 'metric': args.metric}
+        reference = dbscan_labels(features, args.eps, args.min_samples, args.metric, cache_dir=args.cache_dir)
+        centres = None
+    # the graph is built (or loaded) here once, the workers memory-map it
+    graph_directory = shared_graph(features, args.eps, args.metric, cache_dir=args.cache_dir) if args.algorithm == 'dbscan' else None
+    print(f'reference fit (or memo cache) took {time.perf_counter() - start:.1f}s')
+
+    start = time.perf_counter()
+    seeds = list(range(1, args.runs + 1))
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(os.path.dirname(features.filename), graph_directory)) as executor:
+        results = list(executor.map(refit, [args.algorithm] * args.runs, [parameters] * args.runs, [args.fraction] * args.runs, seeds, [centres] * args.runs))
+    runs = [(subsample(len(features), args.fraction, seed), labels) for seed, (labels, _) in zip(seeds, results)]
+    refits = time.perf_counter() - start
+    fit_seconds = [seconds for _, seconds in results]
+    print(f'{args.runs} refits on {args.fraction:.0%} of {len(features)} tracks in {refits:.1f}s with {args.workers} workers, {np.mean(fit_seconds):.2f}s per fit')
+
+    start = time.perf_counter()
+    report, summary = stability_report(np.asarray(reference), runs)
+    summary.update(parameters, refit_seconds=refits, mean_fit_seconds=float(np.mean(fit_seconds)), report_seconds=time.perf_counter() - start)
+    print(report.sort_values('mean_jaccard').to_string(index=False, float_format='%.3f'))
+    print(', '.join(f'{key}: {value:.4g}' if isinstance(value, float) else f'{key}: {value}' for key, value in summary.items()))
+
+    if args.output:
+        report.to_csv(args.output, index=False)
+        with open(os.path.splitext(args.output)[0] + '.json', 'w') as file:
+            json.dump(summary, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import argparse
+import os
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from feature_store import FeatureStore, load_dataset
+from features import DATASET_PATH, load_tracks, synthetic_tracks
+from metrics import GROUP_COLUMNS
+from neighbour_graph import GRAPH_CACHE_DIR, neighbour_graph
+from results_store import EPS_DECIMALS, RESULTS_PATH, ResultsStore
+from scores import EPS_VALUES, METRICS, MIN_SAMPLES_VALUES
+import dbscan_sweep
+import optics_sweep
+
+ALGORITHMS = ['dbscan', 'optics']
+
+# set by init_worker in every worker process, so the dataset is loaded once per worker
+worker_state = {}
+
+
+def init_worker(dataset: str, synthetic: int, store_directory: str, cache_dir: str, sample_size: int):
+    # features are memory-mapped from the store, all workers share one copy
+    tracks_df = synthetic_tracks(synthetic) if synthetic else load_tracks(dataset, GROUP_COLUMNS)
+    features = FeatureStore(store_directory).features
+    worker_state.update(tracks_df=tracks_df, features=features, cache_dir=cache_dir, sample_size=sample_size)
+
+
+def run_task(algorithm: str, eps_values: list[float], min_samples: int, metric: str) -> list[dict]:
+    # one task is one DBSCAN fit, or one OPTICS fit with all eps extracted from it
+    tracemalloc.start()
+    start = time.perf_counter()
+    if algorithm == 'dbscan':
+        rows = list(dbscan_sweep.sweep(worker_state['tracks_df'], worker_state['features'], eps_values, [min_samples], [metric], cache_dir=worker_state['cache_dir'], sample_size=worker_state['sample_size']))
+    else:
+        rows = list(optics_sweep.sweep(worker_state['tracks_df'], worker_state['features'], eps_values, [min_samples], [metric], sample_size=worker_state['sample_size']))
+    seconds = (time.perf_counter() - start) / len(rows)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    for row in rows:
+        row['seconds'] = seconds
+        row['peak_memory_mb'] = peak / 2 ** 20
+    return rows
+
+
+def pending_tasks(store: ResultsStore, algorithm: str, dataset: str, sample_size: int, eps_values: list[float], min_samples_values: list[int], metrics: list[str]) -> list[tuple]:
+    # the finished runs on the dataset with the sample size come from one query, not
+    # one per grid point
+    finished = store.finished(algorithm, dataset, sample_size)
+    tasks = []
+    for metric in metrics:
+        for min_samples in min_samples_values:
+            missing = [eps for eps in eps_values if (round(eps, EPS_DECIMALS), min_samples, metric) not in finished]
+            if algorithm == 'dbscan':
+                tasks.extend((algorithm, [eps], min_samples, metric) for eps in missing)
+            elif missing:
+                tasks.append((algorithm, missing, min_samples, metric))
+    return tasks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parallel, resumable clustering sweep storing its results in SQLite.')
+    parser.add_argument('--algorithm', choices=ALGORITHMS, default='dbscan')
+    parser.add_argument('--dataset', default=DATASET_PATH)
+    parser.add_argument('--synthetic', type=int, help='use this many synthetic tracks instead of the dataset')
+    parser.add_argument('--eps', type=float, nargs='+', default=EPS_VALUES)
+    parser.add_argument('--min-samples', type=int, nargs='+', default=MIN_SAMPLES_VALUES)
+    parser.add_argument('--metrics', nargs='+', default=METRICS)
+    parser.add_argument('--sample-size', type=int, help='estimate the score from a stratified sample of this many tracks')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--cache-dir', default=GRAPH_CACHE_DIR)
+    parser.add_argument('--results', default=RESULTS_PATH)
+    args = parser.parse_args()
+
+    # build (or load) the feature store once before fanning out, so the workers don't
+    # race each other computing it. its directory name identifies the dataset in the
+    # results.
+    _, features = load_dataset(args.dataset, args.synthetic, columns=GROUP_COLUMNS)
+    dataset = os.path.basename(os.path.dirname(features.filename))
+
+    with ResultsStore(args.results) as store:
+        tasks = pending_tasks(store, args.algorithm, dataset, args.sample_size, args.eps, args.min_samples, args.metrics)
+        print(f'{len(tasks)} tasks pending for dataset {dataset}')
+        if not tasks:
+            return
+
+        # the same for the shared neighbour graphs
+        if args.algorithm == 'dbscan':
+            for metric in {task[3] for task in tasks}:
+                neighbour_graph(features, max(args.eps), metric, cache_dir=args.cache_dir)
+
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(args.dataset, args.synthetic, os.path.dirname(features.filename), args.cache_dir, args.sample_size)) as executor:
+            futures = [executor.submit(run_task, *task) for task in tasks]
+            for i, future in enumerate(as_completed(futures)):
+                for row in future.result():
+                    store.save(args.algorithm, {**row, 'dataset': dataset, 'sample_size': args.sample_size})
+                print(f'finished {i + 1}/{len(tasks)} tasks after {time.perf_counter() - start:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+import argparse
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import PCA
+from sklearn.manifold import TSNE
+from sklearn.neighbors import NearestNeighbors
+from feature_store import load_dataset
+from features import DATASET_PATH
+from k_sweep import fit
+from memo import memoise
+from metrics import GROUP_COLUMNS
+
+PROJECTION_METHODS = ['pca', 'tsne', 'umap']
+
+# t-SNE and UMAP are fitted on a sample this large, the remaining tracks are placed
+# next to their nearest sampled neighbour
+EMBEDDING_SAMPLE_SIZE = 20_000
+
+
+@memoise
+def projection(features: np.ndarray, method: str = 'pca', n_components: int = 2, seed: int = 0) -> np.ndarray:
+    # 2D/3D coordinates of every track, cached to disk by memoise
+    if method == 'pca':
+        return PCA(n_components=n_components, random_state=seed).fit_transform(np.asarray(features)).astype(np.float32)
+
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(len(features), min(EMBEDDING_SAMPLE_SIZE, len(features)), replace=False))
+    if method == 'tsne':
+        embedded = TSNE(n_components=n_components, init='pca', random_state=seed).fit_transform(np.asarray(features[sample]))
+    elif method == 'umap':
+        # umap-learn is optional, it's only needed for this projection
+        try:
+            import umap
+        except ImportError:
+            raise ImportError('the umap projection needs umap-learn (pip install umap-learn)')
+        embedded = umap.UMAP(n_components=n_components, random_state=seed).fit_transform(np.asarray(features[sample]))
+    else:
+        raise ValueError(f'unknown projection method {method}, expected one of {PROJECTION_METHODS}')
+
+    nearest = NearestNeighbors(n_neighbors=1).fit(features[sample])
+    coordinates = np.empty((len(features), n_components), dtype=np.float32)
+    for start in range(0, len(features), 65536):
+        rows = np.asarray(features[start:start + 65536])
+        coordinates[start:start + 65536] = embedded[nearest.kneighbors(rows, return_distance=False)[:, 0]]
+    coordinates[sample] = embedded
+    return coordinates
+
+
+def grid_cells(coordinates: np.ndarray, n_bins: int) -> np.ndarray:
+    # flat index of the n_bins^d grid cell every point falls in
+    low = coordinates.min(axis=0)
+    width = np.maximum(coordinates.max(axis=0) - low, np.finfo(np.float32).eps) / n_bins
+    bins = np.minimum(((coordinates - low) / width).astype(np.int64), n_bins - 1)
+    return np.ravel_multi_index(tuple(bins.T), (n_bins,) * coordinates.shape[1])
+
+
+def cluster_budgets(sizes: np.ndarray, max_points: int, min_per_cluster: int) -> np.ndarray:
+    # points to keep per cluster: proportional to its size, but every cluster keeps at
+    # least min_per_cluster points (or all of them) so small clusters stay visible
+    floor = np.minimum(sizes, min_per_cluster)
+    remaining = max(max_points - floor.sum(), 0)
+    extra = np.floor(remaining * (sizes - floor) / max((sizes - floor).sum(), 1)).astype(np.int64)
+    return np.minimum(sizes, floor + extra)
+
+
+def cell_cap(counts: np.ndarray, budget: int) -> float:
+    # per cell cap t with sum(min(counts, t)) = budget: sparse cells keep all of their
+    # points, dense cells are thinned to t points each. t is fractional when there are
+    # more cells than the budget allows whole points for.
+    counts = np.sort(counts)
+    kept = np.cumsum(counts) + counts * np.arange(len(counts) - 1, -1, -1)
+    fits = np.searchsorted(kept, budget, side='right')
+    if fits == len(counts):
+        return float(counts[-1])
+    return (budget - counts[:fits].sum()) / (len(counts) - fits)
+
+
+def downsample(coordinates: np.ndarray, labels: np.ndarray, max_points: int = 20_000, n_bins: int = 64, min_per_cluster: int = 50, seed: int = 0) -> np.ndarray:
+    # rows of a density-aware, stratified sample: each cluster gets its budget, within a
+    # cluster every grid cell keeps at most the same number of points, so outliers and
+    # sparse regions survive while dense cores are thinned
+    if len(labels) <= max_points:
+        return np.arange(len(labels))
+    rng = np.random.default_rng(seed)
+    _, codes = np.unique(labels, return_inverse=True)
+    budgets = cluster_budgets(np.bincount(codes), max_points, min_per_cluster)
+
+    # group = (cluster, cell), rows ordered by group and randomly within it
+    _, groups = np.unique(codes * (n_bins ** coordinates.shape[1]) + grid_cells(coordinates, n_bins), return_inverse=True)
+    order = np.lexsort((rng.random(len(groups)), groups))
+    group_counts = np.bincount(groups)
+    rank = np.arange(len(order)) - np.concatenate([[0], np.cumsum(group_counts)[:-1]])[groups[order]]
+
+    group_codes = np.empty(len(group_counts), dtype=np.int64)
+    group_codes[groups] = codes
+    caps = np.zeros(len(group_counts), dtype=np.float64)
+    for code, budget in enumerate(budgets):
+        in_cluster = np.flatnonzero(group_codes == code)
+        caps[in_cluster] = cell_cap(group_counts[in_cluster], budget)
+    # the point ranked floor(cap) in a cell is kept with probability frac(cap)
+    return np.sort(order[rank + rng.random(len(order)) < caps[groups[order]]])
+
+
+def binned(coordinates: np.ndarray, labels: np.ndarray, n_bins: int = 64) -> pd.DataFrame:
+    # one row per non-empty (cluster, grid cell) with the mean position and the number of
+    # tracks in it, for plotting as markers sized by count
+    columns = ['x', 'y', 'z'][:coordinates.shape[1]]
+    df = pd.DataFrame(coordinates, columns=columns)
+    df['cluster'] = labels
+    df['cell'] = grid_cells(coordinates, n_bins)
+    aggregated = df.groupby(['cluster', 'cell'], sort=False).agg(**{column: (column, 'mean') for column in columns}, count=('cluster', 'size'))
+    return aggregated.reset_index().drop(columns='cell')
+
+
+def scatter(coordinates: np.ndarray, labels: np.ndarray, max_points: int = 20_000, mode: str = 'sample', n_bins: int = 64, title: str = None):
+    # plotly scatter (3D for three components) that stays responsive at 100k+ tracks:
+    # mode 'sample' plots a density-aware sample, mode 'bins' one marker per cluster and cell
+    import plotly.express as px
+
+    if mode == 'bins':
+        df = binned(coordinates, labels, n_bins)
+        size = 'count'
+    else:
+        rows = downsample(coordinates, labels, max_points, n_bins)
+        df = pd.DataFrame(coordinates[rows], columns=['x', 'y', 'z'][:coordinates.shape[1]])
+        df['cluster'] = labels[rows]
+        size = None
+    df['cluster'] = df['cluster'].astype(str)
+
+    if coordinates.shape[1] == 3:
+        return px.scatter_3d(df, x='x', y='y', z='z', color='cluster', size=size, title=title)
+    return px.scatter(df, x='x', y='y', color='cluster', size=size, title=title, render_mode='webgl')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Plot a k-means clustering on a cached 2D/3D projection of the features.')
+    parser.add_argument('--dataset', default=DATASET_PATH)
+    parser.add_argument('--synthetic', type=int, help='use this many synthetic tracks instead of the dataset')
+    parser.add_argument('--k', type=int, default=20)
+    parser.add_argument('--method', choices=PROJECTION_METHODS, default='pca')
+    parser.add_argument('--dimensions', type=int, choices=[2, 3], default=2)
+    parser.add_argument('--mode', choices=['sample', 'bins'], default='sample')
+    parser.add_argument('--max-points', type=int, default=20_000)
+    parser.add_argument('--output', default='clusters.html')
+    args = parser.parse_args()
+
+    _, features = load_dataset(args.dataset, args.synthetic, columns=GROUP_COLUMNS)
+    _, labels = fit(features, args.k, 'k-means++', minibatch=len(features) > 100_000)
+    coordinates = projection(features, args.method, args.dimensions)
+    figure = scatter(coordinates, labels, args.max_points, args.mode, title=f'k = {args.k}, {args.method}')
+    figure.write_html(args.output)
+    print(f'Saved plot of {len(features)} tracks to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+import aiohttp
+import numpy as np
+
+model_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model')
+sys.path.append(model_dir)
+from feature_store import load_dataset
+from features import DATASET_PATH
+
+
+async def client(session: aiohttp.ClientSession, url: str, track_ids: np.ndarray, requests: int, recommend_share: float, k: int, rng: np.random.Generator, latencies: list[float], errors: list[int]):
+    for _ in range(requests):
+        start = time.perf_counter()
+        if rng.random() < recommend_share:
+            seeds = rng.choice(track_ids, 5).tolist()
+            response = session.post(f'{url}/recommend', json={'track_ids': seeds, 'k': k})
+        else:
+            response = session.get(f'{url}/similar', params={'track_id': str(rng.choice(track_ids)), 'k': k})
+        async with response as response:
+            await response.read()
+            if response.status != 200:
+                errors.append(response.status)
+        latencies.append(time.perf_counter() - start)
+
+
+async def run(args, track_ids: np.ndarray):
+    # hot_tracks of the tracks get most of the traffic, so the result cache sees repeats
+    rng = np.random.default_rng(args.seed)
+    hot = rng.choice(track_ids, min(args.hot_tracks, len(track_ids)), replace=False)
+    latencies = []
+    errors = []
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            client(session, args.url, hot if rng.random() < args.hot_share else track_ids, args.requests // args.concurrency, args.recommend_share, args.k, np.random.default_rng(args.seed + i), latencies, errors)
+            for i in range(args.concurrency)
+        ])
+        elapsed = time.perf_counter() - start
+        async with session.get(f'{args.url}/stats') as response:
+            stats = await response.json()
+
+    latencies = np.array(latencies) * 1000
+    print(f'{len(latencies)} requests in {elapsed:.1f}s with {args.concurrency} concurrent clients, {len(errors)} errors')
+    print(f'QPS: {len(latencies) / elapsed:.0f}')
+    print(f'latency p50: {np.percentile(latencies, 50):.1f}ms, p95: {np.percentile(latencies, 95):.1f}ms, p99: {np.percentile(latencies, 99):.1f}ms')
+    print(f'server: mean batch size {stats["mean_batch_size"]:.1f}, cache hits {stats["cache_hits"]}, cache misses {stats["cache_misses"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test a running recommendation server, reporting QPS and latency percentiles.')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--dataset', default=os.path.join(model_dir, DATASET_PATH))
+    parser.add_argument('--synthetic', type=int, help='the server serves this many synthetic tracks')
+    parser.add_argument('--store-dir', default=os.path.join(model_dir, 'feature_store'))
+    parser.add_argument('--requests', type=int, default=10_000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--recommend-share', type=float, default=0.2, help='share of /recommend requests, the rest are /similar')
+    parser.add_argument('--hot-tracks', type=int, default=1000)
+    parser.add_argument('--hot-share', type=float, default=0.5, help='share of clients that only ask for the hot tracks')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    tracks_df, _ = load_dataset(args.dataset, args.synthetic, columns=['id'], store_dir=args.store_dir)
+    asyncio.run(run(args, tracks_df['id'].to_numpy(dtype=str)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from aiohttp import web
+
+model_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model')
+sys.path.append(model_dir)
+from dedup import AliasMap
+from feature_store import FeatureStore, load_dataset
+from features import DATASET_PATH
+from nearest_neighbours import ExactIndex
+from playlist import CANDIDATE_FACTOR, profile_centres, rerank, track_artists
+
+METADATA_COLUMNS = ['id', 'name', 'artists_ids', 'album']
+
+
+class LRUCache:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+
+class QueryBatcher:
+    """
+    Coalesces concurrent nearest neighbour queries: requests arriving within max_wait
+    seconds of each other (up to max_batch of them) are answered by one vectorised
+    index query, which runs in a thread so the event loop keeps accepting requests.
+    """
+
+    def __init__(self, index: ExactIndex, max_batch: int = 64, max_wait: float = 0.002):
+        self.index = index
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        # created in run, inside the event loop of the server
+        self.queue = None
+        self.batches = 0
+        self.queries = 0
+
+    async def query(self, features: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((features, k, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            # waiters that were cancelled (client gone, timeout, shutdown) are skipped
+            batch = [item for item in batch if not item[2].done()]
+            if not batch:
+                continue
+            # a failing batch fails its own queries, never the loop
+            try:
+                await self.answer(batch)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def answer(self, batch: list[tuple]):
+        features = np.stack([features for features, _, _ in batch])
+        k = max(k for _, k, _ in batch)
+        ids, distances = await asyncio.get_running_loop().run_in_executor(None, self.index.query, features, k)
+        self.batches += 1
+        self.queries += len(batch)
+        for i, (_, k, future) in enumerate(batch):
+            # cancelled while the index was queried
+            if not future.done():
+                future.set_result((ids[i, :k], distances[i, :k]))
+
+
+class Recommender:
+    def __init__(self, store: FeatureStore, tracks_df, metric: str = 'euclidean', max_batch: int = 64, max_wait: float = 0.002, cache_size: int = 10_000, aliases: AliasMap = None):
+        self.store = store
+        # re-releases collapsed by dedup.py are answered as their canonical track
+        self.aliases = aliases
+        # rows of tracks_df line up with the rows of the feature store
+        self.metadata = {column: tracks_df[column].fillna('').tolist() for column in METADATA_COLUMNS}
+        # the index works directly on the memory-mapped store matrix, nothing is copied,
+        # and returns store rows
+        self.index = ExactIndex(metric=metric)
+        self.index.add(np.arange(len(store)), store.features)
+        self.batcher = QueryBatcher(self.index, max_batch, max_wait)
+        self.cache = LRUCache(cache_size)
+        self.artists = track_artists(tracks_df['artists_ids'])
+
+    def tracks(self, rows: np.ndarray, values: np.ndarray, field: str = 'distance') -> list[dict]:
+        return [
+            {**{column: self.metadata[column][row] for column in METADATA_COLUMNS}, field: value}
+            for row, value in zip(rows.tolist(), values.tolist())
+        ]
+
+    async def nearest(self, features: np.ndarray, exclude: np.ndarray, k: int) -> list[dict]:
+        rows, distances = await self.batcher.query(features, k + len(exclude))
+        rows = rows.astype(np.int64)
+        keep = ~np.isin(rows, exclude)
+        return self.tracks(rows[keep][:k], distances[keep][:k])
+
+    def rows(self, track_ids: list[str]) -> np.ndarray:
+        return self.store.rows(self.aliases.resolve(track_ids) if self.aliases is not None else track_ids)
+
+    def seed_rows(self, track_ids: list[str]) -> np.ndarray:
+        rows = self.rows(track_ids)
+        unknown = [track_id for track_id, row in zip(track_ids, rows) if row < 0]
+        if unknown:
+            raise web.HTTPNotFound(text=f'unknown tracks {unknown}')
+        return np.sort(rows)
+
+    async def similar(self, track_id: str, k: int) -> list[dict]:
+        key = ('similar', track_id, k)
+        result = self.cache.get(key)
+        if result is None:
+            rows = self.seed_rows([track_id])
+            result = await self.nearest(np.asarray(self.store.features[rows[0]]), rows, k)
+            self.cache.put(key, result)
+        return result
+
+    async def recommend(self, track_ids: list[str], k: int) -> list[dict]:
+        # tracks closest to the centre of the seed tracks, without the seeds themselves
+        key = ('recommend', tuple(sorted(set(track_ids))), k)
+        result = self.cache.get(key)
+        if result is None:
+            rows = self.seed_rows(list(key[1]))
+            result = await self.nearest(np.asarray(self.store.features[rows]).mean(axis=0), rows, k)
+            self.cache.put(key, result)
+        return result
+
+    async def continue_playlist(self, track_ids: list[str], n: int) -> list[dict]:
+        # n tracks extending the playlist, diversified and with at most MAX_PER_ARTIST
+        # tracks per artist. tracks without features are ignored, playlists often have some.
+        rows = np.unique(self.rows(track_ids))
+        rows = rows[rows >= 0]
+        if len(rows) == 0:
+            raise web.HTTPNotFound(text='none of the tracks are known')
+        key = ('continue', rows.tobytes(), n)
+        result = self.cache.get(key)
+        if result is None:
+            # the centres are queried together, the batcher answers them in one index query
+            centres = profile_centres(self.store.features[rows])
+            per_centre = -(-CANDIDATE_FACTOR * n // len(centres)) + len(rows)
+            neighbours = await asyncio.gather(*[self.batcher.query(centre, per_centre) for centre in centres])
+            neighbour_rows = np.stack([neighbour_rows for neighbour_rows, _ in neighbours]).astype(np.int64)
+            picks, relevance = rerank(self.store.features, self.artists, rows, centres, neighbour_rows, n)
+            result = self.tracks(picks, relevance, 'relevance')
+            self.cache.put(key, result)
+        return result
+
+
+def parse_k(value, name: str = 'k') -> int:
+    try:
+        k = int(value)
+    except (TypeError, ValueError):
+        raise web.HTTPBadRequest(text=f'{name} has to be an integer')
+    if not 1 <= k <= 1000:
+        raise web.HTTPBadRequest(text=f'{name} has to be between 1 and 1000')
+    return k
+
+
+async def parse_body(request: web.Request) -> dict:
+    try:
+        body = await request.json()
+    except ValueError:
+        # invalid json (JSONDecodeError) or a body that isn't utf-8 (UnicodeDecodeError)
+        raise web.HTTPBadRequest(text='the body has to be json')
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text='the body has to be a json object')
+    return body
+
+
+def parse_track_ids(value) -> list[str]:
+    # a list of track id strings, empty entries are dropped
+    if value is None:
+        value = []
+    if not isinstance(value, list) or not all(isinstance(track_id, str) for track_id in value):
+        raise web.HTTPBadRequest(text='track_ids has to be a list of strings')
+    track_ids = [track_id for track_id in value if track_id]
+    if not track_ids:
+        raise web.HTTPBadRequest(text='track_ids is required')
+    return track_ids
+
+
+async def similar_handler(request: web.Request) -> web.Response:
+    track_id = request.query.get('track_id')
+    if not track_id:
+        raise web.HTTPBadRequest(text='track_id is required')
+    recommender = request.app['recommender']
+    results = await recommender.similar(track_id, parse_k(request.query.get('k', 10)))
+    return web.json_response({'track_id': track_id, 'results': results})
+
+
+async def recommend_handler(request: web.Request) -> web.Response:
+    # POST {"track_ids": [...], "k": 10} or GET ?track_ids=a,b,c&k=10
+    if request.method == 'POST':
+        body = await parse_body(request)
+        track_ids, k = parse_track_ids(body.get('track_ids')), body.get('k', 10)
+    else:
+        track_ids, k = parse_track_ids(request.query.get('track_ids', '').split(',')), request.query.get('k', 10)
+    recommender = request.app['recommender']
+    results = await recommender.recommend(track_ids, parse_k(k))
+    return web.json_response({'track_ids': track_ids, 'results': results})
+
+
+async def continue_handler(request: web.Request) -> web.Response:
+    # POST {"track_ids": [...], "n": 20}
+    body = await parse_body(request)
+    track_ids = parse_track_ids(body.get('track_ids'))
+    recommender = request.app['recommender']
+    results = await recommender.continue_playlist(track_ids, parse_k(body.get('n', 20), 'n'))
+    return web.json_response({'results': results})
+
+
+async def stats_handler(request: web.Request) -> web.Response:
+    recommender = request.app['recommender']
+    batcher = recommender.batcher
+    return web.json_response({
+        'tracks': len(recommender.store),
+        'batches': batcher.batches,
+        'queries': batcher.queries,
+        'mean_batch_size': batcher.queries / max(batcher.batches, 1),
+        'cache_hits': recommender.cache.hits,
+        'cache_misses': recommender.cache.misses,
+    })
+
+
+def create_app(recommender: Recommender) -> web.Application:
+    app = web.Application()
+    app['recommender'] = recommender
+
+    async def start_batcher(app):
+        app['batcher_task'] = asyncio.create_task(recommender.batcher.run())
+        yield
+        app['batcher_task'].cancel()
+
+    app.cleanup_ctx.append(start_batcher)
+    app.add_routes([
+        web.get('/similar', similar_handler),
+        web.get('/recommend', recommend_handler),
+        web.post('/recommend', recommend_handler),
+        web.post('/continue', continue_handler),
+        web.get('/stats', stats_handler),
+    ])
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve audio feature based recommendations over HTTP.')
+    parser.add_argument('--dataset', default=os.path.join(model_dir, DATASET_PATH))
+    parser.add_argument('--synthetic', type=int, help='serve this many synthetic tracks instead of the dataset')
+    parser.add_argument('--store-dir', default=os.path.join(model_dir, 'feature_store'))
+    parser.add_argument('--metric', default='euclidean')
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-wait-ms', type=float, default=2)
+    parser.add_argument('--cache-size', type=int, default=10_000)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--aliases', help='alias map csv (id, canonical_id) of the tracks collapsed by dedup.py')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    tracks_df, features = load_dataset(args.dataset, args.synthetic, columns=METADATA_COLUMNS, store_dir=args.store_dir)
+    store = FeatureStore(os.path.dirname(features.filename))
+    aliases = AliasMap(pd.read_csv(args.aliases)) if args.aliases else None
+    recommender = Recommender(store, tracks_df, args.metric, args.max_batch, args.max_wait_ms / 1000, args.cache_size, aliases)
+    print(f'Loaded {len(store)} tracks in {time.perf_counter() - start:.1f}s')
+    web.run_app(create_app(recommender), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()